@@ -22,15 +22,46 @@
 
 __all__ = [
            'maximize_total_fds',
-           'AsyncEvent', 'Dispatcher', 'ScheduledJob',
+           'AsyncEvent', 'Dispatcher', 'ScheduledJob', 'DrainJob',
            'AeError', 'AeExitNow', 'AeAlreadyAttachedError', 'AeNotAttachedError',
-           'TcpClientDispatcher', 'TcpServerDispatcher',
+           'AeFrameError',
+           'TcpClientDispatcher', 'TcpServerDispatcher', 'UdpDispatcher',
+           'BufferedStreamDispatcher',
+           'PreforkServer', 'BufferPool',
+           'FramedStreamDispatcher',
+           'LengthPrefixedDecoder', 'DelimiterDecoder', 'FixedSizeDecoder',
+           'LengthPrefixedEncoder', 'DelimiterEncoder', 'FixedSizeEncoder',
+           'RelayDispatcher',
+           'UnixServerDispatcher', 'UnixStreamDispatcher', 'UnixDatagramDispatcher',
+           'HandoffServerDispatcher', 'HandoffWorkerDispatcher',
+           'Resolver', 'SocketProfile', 'ConnectionPool',
+           'TlsStreamDispatcher', 'TlsServerDispatcher', 'TlsSessionCache',
+           'tls_context', 'HotUpgrade',
+           'PipeDispatcher', 'SubprocessDispatcher',
            ]
 
-from ._asyncevent import AsyncEvent, Dispatcher, ScheduledJob
+from ._asyncevent import AsyncEvent, Dispatcher, ScheduledJob, DrainJob
 from ._error import (AeError, AeExitNow, AeAlreadyAttachedError,
-                     AeNotAttachedError)
-from ._socket_dispatcher import TcpClientDispatcher, TcpServerDispatcher
+                     AeNotAttachedError, AeFrameError)
+from ._socket_dispatcher import (TcpClientDispatcher, TcpServerDispatcher,
+                                 UdpDispatcher)
+from ._stream_dispatcher import BufferedStreamDispatcher
+from ._prefork import PreforkServer
+from ._buffer_pool import BufferPool
+from ._framing import (FramedStreamDispatcher,
+                       LengthPrefixedDecoder, DelimiterDecoder, FixedSizeDecoder,
+                       LengthPrefixedEncoder, DelimiterEncoder, FixedSizeEncoder)
+from ._relay import RelayDispatcher
+from ._unix_dispatcher import (UnixServerDispatcher, UnixStreamDispatcher,
+                               UnixDatagramDispatcher)
+from ._handoff import HandoffServerDispatcher, HandoffWorkerDispatcher
+from ._resolver import Resolver
+from ._socket_profile import SocketProfile
+from ._connection_pool import ConnectionPool
+from ._tls_dispatcher import (TlsStreamDispatcher, TlsServerDispatcher,
+                              TlsSessionCache, tls_context)
+from ._hot_upgrade import HotUpgrade
+from ._pipe_dispatcher import PipeDispatcher, SubprocessDispatcher
 
 def maximize_total_fds():
     '''
@@ -18,6 +18,8 @@
 # along with pynebula. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import concurrent.futures
 import errno
 import os
 import select
@@ -25,7 +27,10 @@ import time
 
 from .. import debug_info as _debug_info
 from .. import log as _log
+from . import _buffer_pool
 from . import _error
+from . import _resolver
+from . import _timer
 
 class _SelectApiWrapper(object):
     SELECT_IN, SELECT_OUT, SELECT_ERR = 0x01, 0x02, 0x04
@@ -120,8 +125,14 @@ class AsyncEvent(_log.WrappedLogger):
 
     __api_names = {API_EPOLL: "epoll", API_POLL: "poll", API_SELECT: "select"}
 
+    TIMER_HEAP, TIMER_WHEEL = 0, 1
+
+    __timer_names = {TIMER_HEAP: "heap", TIMER_WHEEL: "wheel"}
+
     def __init__(self, raise_exceptions = True, api = API_DEFAULT,
-                 log_handle = None):
+                 log_handle = None, timer = TIMER_HEAP, timer_resolution = 0.1,
+                 timer_wheel_size = 512, timer_budget = None,
+                 edge_triggered = False, executor_workers = 4):
         '''Asynchronous event loop.
 
         Args:
@@ -136,6 +147,37 @@ class AsyncEvent(_log.WrappedLogger):
                             system, this class will automatically choose an
                             API available.
           log_handle:       A log handle to be used, None to disable logging.
+          timer:            Specifies how timeouts of dispatchers are kept,
+                            valid values are TIMER_HEAP and TIMER_WHEEL.
+                            TIMER_HEAP fires timeouts exactly, arming one costs
+                            O(log n). TIMER_WHEEL uses a hashed timing wheel,
+                            arming, re-arming and cancelling costs O(1), but
+                            timeouts might fire up to `timer_resolution'
+                            seconds late. Prefer TIMER_WHEEL if there are lots
+                            of dispatchers pushing their timeouts forward after
+                            every event, e.g. idle connection timeouts.
+                            Scheduled jobs are always kept in a heap.
+          timer_resolution: Length (in seconds, as float) of one tick of the
+                            timing wheel, ignored if `timer' is TIMER_HEAP.
+          timer_wheel_size: Number of slots of the timing wheel, ignored if
+                            `timer' is TIMER_HEAP.
+          timer_budget:     Max number of expired fd timeouts, and max number
+                            of expired scheduled jobs, handled in one iteration
+                            of the loop, None for no limit. Timers exceeding
+                            the budget are handled in the next iteration,
+                            which won't block in poll().
+          edge_triggered:   If True, and the event API used is API_EPOLL,
+                            register fds in edge-triggered mode (EPOLLET). Each
+                            fd is registered for IN and OUT events once, and
+                            its event mask is never modified afterwards, so
+                            readable() and writable() of dispatchers are NOT
+                            called. In exchange, a dispatcher MUST read (and
+                            write, if it has data to send) until the operation
+                            fails with EAGAIN, or it won't be notified again.
+                            Ignored (with a notice) for other event APIs.
+          executor_workers: Max number of threads of the thread pool used by
+                            run_in_executor(), the pool is created on first
+                            use. See also set_executor().
         '''
 
         _log.WrappedLogger.__init__(self, log_handle = log_handle)
@@ -150,18 +192,42 @@ class AsyncEvent(_log.WrappedLogger):
         else:
             raise ValueError("API {:d} is not supported".format(api))
 
-        #=======================================================================
-        # NOTE:
-        #   This feature is NOT implemented yet!!!
-        #
-        # Tips:
-        #   Use os.read() & os.write().
-        #=======================================================================
-        # pipe used by set_stop_flag() to make epoll.poll() return
-        self._pipe_rd_end, self._pipe_wr_end = os.pipe()
-
-        self.__set_nonblock_flag(self._pipe_rd_end)
-        self.__set_nonblock_flag(self._pipe_wr_end)
+        if edge_triggered and self._event_api != self.API_EPOLL:
+            self.log_notice("edge-triggered mode requires epoll, using level-triggered {:s}".format(
+                self.event_api_name()))
+            edge_triggered = False
+        self._edge_triggered = edge_triggered and True or False
+
+        # Pipe (or eventfd, if available, in which case both ends are the same
+        # fd) used by wakeup() to make poll() return.
+        if hasattr(os, 'eventfd'):
+            self._pipe_rd_end = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._pipe_wr_end = self._pipe_rd_end
+        else:
+            self._pipe_rd_end, self._pipe_wr_end = os.pipe()
+
+            self.__set_nonblock_flag(self._pipe_rd_end)
+            self.__set_nonblock_flag(self._pipe_wr_end)
+        self._pollster.register(self._pipe_rd_end, self._event_in_mask)
+
+        # callbacks submitted by call_soon_threadsafe(), items are 2-tuples of
+        # (callback, args)
+        self._ready_callbacks = collections.deque()
+        # True if wakeup() was called and the loop has not woken up yet, used
+        # to coalesce multiple wakeups into one write
+        self._wakeup_pending = False
+
+        # executor used by run_in_executor(), and whether it's owned by us
+        self._executor = None
+        self._own_executor = False
+        self._executor_workers = executor_workers
+        # number of futures watched by call_when_done() (including jobs
+        # submitted by run_in_executor()) not delivered yet
+        self._pending_futures = 0
+        # created on first use, see buffer_pool()
+        self._buffer_pool = None
+        # None to use the shared one, see resolver()
+        self._resolver = None
 
         self.log_debug("AsyncEvent initialized, api {:s}{:s}, pipe (r {:d}, w {:d})".format(
             self.event_api_name(),
@@ -174,11 +240,25 @@ class AsyncEvent(_log.WrappedLogger):
         self._registered_dispatchers = {}
         # mapping from fd to events monitored
         self._monitored_events = {}
-        # list of monitored fds with timeout, item is 2-tuple of (timeout, fd)
-        self._fds_with_timeout = []
+        # dispatchers whose monitored events need to be re-synchronized
+        self._dirty_dispatchers = set()
+        # timers of monitored fds, keyed by fd
+        if timer == self.TIMER_HEAP:
+            self._fds_with_timeout = _timer._HeapTimerQueue()
+        elif timer == self.TIMER_WHEEL:
+            self._fds_with_timeout = _timer._TimingWheel(timer_resolution,
+                                                         timer_wheel_size)
+        else:
+            raise ValueError("timer {:d} is not supported".format(timer))
+        self._timer = timer
+        if timer_budget is not None and timer_budget <= 0:
+            raise ValueError("timer_budget must be positive: {:d}".format(timer_budget))
+        self._timer_budget = timer_budget
 
         # --- time events related ---
-        self._time_events = []
+
+        # timers of scheduled jobs, keyed by job object
+        self._time_events = _timer._HeapTimerQueue()
 
         # raise an exception in case of error
         self._raise_exceptions = raise_exceptions
@@ -195,6 +275,8 @@ class AsyncEvent(_log.WrappedLogger):
             self._event_out_mask = select.EPOLLOUT
             self._event_hup_mask = select.EPOLLHUP
             self._event_err_mask = select.EPOLLERR
+            self._event_et_mask = select.EPOLLET
+            self._event_exclusive_mask = getattr(select, 'EPOLLEXCLUSIVE', 0)
 
         elif api == self.API_POLL:
             self._pollster = select.poll()
@@ -205,6 +287,8 @@ class AsyncEvent(_log.WrappedLogger):
             self._event_out_mask = select.POLLOUT
             self._event_hup_mask = select.POLLHUP
             self._event_err_mask = select.POLLERR
+            self._event_et_mask = 0
+            self._event_exclusive_mask = 0
 
         elif api == self.API_SELECT:
             self._pollster = _SelectApiWrapper()
@@ -215,6 +299,8 @@ class AsyncEvent(_log.WrappedLogger):
             self._event_out_mask = _SelectApiWrapper.SELECT_OUT
             self._event_hup_mask = _SelectApiWrapper.SELECT_ERR
             self._event_err_mask = _SelectApiWrapper.SELECT_ERR
+            self._event_et_mask = 0
+            self._event_exclusive_mask = 0
 
         else:
             raise ValueError("API {:d} is not supported".format(api))
@@ -229,21 +315,214 @@ class AsyncEvent(_log.WrappedLogger):
 
         return self._event_api
 
+    def edge_triggered(self):
+        "Whether fds are registered in edge-triggered mode or not."
+
+        return self._edge_triggered
+
+    def timer_name(self):
+        "String representation of the timer used for timeouts of dispatchers."
+
+        return self.__timer_names[self._timer]
+
+    def timer(self):
+        "Timer used for timeouts of dispatchers."
+
+        return self._timer
+
     def set_stop_flag(self):
-        '''Try to stop the event loop.
+        '''Stops the event loop.
 
-        Notes:
-          This method may not work as expected, refer to method loop() for more
-          information.
+        The loop returns after the current iteration. This method is safe to be
+        called from other threads, or from signal handlers.
         '''
 
         self._stop_flag = True
+        self.wakeup()
 
     def get_stop_flag(self):
         '''Check if the stop flag was set.'''
 
         return self._stop_flag
 
+    def wakeup(self):
+        '''Makes a blocking poll() of the event loop return.
+
+        This method is safe to be called from other threads, or from signal
+        handlers. Multiple calls before the loop wakes up are coalesced into
+        one write to the wakeup pipe.
+        '''
+
+        if self._wakeup_pending:
+            return
+        self._wakeup_pending = True
+        try:
+            if self._pipe_wr_end == self._pipe_rd_end:
+                os.eventfd_write(self._pipe_wr_end, 1)
+            else:
+                os.write(self._pipe_wr_end, b'\0')
+        except BlockingIOError:
+            # pipe is full, the loop will wake up anyway
+            pass
+        except OSError as err:
+            if err.args[0] != errno.EBADF:
+                raise
+            # closed by close()
+
+    def call_soon_threadsafe(self, callback, *args):
+        '''Calls `callback(*args)' in the thread running the event loop.
+
+        This method is safe to be called from other threads. Callbacks are
+        called in the order they were submitted, at the end of the current (or
+        next) iteration of the loop. A pending callback keeps the loop running.
+        '''
+
+        self._ready_callbacks.append((callback, args))
+        self.wakeup()
+
+    def __handle_wakeup(self):
+        # Clear the flag after draining: a concurrent wakeup() seeing the flag
+        # still set has queued its callback already, which is run below. If
+        # cleared before, the write of a concurrent wakeup() could be drained
+        # with the flag left set, and later wakeups would be lost.
+        try:
+            if self._pipe_wr_end == self._pipe_rd_end:
+                os.eventfd_read(self._pipe_rd_end)
+            else:
+                while os.read(self._pipe_rd_end, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+        self._wakeup_pending = False
+
+    def __run_ready_callbacks(self):
+        # callbacks submitted by these callbacks are run in next iteration
+        ready = self._ready_callbacks
+        for unused_idx in range(len(ready)):
+            callback, args = ready.popleft()
+            try:
+                callback(*args)
+            except (_error.AeExitNow, KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                unused_nil, exp_type, exp_value, exp_traceback = _debug_info.compact_traceback()
+                self.log_err('callback {:s} failed, exception {:s} (type: {:s}, callstack: {:s})'.format(
+                    repr(callback), str(exp_value), str(exp_type), exp_traceback))
+
+    def set_executor(self, executor):
+        '''Sets the executor used by run_in_executor().
+
+        Args:
+          executor: an instance of concurrent.futures.Executor, e.g. a
+                    ProcessPoolExecutor for CPU-bound jobs. It's NOT shut down
+                    by close().
+        '''
+
+        if not isinstance(executor, concurrent.futures.Executor):
+            raise TypeError("{:s} is not an instance of concurrent.futures.Executor".format(
+                repr(executor)))
+        if self._own_executor:
+            self._executor.shutdown(wait = False)
+        self._executor = executor
+        self._own_executor = False
+
+    def run_in_executor(self, func, *args, callback = None):
+        '''Calls `func(*args)' in the executor, without blocking the loop.
+
+        Use it for blocking (e.g. DNS lookup, file I/O) or CPU-bound (e.g.
+        decompression) jobs. This method must be called in the thread running
+        the loop; a job not delivered yet keeps the loop running.
+
+        Args:
+          func:     callable to be called in the executor
+          callback: optional callable, called with the finished future as its
+                    only argument, in the thread running the loop
+
+        Returns:
+          A concurrent.futures.Future object.
+        '''
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = self._executor_workers,
+                thread_name_prefix = 'AsyncEvent-executor')
+            self._own_executor = True
+
+        future = self._executor.submit(func, *args)
+        self.call_when_done(future, callback)
+        return future
+
+    def call_when_done(self, future, callback = None):
+        '''Calls `callback(future)' in the thread running the loop, once
+        `future' (a concurrent.futures.Future object) is done.
+
+        This method must be called in the thread running the loop; a future
+        not delivered yet keeps the loop running.
+        '''
+
+        self._pending_futures += 1
+        # called in the thread completing the future, or in this thread if
+        # already finished
+        future.add_done_callback(
+            lambda f: self.call_soon_threadsafe(self.__deliver_future, f, callback))
+
+    def __deliver_future(self, future, callback):
+        self._pending_futures -= 1
+        if callback is not None:
+            callback(future)
+
+    def buffer_pool(self):
+        '''Returns the BufferPool shared by dispatchers of this object, e.g.
+        used by _SocketDispatcher.recv_pooled().'''
+
+        if self._buffer_pool is None:
+            self._buffer_pool = _buffer_pool.BufferPool()
+        return self._buffer_pool
+
+    def set_buffer_pool(self, pool):
+        '''Sets the BufferPool returned by buffer_pool(), e.g. one with size
+        classes suited to the application.'''
+
+        if not isinstance(pool, _buffer_pool.BufferPool):
+            raise TypeError("{:s} is not an instance of BufferPool".format(repr(pool)))
+        self._buffer_pool = pool
+
+    def resolver(self):
+        '''Returns the Resolver used by dispatchers of this object to look up
+        host names, by default the one shared by all AsyncEvent objects.'''
+
+        if self._resolver is None:
+            return _resolver.default_resolver()
+        return self._resolver
+
+    def set_resolver(self, resolver):
+        '''Sets the Resolver returned by resolver(), e.g. one with its own
+        cache settings.'''
+
+        if not isinstance(resolver, _resolver.Resolver):
+            raise TypeError("{:s} is not an instance of Resolver".format(repr(resolver)))
+        self._resolver = resolver
+
+    def close(self):
+        '''Releases the wakeup pipe, the poll object, and the executor created
+        by run_in_executor().
+
+        Registered dispatchers are NOT closed, the object must not be used
+        afterwards.
+        '''
+
+        if self._own_executor:
+            self._executor.shutdown(wait = False)
+            self._executor = None
+            self._own_executor = False
+
+        fds = set((self._pipe_rd_end, self._pipe_wr_end))
+        self._pipe_rd_end = self._pipe_wr_end = -1
+        for fd in fds:
+            os.close(fd)
+        if self._event_api == self.API_EPOLL:
+            self._pollster.close()
+
     def num_of_dispatchers(self):
         '''Returns number of Dispatcher objects being monitored.'''
 
@@ -255,11 +534,11 @@ class AsyncEvent(_log.WrappedLogger):
         return len(self._time_events)
 
     def __str__(self):
-        return "<%s.%s at %s {api: %s%s, pipe_rd:%d, pipe_wr:%d, dispatchers:%d, jobs:%d, stop_flag:%d}>" % \
+        return "<%s.%s at %s {api: %s%s, timer:%s, pipe_rd:%d, pipe_wr:%d, dispatchers:%d, jobs:%d, stop_flag:%d}>" % \
             (self.__class__.__module__, self.__class__.__name__, hex(id(self)),
              self.event_api_name(),
              self.event_api() == self.API_EPOLL and ", epoll_fd:{:d}".format(self._pollster.fileno()) or "",
-             self._pipe_rd_end, self._pipe_wr_end, self.num_of_dispatchers(),
+             self.timer_name(), self._pipe_rd_end, self._pipe_wr_end, self.num_of_dispatchers(),
              self.num_of_scheduled_jobs(), self._stop_flag,)
 
     def register(self, disp_obj):
@@ -286,30 +565,24 @@ class AsyncEvent(_log.WrappedLogger):
         if file_number not in self._registered_dispatchers:
             disp_obj.attach_to_pollster(self)
 
-            flags = 0
-            flag_names = []
-            if disp_obj.monitor_readable():
-                flags |= self._event_in_mask
-                flag_names.append("IN")
-                if self._event_in_mask != self._event_pri_mask:
-                    flags |= self._event_pri_mask
-                    flag_names.append("PRI")
-            if disp_obj.monitor_writable():
-                flags |= self._event_out_mask
-                flag_names.append("OUT")
+            if disp_obj.monitor_fd():
+                flags = self.__initial_flags(disp_obj)
+                self._pollster.register(file_number, flags)
+                self.log_debug("monitored fd {:d}, flags ({:s})".format(file_number,
+                    self.__flag_names(flags)))
+            else:
+                # None: not registered with the pollster
+                flags = None
+                self.log_debug("fd {:d} not polled".format(file_number))
 
             timeout = disp_obj.monitor_timeout()
 
-            self._pollster.register(file_number, flags)
-            self.log_debug("monitored fd {:d}, flags ({:s})".format(file_number,
-                " ".join(flag_names)))
-
             self._registered_dispatchers[file_number] = disp_obj
             # NOTE: a new entry is always created, no matter flag is 0 or not!
             self._monitored_events[file_number] = flags
 
             if timeout:
-                self._fds_with_timeout.append((timeout, file_number))
+                self._fds_with_timeout.push(file_number, timeout)
                 self.log_debug("fd {:d}, timeout event at {:s}".format(
                     file_number, _log.Logger.timestamp_str(timeout)))
             else:
@@ -348,9 +621,11 @@ class AsyncEvent(_log.WrappedLogger):
             disp_obj.detach_from_pollster(self)
 
             del self._registered_dispatchers[file_number]
-            del self._monitored_events[file_number]
-            self.__remove_timeout_fd(file_number)
-            self._pollster.unregister(file_number)
+            polled = self._monitored_events.pop(file_number) is not None
+            self._dirty_dispatchers.discard(disp_obj)
+            self._fds_with_timeout.cancel(file_number)
+            if polled:
+                self._pollster.unregister(file_number)
             return True
         elif not self._raise_exceptions:
             return False
@@ -361,16 +636,21 @@ class AsyncEvent(_log.WrappedLogger):
     def add_scheduled_job(self, job_obj):
         '''Schedule to execute the job in the future.
 
+        Adding a job already scheduled re-arms it by calling its schedule()
+        again, a job whose schedule() returns None is cancelled.
+
         Returns:
-          Absolute time (since epoch, as float) the job will be started, or
-          None if not scheduled.
+          True if the job is scheduled, at the time returned by its
+          schedule(); False if schedule() returned None (or 0), the job is
+          not scheduled, and cancelled if it was.
         '''
 
         timeout = job_obj.schedule()
         if timeout:
-            self._time_events.append((timeout, job_obj))
+            self._time_events.push(job_obj, timeout)
             return True
         else:
+            self._time_events.cancel(job_obj)
             return False
 
     def __set_nonblock_flag(self, fd):
@@ -396,7 +676,7 @@ class AsyncEvent(_log.WrappedLogger):
 
             return True
         except IOError as err:
-            self.log_notice("fcntl() failed setting O_NONBLOCK on fd {:d}, exception {:s}".format(fd, err))
+            self.log_notice("fcntl() failed setting O_NONBLOCK on fd {:d}, exception {:s}".format(fd, str(err)))
             return False
         except ImportError:
             return False
@@ -428,30 +708,26 @@ class AsyncEvent(_log.WrappedLogger):
             # 4th: HUP and ERR event
             if (flags & (self._event_hup_mask | self._event_err_mask)) \
             and (fd in self._registered_dispatchers):
-                disp_obj.handle_close()
+                disp_obj.handle_hup_event()
         except (_error.AeExitNow, KeyboardInterrupt, SystemExit):
             raise
         except Exception as e:
             disp_obj.handle_error(e)
 
     def __loop_step(self):
+        if self._dirty_dispatchers:
+            self.__sync_dirty_dispatchers()
+
         nearest_timeout = -1
+        if self._ready_callbacks or self._stop_flag:
+            nearest_timeout = 0
 
         now = time.time()
 
-        if len(self._fds_with_timeout):
-            self.__sort_timeout_fds()
-            nt = self._fds_with_timeout[0][0] - now
-
-            if nt <= 0: # already timed out
-                nearest_timeout = 0
-            else: # not timed out yet
-                if (nearest_timeout < 0) or (nt < nearest_timeout):
-                    nearest_timeout = nt
-
-        if len(self._time_events):
-            self.__sort_time_events()
-            nt = self._time_events[0][0] - now
+        for deadline in (self._fds_with_timeout.peek(), self._time_events.peek()):
+            if deadline is None:
+                continue
+            nt = deadline - now
 
             if nt <= 0: # already timed out
                 nearest_timeout = 0
@@ -475,118 +751,175 @@ class AsyncEvent(_log.WrappedLogger):
             result = []
 
         if len(result):
+            registered = self._registered_dispatchers
             for fd, flags in result:
                 if self.get_log_handle():
-                    flag_names = []
-                    if flags & self._event_in_mask:
-                        flag_names.append("IN")
-                    if flags & self._event_out_mask:
-                        flag_names.append("OUT")
-                    if (flags & self._event_pri_mask) \
-                    and (self._event_pri_mask != self._event_in_mask):
-                        flag_names.append("PRI")
-                    if (flags & self._event_hup_mask) \
-                    and (self._event_hup_mask != self._event_err_mask):
-                        flag_names.append("HUP")
-                    if flags & self._event_err_mask:
-                        flag_names.append("ERR")
                     self.log_debug("events fired, fd {:d}, flags ({:s})".format(
-                        fd, " ".join(flag_names)))
+                        fd, self.__flag_names(flags)))
 
+                if fd == self._pipe_rd_end:
+                    self.__handle_wakeup()
+                    continue
+
+                disp_obj = registered.get(fd)
+                if disp_obj is None:
+                    continue
                 self.__process_fired_events(fd, flags)
-                self.__update_associated_events(fd)
-        else:
-            now = time.time()
+                # dispatchers using explicit interest (see want_read() etc. of
+                # Dispatcher) are re-synchronized only if marked dirty
+                if not disp_obj.explicit_interest():
+                    self.__update_associated_events(fd)
+
+        # Expired timers are processed on every iteration, even if I/O events
+        # were fired, so a busy loop won't postpone them indefinitely.
+        self.__process_expired_timers()
 
-            # handle timeout events of file descriptors
-            for (timeout, fd) in self._fds_with_timeout:
-                if timeout > now:
-                    break
-                del self._fds_with_timeout[0]
+        if self._ready_callbacks:
+            self.__run_ready_callbacks()
 
-                self._registered_dispatchers[fd].handle_timeout_event(self)
+    def __process_expired_timers(self):
+        now = time.time()
+
+        # handle timeout events of file descriptors, timers re-armed by the
+        # handlers are not collected by pop_due() called here
+        for fd in self._fds_with_timeout.pop_due(now, self._timer_budget):
+            disp_obj = self._registered_dispatchers.get(fd)
+            if disp_obj is None:
+                continue
+            if disp_obj.explicit_interest():
+                # deadline set by set_deadline() is one-shot, the handler may
+                # set a new one
+                disp_obj.set_deadline(None)
+                disp_obj.handle_timeout_event(self)
+            else:
+                disp_obj.handle_timeout_event(self)
                 self.__update_associated_events(fd)
 
-            # handle scheduled jobs
-            # TODO: it seems strange to deleting items from iterable while iterating
-            for (timeout, job_obj) in self._time_events:
-                if timeout > now:
-                    break
-                del self._time_events[0]
-                job_obj.handle_job_event()
-                new_timeout = job_obj.schedule()
-                if new_timeout:
-                    self._time_events.append((new_timeout, job_obj))
-
-    def __sort_timeout_fds(self):
-        self._fds_with_timeout = sorted(self._fds_with_timeout,
-                                        key = lambda item: item[0])
-
-    def __sort_time_events(self):
-        self._time_events = sorted(self._time_events,
-                                   key = lambda item: item[0])
-
-    def __remove_timeout_fd(self, fd):
-        for (idx, (unused_timeout, a_fd)) in enumerate(self._fds_with_timeout):
-            if fd == a_fd:
-                del self._fds_with_timeout[idx]
-                # assume there's no duplicated fd in self._fds_with_timeout[]
-                break
+        # handle scheduled jobs
+        for job_obj in self._time_events.pop_due(now, self._timer_budget):
+            job_obj.handle_job_event()
+            new_timeout = job_obj.schedule()
+            if new_timeout:
+                self._time_events.push(job_obj, new_timeout)
 
     def __update_associated_events(self, fd):
-        if fd not in self._registered_dispatchers:
+        disp_obj = self._registered_dispatchers.get(fd)
+        if disp_obj is None:
             return
 
-        self.__remove_timeout_fd(fd)
+        if not disp_obj.monitor_fd():
+            if self._monitored_events[fd] is not None:
+                self.log_debug("fd {:d} not polled any more".format(fd))
+                self._pollster.unregister(fd)
+                self._monitored_events[fd] = None
+        elif self._monitored_events[fd] is None:
+            flags = self.__initial_flags(disp_obj)
+            self._pollster.register(fd, flags)
+            self._monitored_events[fd] = flags
+            self.log_debug("monitored fd {:d}, flags ({:s})".format(fd,
+                self.__flag_names(flags)))
+        elif not (self._edge_triggered
+                  or self._monitored_events[fd] & self._event_exclusive_mask):
+            flags = self.__interest_flags(disp_obj)
+            if self._monitored_events[fd] != flags:
+                if self.get_log_handle():
+                    self.log_debug("modifying fd {:d}, flags {:d} -> {:d} ({:s})".format(
+                        fd, self._monitored_events[fd], flags, self.__flag_names(flags)))
+                self._pollster.modify(fd, flags)
+                self._monitored_events[fd] = flags
 
-        disp_obj = self._registered_dispatchers[fd]
+        timeout = disp_obj.monitor_timeout()
+        if timeout:
+            self._fds_with_timeout.push(fd, timeout)
+            if self.get_log_handle():
+                self.log_debug("fd {:d}, timeout event at {:s}".format(fd,
+                    _log.Logger.timestamp_str(timeout)))
+        else:
+            self._fds_with_timeout.cancel(fd)
+
+    def __initial_flags(self, disp_obj):
+        '''Event mask a dispatcher is registered with.'''
+
+        if self._edge_triggered:
+            # event mask is never modified in edge-triggered mode
+            flags = self._event_in_mask | self._event_pri_mask \
+                  | self._event_out_mask | self._event_et_mask
+        else:
+            flags = self.__interest_flags(disp_obj)
+        if self._event_exclusive_mask and disp_obj.exclusive_wakeup():
+            # EPOLLEXCLUSIVE can't be modified, so the event mask is fixed
+            flags = self._event_in_mask | self._event_exclusive_mask \
+                  | (flags & self._event_et_mask)
+        return flags
+
+    def __interest_flags(self, disp_obj):
+        '''Event mask a (level-triggered) dispatcher is interested in.'''
 
         flags = 0
-        flag_names = []
         if disp_obj.monitor_readable():
-            flags |= self._event_in_mask
-            flag_names.append("IN")
-            if self._event_in_mask != self._event_pri_mask:
-                flags |= self._event_pri_mask
-                flag_names.append("PRI")
+            flags = self._event_in_mask | self._event_pri_mask
         if disp_obj.monitor_writable():
             flags |= self._event_out_mask
+        return flags
+
+    def __flag_names(self, flags):
+        '''String representation of an event mask, used for logging only.'''
+
+        flag_names = []
+        if flags & self._event_in_mask:
+            flag_names.append("IN")
+        if flags & self._event_out_mask:
             flag_names.append("OUT")
+        if (flags & self._event_pri_mask) \
+        and (self._event_pri_mask != self._event_in_mask):
+            flag_names.append("PRI")
+        if (flags & self._event_hup_mask) \
+        and (self._event_hup_mask != self._event_err_mask):
+            flag_names.append("HUP")
+        if flags & self._event_err_mask:
+            flag_names.append("ERR")
+        if flags & self._event_et_mask:
+            flag_names.append("ET")
+        if flags & self._event_exclusive_mask:
+            flag_names.append("EXCLUSIVE")
+        return " ".join(flag_names)
+
+    def mark_dirty(self, disp_obj):
+        '''Re-synchronize events monitored for the dispatcher before the next
+        call of poll().
+
+        Called by Dispatcher.update_interest(), dispatchers marked more than
+        once in one iteration are re-synchronized only once.
+        '''
 
-        if self._monitored_events[fd] != flags:
-            self.log_debug("modifying fd {:d}, flags {:d} -> {:d} ({:s})".format(
-                fd, self._monitored_events[fd], flags, " ".join(flag_names)))
-            self._pollster.modify(fd, flags)
-            self._monitored_events[fd] = flags
-        else:
-            self.log_debug("monitored fd {:d}, flags ({:s})".format(fd,
-                " ".join(flag_names)))
+        self._dirty_dispatchers.add(disp_obj)
 
-        timeout = disp_obj.monitor_timeout()
-        if timeout:
-            self._fds_with_timeout.append((timeout, fd))
-            self.log_debug("fd {:d}, timeout event at {:s}".format(fd,
-                _log.Logger.timestamp_str(timeout)))
-        else:
-            self.log_debug("fd {:d}, no timeout event".format(fd))
+    def __sync_dirty_dispatchers(self):
+        dirty = self._dirty_dispatchers
+        self._dirty_dispatchers = set()
+        for disp_obj in dirty:
+            fd = disp_obj.fileno()
+            if self._registered_dispatchers.get(fd) is disp_obj:
+                self.__update_associated_events(fd)
 
     def loop(self):
         '''Starts the event loop
 
-        Event loop will terminate if no Dispatcher or ScheduledJob is available.
-
-        NOTES (or TODOs):
-          Sometimes this method might not terminate as you expected, because we
-          might be blocked in the call of poll().
+        Event loop will terminate if no Dispatcher, ScheduledJob, callback
+        submitted by call_soon_threadsafe(), or future watched by
+        call_when_done() (e.g. job submitted by run_in_executor()) is
+        available, or if the stop flag was set, see
+        set_stop_flag().
         '''
 
-        self.log_notice("starting {:s}".format(self))
+        self.log_notice("starting {:s}".format(str(self)))
 
         while (not self.get_stop_flag()) \
-        and (self.num_of_dispatchers() or self.num_of_scheduled_jobs()):
+        and (self.num_of_dispatchers() or self.num_of_scheduled_jobs()
+             or self._ready_callbacks or self._pending_futures):
             self.__loop_step()
 
-        self.log_notice("finishing {:s}".format(self))
+        self.log_notice("finishing {:s}".format(str(self)))
 
 #------------------------------------------------------------------------------ 
 
@@ -596,12 +929,22 @@ class Dispatcher(_log.WrappedLogger):
     This class turns a file (or socket) descriptor into a non-blocking object,
     and when certain low level events fired, the asynchronous loop will detect
     it and calls corresponding handler methods to handle it.
+
+    If the AsyncEvent object is in edge-triggered mode, readable() and
+    writable() are never called, and handle_read() (or handle_write()) must
+    read (or write) until the operation fails with EAGAIN.
     '''
 
     def __init__(self, log_handle = None):
         _log.WrappedLogger.__init__(self, log_handle)
         self.__pollster = None
 
+        # explicit interest, see want_read(), want_write() and set_deadline()
+        self.__explicit_interest = False
+        self.__want_read = False
+        self.__want_write = False
+        self.__deadline = None
+
     def attach_to_pollster(self, pollster):
         if not isinstance(pollster, AsyncEvent):
             raise TypeError("{:s}: not instance of AsyncEvent".format(repr(pollster)))
@@ -621,6 +964,79 @@ class Dispatcher(_log.WrappedLogger):
             raise _error.AeNotAttachedError
         return self.__pollster
 
+    def want_read(self, flag = True):
+        '''Declares whether read events should be waited.
+
+        Calling any of want_read(), want_write() or set_deadline() switches
+        this dispatcher to explicit interest: readable(), writable() and
+        timeout() return values declared by these methods, and the AsyncEvent
+        object re-synchronizes monitored events only if they were changed,
+        instead of querying this dispatcher after every event.
+
+        NOTES:
+          A subclass overriding readable(), writable() or timeout() should not
+          use these methods.
+        '''
+
+        self.__want_read = flag and True or False
+        self.__explicit_interest = True
+        self.update_interest()
+
+    def want_write(self, flag = True):
+        '''Declares whether write events should be waited, see want_read().'''
+
+        self.__want_write = flag and True or False
+        self.__explicit_interest = True
+        self.update_interest()
+
+    def set_deadline(self, deadline):
+        '''Declares when timeout event should be fired, see want_read().
+
+        Args:
+          deadline: time in seconds (as float) since the Epoch, either None or
+                    0 to cancel the timeout event. The deadline is cleared
+                    before handle_timeout() is called.
+        '''
+
+        self.__deadline = deadline
+        self.__explicit_interest = True
+        self.update_interest()
+
+    def explicit_interest(self):
+        '''Whether want_read(), want_write() or set_deadline() was used.'''
+
+        return self.__explicit_interest
+
+    def exclusive_wakeup(self):
+        '''Whether the fd should be registered with EPOLLEXCLUSIVE or not.
+
+        If True (and supported), the fd is registered for IN events only, and
+        the event mask is never modified.
+        '''
+
+        return False
+
+    def monitor_fd(self):
+        '''Whether the fd should be polled at all.
+
+        If False, the dispatcher stays registered, but its fd is removed from
+        the pollster (only its timeout is monitored), e.g. a socket not
+        connected yet, for which poll() reports HUP. Call update_interest()
+        once the value has changed.
+        '''
+
+        return True
+
+    def update_interest(self):
+        '''Tells the AsyncEvent object values returned by monitor_readable(),
+        monitor_writable() or monitor_timeout() might have changed.
+
+        Monitored events are re-synchronized before the next call of poll().
+        '''
+
+        if self.__pollster:
+            self.__pollster.mark_dirty(self)
+
     # 1. helper methods, implement these methods in derived classes
 
     def fileno(self):
@@ -652,6 +1068,9 @@ class Dispatcher(_log.WrappedLogger):
         will be called.
         '''
 
+        if self.__explicit_interest:
+            return self.__want_read
+
         self.log_notice("{:s}.{:s}: using default readable()".format(
             self.__class__.__module__, self.__class__.__name__))
         return True
@@ -663,6 +1082,9 @@ class Dispatcher(_log.WrappedLogger):
         will be called.
         '''
 
+        if self.__explicit_interest:
+            return self.__want_write
+
         self.log_notice("{:s}.{:s}: using default writable()".format(
             self.__class__.__module__, self.__class__.__name__))
         return True
@@ -678,6 +1100,9 @@ class Dispatcher(_log.WrappedLogger):
           event; either None or 0, if not interested in timeout event.
         '''
 
+        if self.__explicit_interest:
+            return self.__deadline
+
         self.log_notice("{:s}.{:s}: using default timeout()".format(
             self.__class__.__module__, self.__class__.__name__))
         return None
@@ -733,9 +1158,11 @@ class Dispatcher(_log.WrappedLogger):
         if exception_obj:
             unused_nil, exp_type, exp_value, exp_traceback = _debug_info.compact_traceback()
             self.log_notice('error, exception {:s} (type: {:s}, callstack: {:s}), fd {:d}, ae {:s}'.format(
-                exp_value, exp_type, exp_traceback, self.fileno(), self.pollster(False)))
+                str(exp_value), str(exp_type), exp_traceback, self.fileno(),
+                str(self.pollster(False))))
         else:
-            self.log_notice('error, fd {:d}, ae {:s}'.format(self.fileno(), self.pollster(False)))
+            self.log_notice('error, fd {:d}, ae {:s}'.format(self.fileno(),
+                str(self.pollster(False))))
         self.handle_close()
 
     def handle_close(self):
@@ -757,8 +1184,8 @@ class Dispatcher(_log.WrappedLogger):
         '''
 
         if self.pollster(False):
-            self.log_info("unregister, dispatcher {:s}, ae {:s}".format(self,
-                self.pollster()))
+            self.log_info("unregister, dispatcher {:s}, ae {:s}".format(str(self),
+                str(self.pollster())))
             self.pollster().unregister(self)
 
         self.close()
@@ -785,6 +1212,12 @@ class Dispatcher(_log.WrappedLogger):
         if call_user_func:
             self.handle_expt()
 
+    def handle_hup_event(self):
+        '''Called on HUP or ERR event, after read and write events of the
+        same iteration were handled; calls handle_close() by default.'''
+
+        self.handle_close()
+
     def monitor_readable(self, call_user_func = True):
         if call_user_func:
             return self.readable()
@@ -850,3 +1283,34 @@ class ScheduledJob(_log.WrappedLogger):
 
         self.log_notice("{:s}.{:s}: using default handle_timeout()".format(
             self.__class__.__module__, self.__class__.__name__))
+
+class DrainJob(ScheduledJob):
+    '''Stops the loop once all dispatchers are gone, or the deadline is hit,
+    e.g. after a server stopped accepting, so connections may finish.'''
+
+    def __init__(self, pollster, deadline, interval = 0.1, log_handle = None):
+        '''Creates the job, add it by AsyncEvent.add_scheduled_job().
+
+        Args:
+          pollster:   the AsyncEvent object to be stopped
+          deadline:   time in seconds (as float) since the Epoch, the loop is
+                      stopped then, even if dispatchers are left
+          interval:   seconds between checks
+          log_handle: a log handle to be used, None to disable logging
+        '''
+
+        ScheduledJob.__init__(self, log_handle = log_handle)
+        self._pollster = pollster
+        self._deadline = deadline
+        self._interval = interval
+
+    def schedule(self):
+        return time.time() + self._interval
+
+    def handle_job_event(self):
+        if not self._pollster.num_of_dispatchers():
+            self._pollster.set_stop_flag()
+        elif time.time() >= self._deadline:
+            self.log_notice("drain deadline reached, {:d} dispatchers left".format(
+                self._pollster.num_of_dispatchers()))
+            self._pollster.set_stop_flag()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+
+class BufferPool(object):
+    '''Pool of preallocated bytearray slabs, grouped in size classes.
+
+    lease() returns a slab of the smallest size class not smaller than the
+    requested size, release() puts it back for later reuse. Requests larger
+    than the largest size class are served by a new bytearray of the exact
+    size, which is not pooled.
+
+    The pool is not thread-safe, each AsyncEvent object owns its own pool, see
+    AsyncEvent.buffer_pool().
+    '''
+
+    DEFAULT_SIZE_CLASSES = (4096, 16384, 65536, 262144)
+
+    def __init__(self, size_classes = DEFAULT_SIZE_CLASSES, max_free = 64):
+        '''Creates a buffer pool.
+
+        Args:
+          size_classes: sizes (in bytes) of the slabs
+          max_free:     max number of free slabs kept per size class, extra
+                        slabs are dropped on release
+        '''
+
+        if not size_classes or min(size_classes) <= 0:
+            raise ValueError("size classes must be positive: {:s}".format(
+                repr(size_classes)))
+
+        self._size_classes = sorted(set(size_classes))
+        self._max_free = max_free
+        # mapping from size class to list of free slabs
+        self._free = dict((size, []) for size in self._size_classes)
+
+        self._hits = 0
+        self._misses = 0
+        self._oversize = 0
+        self._dropped = 0
+        self._leased = 0
+
+    def size_classes(self):
+        return tuple(self._size_classes)
+
+    def lease(self, size):
+        '''Returns a bytearray of at least `size' bytes.
+
+        The content of the returned slab is undefined.
+        '''
+
+        idx = bisect.bisect_left(self._size_classes, size)
+        self._leased += 1
+        if idx == len(self._size_classes):
+            self._oversize += 1
+            return bytearray(size)
+
+        slab_size = self._size_classes[idx]
+        free = self._free[slab_size]
+        if free:
+            self._hits += 1
+            return free.pop()
+        self._misses += 1
+        return bytearray(slab_size)
+
+    def release(self, buf):
+        '''Returns a slab leased by lease().
+
+        Args:
+          buf: the slab, or a memoryview of it (e.g. returned by
+               _SocketDispatcher.recv_pooled()), which is released
+
+        Raises:
+          BufferError if other memoryview objects of the slab are still alive,
+          since its content would be overwritten by the next lease.
+        '''
+
+        if isinstance(buf, memoryview):
+            slab = buf.obj
+            buf.release()
+        else:
+            slab = buf
+
+        free = self._free.get(len(slab))
+        if free is not None:
+            # resizing fails if the slab is still exported
+            slab.append(0)
+            del slab[-1]
+
+        self._leased -= 1
+        if free is None:
+            # oversize, or not leased from this pool
+            return
+        if len(free) >= self._max_free:
+            self._dropped += 1
+            return
+        free.append(slab)
+
+    def stats(self):
+        '''Returns a dict of statistics of this pool:
+
+          hits:     leases served by a free slab
+          misses:   leases which allocated a new slab
+          oversize: leases larger than the largest size class
+          dropped:  releases which did not keep the slab, the pool was full
+          leased:   slabs leased and not released yet
+          free:     mapping from size class to number of free slabs
+        '''
+
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'oversize': self._oversize,
+            'dropped': self._dropped,
+            'leased': self._leased,
+            'free': dict((size, len(free)) for (size, free) in self._free.items()),
+            }
+
+    def __str__(self):
+        return "<%s.%s at %s {hits:%d, misses:%d, oversize:%d, leased:%d}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            self._hits, self._misses, self._oversize, self._leased)
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import heapq
+import itertools
+import socket
+import time
+
+from .. import log as _log
+from . import _asyncevent
+from . import _error
+from . import _socket_dispatcher
+
+#------------------------------------------------------------------------------
+
+def _is_alive(sock):
+    '''Whether an idle connection may be reused: not closed by the peer, and
+    no data is pending (e.g. a response nobody read).'''
+
+    try:
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+        return True
+    except OSError:
+        return False
+    return False
+
+class _PoolConnector(_socket_dispatcher.TcpClientDispatcher):
+    '''Establishes a connection for the pool, then hands its socket over.'''
+
+    def __init__(self, on_done, log_handle = None):
+        _socket_dispatcher.TcpClientDispatcher.__init__(self, log_handle = log_handle)
+        self._on_done = on_done
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        # once a connection attempt won a race, see TcpClientDispatcher.connect()
+        return self.is_connected()
+
+    def timeout(self):
+        return None
+
+    def handle_write_event(self, call_user_func = True):
+        _socket_dispatcher.TcpClientDispatcher.handle_write_event(self, False)
+        if self.is_connected():
+            self._on_done(self, self.detach_socket(), None)
+
+    def handle_timeout(self):
+        self.handle_close()
+        self._on_done(self, None, TimeoutError("timed out connecting to {:s}".format(
+            self.peer_addr_repr())))
+
+    def handle_error(self, exception_obj):
+        self.log_info("failed connecting to {:s}: {:s}".format(
+            self.peer_addr_repr(), str(exception_obj)))
+        self.handle_close()
+        self._on_done(self, None, exception_obj)
+
+class _Slot(object):
+    '''Connections of one key.'''
+
+    __slots__ = ('idle', 'in_use', 'connecting', 'waiters', 'expires_at')
+
+    def __init__(self):
+        # 2-tuples of (sock, idle since), most recently used last
+        self.idle = collections.deque()
+        self.in_use = 0
+        self.connecting = set()
+        # 3-tuples of (callback, acquired at, deadline), in order of arrival
+        self.waiters = collections.deque()
+        # deadline of the current entry of this slot in the heap of the pool
+        self.expires_at = None
+
+    def total(self):
+        return len(self.idle) + self.in_use + len(self.connecting)
+
+class _PoolTimer(_asyncevent.ScheduledJob):
+    def __init__(self, pool, log_handle = None):
+        _asyncevent.ScheduledJob.__init__(self, log_handle = log_handle)
+        self._pool = pool
+
+    def schedule(self):
+        return self._pool._next_deadline()
+
+    def handle_job_event(self):
+        self._pool._expire(time.time())
+
+#------------------------------------------------------------------------------
+
+class ConnectionPool(_log.WrappedLogger):
+    '''Pool of outbound TCP connections, keyed by peer address.
+
+    acquire() passes a connected socket to its callback: an idle one of the
+    same key if available and still alive, otherwise a new one, connected by
+    a TcpClientDispatcher (so host names are resolved, and addresses raced,
+    without blocking). Once done, the caller gives it back by release(), or
+    closes it by discard(). If `max_total' connections of the key exist
+    already, the caller waits for one to be released.
+
+    Idle connections are closed once idle for `idle_timeout' seconds, but
+    `min_idle' of them are kept (and established in advance) per key seen.
+    Timers are driven by the AsyncEvent object, which must be the one used by
+    the callers; the pool is not thread-safe.
+
+    Usage:
+      >>> def on_connection(sock, error):
+      >>>     if error is None:
+      >>>         ae.register(MyStreamDispatcher(sock))
+      >>> pool.acquire(('backend.example', 8080), on_connection)
+      >>> ...
+      >>> # in MyStreamDispatcher, once the response was read
+      >>> pool.release(self.detach_socket())
+    '''
+
+    DEFAULT_MAX_TOTAL = 8
+    DEFAULT_IDLE_TIMEOUT = 30.0
+    DEFAULT_CONNECT_TIMEOUT = 10.0
+
+    def __init__(self, pollster, max_total = DEFAULT_MAX_TOTAL, min_idle = 0,
+                 idle_timeout = DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout = DEFAULT_CONNECT_TIMEOUT,
+                 acquire_timeout = None, profile = None, log_handle = None):
+        '''Creates a connection pool.
+
+        Args:
+          pollster:        the AsyncEvent object
+          max_total:       max number of connections per key, idle, in use or
+                           being established
+          min_idle:        number of idle connections kept per key
+          idle_timeout:    seconds an idle connection is kept, None for ever
+          connect_timeout: seconds to wait for a new connection
+          acquire_timeout: default seconds acquire() waits, None for ever
+          profile:         SocketProfile of new connections
+          log_handle:      a log handle to be used, None to disable logging
+        '''
+
+        _log.WrappedLogger.__init__(self, log_handle = log_handle)
+
+        if max_total <= 0:
+            raise ValueError("max_total must be positive: {:d}".format(max_total))
+        if not 0 <= min_idle <= max_total:
+            raise ValueError("min_idle must be between 0 and max_total: {:d}".format(min_idle))
+
+        self._pollster = pollster
+        self._max_total = max_total
+        self._min_idle = min_idle
+        self._idle_timeout = idle_timeout
+        self._connect_timeout = connect_timeout
+        self._acquire_timeout = acquire_timeout
+        self._profile = profile
+
+        # mapping from key to _Slot
+        self._slots = {}
+        # mapping from socket in use to its key
+        self._leased = {}
+        # mapping from _PoolConnector to key
+        self._connectors = {}
+        # heap of 3-tuples of (deadline, sequence number, key), one entry per
+        # slot is current, see _Slot.expires_at; others are skipped
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._timer = _PoolTimer(self, log_handle = log_handle)
+        # deadline the timer is armed for
+        self._armed = None
+        self._closed = False
+        self._stats = dict.fromkeys(('hits', 'misses', 'waits', 'timeouts',
+                                     'connects', 'connect_failures', 'dead',
+                                     'evictions', 'wait_time_total',
+                                     'wait_time_max'), 0)
+
+    def acquire(self, addr, callback, tls = None, timeout = None):
+        '''Gets a connection to `addr'.
+
+        Args:
+          addr:     2-tuple of (host, port), the host may be a name
+          callback: called as `callback(sock, error)' in the thread of the
+                    loop, never from within this method: with a connected
+                    socket owned by the caller (until given back) and None, or
+                    with None and the exception raised connecting, or
+                    TimeoutError
+          tls:      hashable TLS parameters (e.g. the server name) of the
+                    connection, part of the key, so connections set up with
+                    different parameters are never mixed up
+          timeout:  seconds to wait, acquire_timeout of the pool if None
+        '''
+
+        if self._closed:
+            raise _error.AeError("connection pool closed")
+
+        key = (addr[0], addr[1], tls)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+
+        sock = self.__take_idle(slot)
+        if sock is not None:
+            self._stats['hits'] += 1
+            self.__lease(key, slot, sock, callback)
+        else:
+            self._stats['misses'] += 1
+            if slot.total() >= self._max_total:
+                self._stats['waits'] += 1
+            if timeout is None:
+                timeout = self._acquire_timeout
+            now = time.time()
+            deadline = timeout and now + timeout or None
+            slot.waiters.append((callback, now, deadline))
+            if deadline:
+                self.__watch(key, slot, deadline)
+        self.__dispatch(key, slot, top_up = True)
+
+    def release(self, sock, reusable = True):
+        '''Gives back a connection obtained by acquire().
+
+        Args:
+          sock:     the socket, see also Dispatcher.detach_socket()
+          reusable: False to close the connection, e.g. if the protocol state
+                    is unknown after an error
+        '''
+
+        try:
+            key = self._leased.pop(sock)
+        except KeyError:
+            raise ValueError("{:s} was not acquired from this pool".format(repr(sock)))
+        slot = self._slots[key]
+        slot.in_use -= 1
+
+        closed = not reusable or self._closed or sock.fileno() < 0
+        if closed:
+            sock.close()
+        elif slot.waiters:
+            self.__serve_waiter(key, slot, sock)
+        else:
+            self.__add_idle(key, slot, sock)
+        # replaces the connection closed, if needed for min_idle
+        self.__dispatch(key, slot, top_up = closed)
+
+    def discard(self, sock):
+        '''Closes a connection obtained by acquire(), instead of reusing it.'''
+
+        self.release(sock, reusable = False)
+
+    def close(self):
+        '''Closes idle connections and those being established, waiters are
+        called with an error; connections in use are closed when released.'''
+
+        self._closed = True
+        error = _error.AeError("connection pool closed")
+        for connector in list(self._connectors):
+            connector.handle_close()
+        self._connectors.clear()
+        for slot in self._slots.values():
+            slot.connecting.clear()
+            while slot.idle:
+                slot.idle.popleft()[0].close()
+            while slot.waiters:
+                callback = slot.waiters.popleft()[0]
+                self._pollster.call_soon_threadsafe(callback, None, error)
+        # cancels the timer
+        self._deadlines = []
+        self._pollster.add_scheduled_job(self._timer)
+
+    def stats(self):
+        '''Returns a dict of statistics:
+
+          hits:             acquisitions served by an idle connection
+          misses:           acquisitions which waited for a new or released
+                            connection
+          waits:            misses while max_total connections existed
+          timeouts:         acquisitions which timed out
+          connects:         connections established
+          connect_failures: connections which failed
+          dead:             idle connections found closed (or with data
+                            pending) before reuse
+          evictions:        idle connections closed after idle_timeout
+          wait_time_total:  seconds misses waited, in total
+          wait_time_max:    seconds the longest miss waited
+          idle:             idle connections
+          in_use:           connections acquired, not released yet
+          connecting:       connections being established
+          waiters:          acquisitions waiting
+        '''
+
+        result = dict(self._stats)
+        result['idle'] = sum(len(slot.idle) for slot in self._slots.values())
+        result['in_use'] = len(self._leased)
+        result['connecting'] = len(self._connectors)
+        result['waiters'] = sum(len(slot.waiters) for slot in self._slots.values())
+        return result
+
+    def __str__(self):
+        return "<%s.%s at %s {keys:%d, max_total:%d, min_idle:%d, idle_timeout:%s}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            len(self._slots), self._max_total, self._min_idle, str(self._idle_timeout))
+
+    def __take_idle(self, slot):
+        # most recently used first, its peer is the least likely to have
+        # closed it
+        while slot.idle:
+            sock, unused_since = slot.idle.pop()
+            if _is_alive(sock):
+                return sock
+            self._stats['dead'] += 1
+            self.log_info("closing dead idle connection, fd {:d}".format(sock.fileno()))
+            sock.close()
+        return None
+
+    def __lease(self, key, slot, sock, callback):
+        slot.in_use += 1
+        self._leased[sock] = key
+        self._pollster.call_soon_threadsafe(callback, sock, None)
+
+    def __serve_waiter(self, key, slot, sock):
+        callback, acquired_at, unused_deadline = slot.waiters.popleft()
+        waited = time.time() - acquired_at
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        self.__lease(key, slot, sock, callback)
+
+    def __dispatch(self, key, slot, top_up = False):
+        '''Serves waiters by idle connections, and starts new connections for
+        the others; if `top_up' is True, also for min_idle.'''
+
+        while slot.waiters and slot.idle:
+            sock = self.__take_idle(slot)
+            if sock is None:
+                break
+            self.__serve_waiter(key, slot, sock)
+
+        wanted = len(slot.waiters)
+        if top_up:
+            wanted += max(0, self._min_idle - len(slot.idle))
+        while len(slot.connecting) < wanted and slot.total() < self._max_total \
+        and not self._closed:
+            self.__connect(key, slot)
+
+    def __connect(self, key, slot):
+        connector = _PoolConnector(self.__connected, log_handle = self.get_log_handle())
+        connector.initialize(profile = self._profile)
+        slot.connecting.add(connector)
+        self._connectors[connector] = key
+        self._pollster.register(connector)
+        try:
+            connector.connect(key[:2], self._connect_timeout)
+        except socket.error as e:
+            # e.g. ENETUNREACH, calls __connected()
+            connector.handle_error(e)
+
+    def __connected(self, connector, sock, error):
+        key = self._connectors.pop(connector, None)
+        if key is None:
+            # closed by close()
+            if sock is not None:
+                sock.close()
+            return
+        slot = self._slots[key]
+        slot.connecting.discard(connector)
+
+        if error is not None:
+            self._stats['connect_failures'] += 1
+            if slot.waiters:
+                callback = slot.waiters.popleft()[0]
+                self._pollster.call_soon_threadsafe(callback, None, error)
+        else:
+            self._stats['connects'] += 1
+            if slot.waiters:
+                self.__serve_waiter(key, slot, sock)
+            else:
+                self.__add_idle(key, slot, sock)
+        # no top up after a failure, don't retry in a busy loop
+        self.__dispatch(key, slot, top_up = error is None)
+
+    def __add_idle(self, key, slot, sock):
+        slot.idle.append((sock, time.time()))
+        if self._idle_timeout and len(slot.idle) > self._min_idle:
+            self.__watch(key, slot, slot.idle[0][1] + self._idle_timeout)
+
+    def __watch(self, key, slot, deadline):
+        '''Makes sure _expire() is called for `slot' by `deadline'.
+
+        An entry of the slot due earlier covers it: once expired, the next
+        deadline of the slot is watched. Entries are not removed once what
+        they watch is gone, the timer fires for nothing instead.
+        '''
+
+        if slot.expires_at is not None and slot.expires_at <= deadline:
+            return
+        slot.expires_at = deadline
+        heapq.heappush(self._deadlines, (deadline, next(self._sequence), key))
+        if self._armed is None or deadline < self._armed:
+            self._pollster.add_scheduled_job(self._timer)
+
+    def _next_deadline(self):
+        '''Nearest deadline watched, None if none.'''
+
+        self._armed = self._deadlines and self._deadlines[0][0] or None
+        return self._armed
+
+    def _expire(self, now):
+        '''Closes idle connections expired, and times out waiters, of slots
+        whose deadlines are due.'''
+
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, unused_seq, key = heapq.heappop(deadlines)
+            slot = self._slots.get(key)
+            if slot is None or slot.expires_at != deadline:
+                # the slot is gone, or watched by an earlier entry
+                continue
+            slot.expires_at = None
+            self.__expire_slot(key, slot, now)
+
+    def __expire_slot(self, key, slot, now):
+        if self._idle_timeout:
+            while len(slot.idle) > self._min_idle \
+            and slot.idle[0][1] + self._idle_timeout <= now:
+                sock = slot.idle.popleft()[0]
+                self._stats['evictions'] += 1
+                self.log_info("closing idle connection, fd {:d}".format(sock.fileno()))
+                sock.close()
+
+        expired = [waiter for waiter in slot.waiters
+                   if waiter[2] and waiter[2] <= now]
+        for waiter in expired:
+            slot.waiters.remove(waiter)
+            self._stats['timeouts'] += 1
+            self._pollster.call_soon_threadsafe(waiter[0], None, TimeoutError(
+                "timed out waiting for a connection to {:s}:{:d}".format(
+                    str(key[0]), key[1])))
+
+        if not (slot.idle or slot.in_use or slot.connecting or slot.waiters):
+            del self._slots[key]
+            return
+        deadlines = [waiter[2] for waiter in slot.waiters if waiter[2]]
+        if self._idle_timeout and len(slot.idle) > self._min_idle:
+            deadlines.append(slot.idle[0][1] + self._idle_timeout)
+        if deadlines:
+            self.__watch(key, slot, min(deadlines))
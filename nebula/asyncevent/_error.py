@@ -23,6 +23,7 @@ __all__ = [
            "AeExitNow",
            "AeAlreadyAttachedError",
            "AeNotAttachedError",
+           "AeFrameError",
            ]
 
 class AeError(Exception):
@@ -36,3 +37,6 @@ class AeAlreadyAttachedError(AeError):
 
 class AeNotAttachedError(AeError):
     pass
+
+class AeFrameError(AeError):
+    pass
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Incremental frame decoders and encoders for stream dispatchers.
+
+A decoder is fed with all received but not yet consumed data, e.g. the
+memoryview passed to BufferedStreamDispatcher.on_data(); decode() returns a
+2-tuple of (frames, consumed), where frames is a list of memoryview slices of
+the data (no copy is made), and consumed is the number of bytes used by these
+frames. Bytes not consumed must be passed again, followed by newly received
+data, to the next call of decode().
+
+An encoder turns a payload into a list of buffers, suitable for
+BufferedStreamDispatcher.writelines(); the payload itself is not copied.
+'''
+
+import re
+import struct
+
+from . import _error
+from . import _stream_dispatcher
+
+#------------------------------------------------------------------------------
+
+class LengthPrefixedDecoder(object):
+    '''Frames preceded by an unsigned integer header holding their length.'''
+
+    def __init__(self, header_size = 4, byteorder = 'big',
+                 max_frame_size = 16 * 1024 * 1024):
+        '''Creates a decoder.
+
+        Args:
+          header_size:    size of the length header, one of 1, 2, 4 and 8
+          byteorder:      byte order of the length header, 'big' or 'little'
+          max_frame_size: frames longer than this raise AeFrameError
+        '''
+
+        self._header = _length_header(header_size, byteorder)
+        self._max_frame_size = max_frame_size
+
+    def reset(self):
+        pass
+
+    def decode(self, data):
+        header = self._header
+        header_size = header.size
+        end = len(data)
+        offset = 0
+        frames = []
+        while end - offset >= header_size:
+            length = header.unpack_from(data, offset)[0]
+            if length > self._max_frame_size:
+                raise _error.AeFrameError("frame too long: {:d} > {:d}".format(
+                    length, self._max_frame_size))
+            stop = offset + header_size + length
+            if stop > end:
+                break
+            frames.append(data[offset + header_size:stop])
+            offset = stop
+        return frames, offset
+
+class DelimiterDecoder(object):
+    '''Frames terminated by a delimiter, which is not part of the frames.
+
+    Scanning resumes where the previous call of decode() stopped, so a frame
+    arriving in many small segments is scanned only once.
+    '''
+
+    CRLF = b'\r\n'
+    LF = b'\n'
+
+    def __init__(self, delimiter = CRLF, max_frame_size = 65536):
+        '''Creates a decoder.
+
+        Args:
+          delimiter:      (bytes) terminator of frames
+          max_frame_size: frames longer than this (excluding the delimiter)
+                          raise AeFrameError
+        '''
+
+        if not delimiter:
+            raise ValueError("delimiter must not be empty")
+        self._delimiter = bytes(delimiter)
+        self._pattern = re.compile(re.escape(self._delimiter))
+        self._max_frame_size = max_frame_size
+        # offset, relative to the first byte not consumed, where next scan
+        # starts from
+        self._scan_from = 0
+
+    def reset(self):
+        '''Forgets the scan position, e.g. after unconsumed data was dropped.'''
+
+        self._scan_from = 0
+
+    def decode(self, data):
+        search = self._pattern.search
+        delimiter_size = len(self._delimiter)
+        end = len(data)
+        offset = 0
+        frames = []
+        pos = self._scan_from
+        while True:
+            match = search(data, pos)
+            if match is None:
+                break
+            start = match.start()
+            if start - offset > self._max_frame_size:
+                break
+            frames.append(data[offset:start])
+            offset = pos = start + delimiter_size
+
+        if end - offset > self._max_frame_size + delimiter_size - 1:
+            raise _error.AeFrameError("frame too long: {:d} > {:d}".format(
+                end - offset, self._max_frame_size))
+        # a delimiter might be split between this and the next call
+        self._scan_from = max(0, end - offset - delimiter_size + 1)
+        return frames, offset
+
+class FixedSizeDecoder(object):
+    '''Frames of the same size.'''
+
+    def __init__(self, frame_size):
+        if frame_size <= 0:
+            raise ValueError("frame size must be positive: {:d}".format(frame_size))
+        self._frame_size = frame_size
+
+    def reset(self):
+        pass
+
+    def decode(self, data):
+        size = self._frame_size
+        count = len(data) // size
+        return [data[idx * size:(idx + 1) * size] for idx in range(count)], count * size
+
+#------------------------------------------------------------------------------
+
+class LengthPrefixedEncoder(object):
+    '''Encoder matching LengthPrefixedDecoder.'''
+
+    def __init__(self, header_size = 4, byteorder = 'big'):
+        self._header = _length_header(header_size, byteorder)
+        self._max_length = (1 << (8 * header_size)) - 1
+
+    def encode(self, payload):
+        length = len(memoryview(payload).cast('B'))
+        if length > self._max_length:
+            raise _error.AeFrameError("frame too long: {:d} > {:d}".format(
+                length, self._max_length))
+        return [self._header.pack(length), payload]
+
+class DelimiterEncoder(object):
+    '''Encoder matching DelimiterDecoder, the payload must not contain the
+    delimiter (which is not checked).'''
+
+    def __init__(self, delimiter = DelimiterDecoder.CRLF):
+        self._delimiter = bytes(delimiter)
+
+    def encode(self, payload):
+        return [payload, self._delimiter]
+
+class FixedSizeEncoder(object):
+    '''Encoder matching FixedSizeDecoder.'''
+
+    def __init__(self, frame_size):
+        self._frame_size = frame_size
+
+    def encode(self, payload):
+        length = len(memoryview(payload).cast('B'))
+        if length != self._frame_size:
+            raise _error.AeFrameError("frame size {:d} != {:d}".format(
+                length, self._frame_size))
+        return [payload]
+
+def _length_header(header_size, byteorder):
+    try:
+        code = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[header_size]
+    except KeyError:
+        raise ValueError("header size must be 1, 2, 4 or 8: {:s}".format(repr(header_size)))
+    try:
+        order = {'big': '>', 'little': '<'}[byteorder]
+    except KeyError:
+        raise ValueError("byte order must be 'big' or 'little': {:s}".format(repr(byteorder)))
+    return struct.Struct(order + code)
+
+#------------------------------------------------------------------------------
+
+class FramedStreamDispatcher(_stream_dispatcher.BufferedStreamDispatcher):
+    '''Buffered stream dispatcher exchanging frames.
+
+    Usage:
+      Derive from this class, override on_frame(), and call send_frame() to
+      send a frame. A framing error raises AeFrameError, which is handled by
+      handle_error(), i.e. the connection is closed.
+    '''
+
+    def __init__(self, decoder, encoder, sock = None, log_handle = None,
+                 read_size = None):
+        _stream_dispatcher.BufferedStreamDispatcher.__init__(self, sock = sock,
+                                                             log_handle = log_handle,
+                                                             read_size = read_size)
+        self._decoder = decoder
+        self._encoder = encoder
+
+    def send_frame(self, payload):
+        '''Queues a frame, the payload is not copied.'''
+
+        self.writelines(self._encoder.encode(payload))
+
+    def on_data(self, data):
+        frames, consumed = self._decoder.decode(data)
+        for frame in frames:
+            self.on_frame(frame)
+            if not self.pollster(False):
+                # closed by on_frame()
+                break
+        return consumed
+
+    def on_frame(self, frame):
+        '''Called for each frame received.
+
+        Args:
+          frame: memoryview of the frame, only valid during this call
+        '''
+
+        self.log_notice("{:s}.{:s}: using default on_frame()".format(
+            self.__class__.__module__, self.__class__.__name__))
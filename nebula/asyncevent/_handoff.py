@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Handing off accepted connections to the least loaded worker process.
+
+A front process accepts connections with HandoffServerDispatcher, and passes
+each of them to a worker over an AF_UNIX stream socket (one per worker, e.g.
+created by socket.socketpair() before forking). Each worker runs its own
+AsyncEvent object with a HandoffWorkerDispatcher, which receives the
+connections and reports its load back to the front process:
+
+  front -> worker: one byte per connection, carrying its descriptor
+  worker -> front: 16 bytes, number of connections received so far and the
+                   current load, both 64-bit unsigned big-endian integers
+
+Unlike SO_REUSEPORT hashing, a connection goes to the worker with the lowest
+load, counting connections handed off but not yet reported by the worker.
+'''
+
+import socket
+import struct
+import time
+
+from . import _socket_dispatcher
+from . import _unix_dispatcher
+
+#------------------------------------------------------------------------------
+
+_HANDOFF_MARKER = b'C'
+_LOAD_REPORT = struct.Struct('>QQ')
+
+class _WorkerChannel(_unix_dispatcher.UnixStreamDispatcher):
+    '''Front side of the connection to a worker.'''
+
+    def __init__(self, server, sock, log_handle = None):
+        _unix_dispatcher.UnixStreamDispatcher.__init__(self, sock = sock,
+                                                       log_handle = log_handle)
+        self._server = server
+        self._handed_off = 0
+        self._acknowledged = 0
+        self._reported_load = 0
+
+    def load(self):
+        '''Last load reported by the worker, plus connections handed off
+        since then.'''
+
+        return self._reported_load + self._handed_off - self._acknowledged
+
+    def handed_off(self):
+        return self._handed_off
+
+    def hand_off(self, conn_sock):
+        self._handed_off += 1
+        self.send_fds(_HANDOFF_MARKER, [conn_sock], close_fds = True)
+
+    def on_data(self, data):
+        size = _LOAD_REPORT.size
+        count = len(data) // size
+        if count:
+            # only the latest report matters
+            self._acknowledged, self._reported_load = _LOAD_REPORT.unpack_from(
+                data, (count - 1) * size)
+        return count * size
+
+    def handle_close(self):
+        _unix_dispatcher.UnixStreamDispatcher.handle_close(self)
+        if self._server is not None:
+            server, self._server = self._server, None
+            server._remove_worker(self)
+
+class HandoffServerDispatcher(_socket_dispatcher.TcpServerDispatcher):
+    '''Server dispatcher passing accepted connections to worker processes.
+
+    Usage:
+      Create one AF_UNIX stream socket pair per worker, register the server,
+      and call add_worker() with the front end of each pair. Connections are
+      closed (in the front process) once handed off; if there's no worker,
+      they are closed without being served.
+    '''
+
+    def __init__(self, sock = None, log_handle = None):
+        _socket_dispatcher.TcpServerDispatcher.__init__(self, sock = sock,
+                                                        log_handle = log_handle)
+        self._workers = []
+
+    def add_worker(self, sock):
+        '''Adds a worker, the server must be registered already.
+
+        Args:
+          sock: connected AF_UNIX stream socket, the other end of which is
+                used by the HandoffWorkerDispatcher of the worker
+
+        Returns:
+          The dispatcher of the channel to the worker, which is closed (and
+          removed) once the worker has gone away.
+        '''
+
+        channel = _WorkerChannel(self, sock, log_handle = self.get_log_handle())
+        self.pollster().register(channel)
+        self._workers.append(channel)
+        return channel
+
+    def workers(self):
+        return list(self._workers)
+
+    def _remove_worker(self, channel):
+        try:
+            self._workers.remove(channel)
+        except ValueError:
+            return
+        self.log_notice("worker channel closed, fd {:d}, {:d} workers left".format(
+            channel.fileno(), len(self._workers)))
+
+    def pick_worker(self):
+        '''Returns the channel of the worker to hand off the next connection
+        to, None if there is no worker. Picks the least loaded one by
+        default.'''
+
+        if not self._workers:
+            return None
+        return min(self._workers, key = lambda channel: channel.load())
+
+    def prepare_serving_clients(self, new_clients):
+        for conn_sock, conn_addr in new_clients:
+            channel = self.pick_worker()
+            if channel is None:
+                self.log_warning("no worker, closing connection, fd {:d}, peer address {:s}".format(
+                    conn_sock.fileno(), str(conn_addr)))
+                conn_sock.close()
+                continue
+            channel.hand_off(conn_sock)
+
+    def handle_close(self):
+        _socket_dispatcher.TcpServerDispatcher.handle_close(self)
+        # workers see the end of file, and may shut down
+        for channel in list(self._workers):
+            channel.close_when_done()
+
+#------------------------------------------------------------------------------
+
+class HandoffWorkerDispatcher(_unix_dispatcher.UnixStreamDispatcher):
+    '''Worker side of the channel to a HandoffServerDispatcher.
+
+    Usage:
+      Derive from this class, and override serve_connection() to register a
+      dispatcher for each connection received. The load is reported after
+      each batch of connections received, and every report_interval seconds.
+      By default the load is the number of other dispatchers registered,
+      override load() to report something else.
+    '''
+
+    DEFAULT_REPORT_INTERVAL = 1.0
+
+    def __init__(self, sock = None, log_handle = None,
+                 report_interval = DEFAULT_REPORT_INTERVAL):
+        _unix_dispatcher.UnixStreamDispatcher.__init__(self, sock = sock,
+                                                       log_handle = log_handle)
+        self._report_interval = report_interval
+        self._received = 0
+        self._reported = None
+        # first report as soon as the loop runs
+        self.set_deadline(time.time())
+
+    def received(self):
+        '''Number of connections received so far.'''
+
+        return self._received
+
+    def load(self):
+        return self.pollster().num_of_dispatchers() - 1
+
+    def report_load(self):
+        self._reported = self._received
+        self.write(_LOAD_REPORT.pack(self._received, max(0, self.load())))
+
+    def on_fds(self, fds):
+        for fd in fds:
+            self._received += 1
+            self.serve_connection(socket.socket(fileno = fd))
+
+    def on_data(self, data):
+        # markers of connections, already served by on_fds()
+        if self._reported != self._received:
+            self.report_load()
+        return None
+
+    def handle_timeout(self):
+        self.report_load()
+        if self._report_interval:
+            self.set_deadline(time.time() + self._report_interval)
+
+    def serve_connection(self, conn_sock):
+        '''Called for each connection received.'''
+
+        self.log_notice("{:s}.{:s}: using default serve_connection()".format(
+            self.__class__.__module__, self.__class__.__name__))
+        self.log_info("closing connection received without serving, fd {:d}".format(
+            conn_sock.fileno()))
+        conn_sock.close()
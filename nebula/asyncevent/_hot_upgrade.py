@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Restarting a server without closing its listening sockets.
+
+The running process spawns its successor (by default the same command line),
+passing the listening sockets as inherited file descriptors, listed by an
+environment variable:
+
+  NEBULA_LISTEN_FDS: comma separated descriptors of listening sockets
+  NEBULA_READY_FD:   descriptor of an AF_UNIX stream socket, to which the
+                     successor writes one byte once it's ready to serve
+
+The successor creates its server dispatchers from the inherited sockets, so
+pending connections are accepted by whichever process gets to them first, and
+no connection is refused meanwhile. Once the successor is ready, the old
+process stops accepting, waits for its connections to finish (for at most
+`drain_timeout' seconds), and its loop returns. If the successor exits, or is
+not ready in time, the upgrade is abandoned, and the old process goes on
+serving.
+'''
+
+import ipaddress
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from .. import log as _log
+from . import _asyncevent
+from . import _socket_dispatcher
+from . import _unix_dispatcher
+
+#------------------------------------------------------------------------------
+
+def _ip_address(host):
+    # without the scope of a link-local IPv6 address
+    return ipaddress.ip_address(host.split('%', 1)[0])
+
+def _local_addresses(family, host):
+    '''Returns the set of addresses a socket of `family' is bound to, if bound
+    to `host' (as passed to bind(), e.g. '' or a host name).'''
+
+    if not host:
+        return {_ip_address(family == socket.AF_INET6 and '::' or '0.0.0.0')}
+    try:
+        return {_ip_address(host)}
+    except ValueError:
+        pass
+    try:
+        infos = socket.getaddrinfo(host, None, family, socket.SOCK_STREAM, 0,
+                                   socket.AI_PASSIVE)
+    except socket.gaierror:
+        return set()
+    return {_ip_address(info[4][0]) for info in infos}
+
+#------------------------------------------------------------------------------
+
+ENV_LISTEN_FDS = 'NEBULA_LISTEN_FDS'
+ENV_READY_FD = 'NEBULA_READY_FD'
+
+_READY_MARKER = b'R'
+
+class _SuccessorChannel(_unix_dispatcher.UnixStreamDispatcher):
+    '''Old process' end of the socket the successor reports readiness on.'''
+
+    def __init__(self, upgrade, ae, sock, deadline, log_handle = None):
+        _unix_dispatcher.UnixStreamDispatcher.__init__(self, sock = sock,
+                                                       log_handle = log_handle)
+        self._upgrade = upgrade
+        self._ae = ae
+        self.set_deadline(deadline)
+
+    def on_data(self, data):
+        if _READY_MARKER in bytes(data):
+            self.handle_close()
+            self._upgrade._handover(self._ae)
+        return None
+
+    def on_eof(self):
+        self.handle_close()
+        self._upgrade._abandon(self._ae, "successor exited before it was ready")
+
+    def handle_timeout(self):
+        self.handle_close()
+        self._upgrade._abandon(self._ae, "successor was not ready in time")
+
+class _ReapJob(_asyncevent.ScheduledJob):
+    '''Polls a child process until it's reaped, without blocking the loop.'''
+
+    def __init__(self, popen, interval = 0.1, log_handle = None):
+        _asyncevent.ScheduledJob.__init__(self, log_handle = log_handle)
+        self._popen = popen
+        self._interval = interval
+
+    def schedule(self):
+        if self._popen.poll() is not None:
+            return None
+        return time.time() + self._interval
+
+    def handle_job_event(self):
+        # see schedule()
+        pass
+
+#------------------------------------------------------------------------------
+
+class HotUpgrade(_log.WrappedLogger):
+    '''Hands the listening sockets of a process over to its successor.
+
+    Usage:
+      >>> upgrade = HotUpgrade(drain_timeout = 30.0)
+      >>> server = upgrade.create_server(MyServerDispatcher, ('', 8080))
+      >>> ae.register(server)
+      >>> upgrade.install(ae)     # SIGUSR2 starts the successor
+      >>> upgrade.ready()         # tells the predecessor (if any) to leave
+      >>> ae.loop()
+
+    The same code runs in both processes: create_server() uses an inherited
+    socket if there's one bound to the address, otherwise it binds a new one.
+    '''
+
+    DEFAULT_READY_TIMEOUT = 30.0
+    DEFAULT_DRAIN_TIMEOUT = 10.0
+
+    def __init__(self, argv = None, ready_timeout = DEFAULT_READY_TIMEOUT,
+                 drain_timeout = DEFAULT_DRAIN_TIMEOUT, log_handle = None):
+        '''Creates the upgrade helper, takes over sockets inherited from a
+        predecessor; the environment variables are removed, so they're not
+        passed on to other processes spawned.
+
+        Args:
+          argv:          command line of the successor, defaults to the one
+                         of this process
+          ready_timeout: seconds the successor may take to call ready()
+          drain_timeout: seconds connections may take to finish, once the
+                         successor took over
+          log_handle:    a log handle to be used, None to disable logging
+        '''
+
+        _log.WrappedLogger.__init__(self, log_handle = log_handle)
+        self._argv = argv or [sys.executable] + sys.argv
+        self._ready_timeout = ready_timeout
+        self._drain_timeout = drain_timeout
+
+        # server dispatchers created by create_server()
+        self._servers = []
+        self._successor = None
+        self._draining = False
+
+        fds = os.environ.pop(ENV_LISTEN_FDS, None)
+        ready_fd = os.environ.pop(ENV_READY_FD, None)
+        self._predecessor = fds is not None or ready_fd is not None
+        self._inherited = []
+        for fd in fds and fds.split(',') or ():
+            sock = self.__adopt(int(fd))
+            if sock is not None:
+                self._inherited.append(sock)
+        self._ready_sock = None
+        if ready_fd is not None:
+            os.set_inheritable(int(ready_fd), False)
+            self._ready_sock = socket.socket(fileno = int(ready_fd))
+
+    def __adopt(self, fd):
+        os.set_inheritable(fd, False)
+        try:
+            sock = socket.socket(fileno = fd)
+        except OSError as why:
+            self.log_warning("inherited fd {:d} is not a socket: {:s}".format(fd, str(why)))
+            return None
+        if sock.type != socket.SOCK_STREAM \
+        or not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN):
+            self.log_warning("inherited fd {:d} is not a listening socket, closing it".format(fd))
+            sock.close()
+            return None
+        self.log_info("inherited listening socket, fd {:d}, local address {:s}".format(
+            fd, str(sock.getsockname())))
+        return sock
+
+    def has_predecessor(self):
+        '''Whether this process was started by upgrade().'''
+
+        return self._predecessor
+
+    def is_upgrading(self):
+        '''Whether a successor was started, and is not ready yet.'''
+
+        return self._successor is not None and not self._draining
+
+    def is_draining(self):
+        '''Whether the successor took over.'''
+
+        return self._draining
+
+    def servers(self):
+        return list(self._servers)
+
+    def listening_socket(self, local_addr):
+        '''Returns the inherited listening socket bound to `local_addr', and
+        no longer offers it; None if there's none.
+
+        Addresses are compared as bind() sees them: '' matches the wildcard
+        address of IPv4 ('0.0.0.0'), a host name matches addresses it resolves
+        to, of either family. A port number of 0 matches any port of the same
+        host.
+        '''
+
+        host, port = local_addr[0], local_addr[1]
+        if not host:
+            families = (_socket_dispatcher._address_family(local_addr),)
+        else:
+            try:
+                version = _ip_address(host).version
+                families = (socket.AF_INET6 if version == 6 else socket.AF_INET,)
+            except ValueError:
+                # a host name, of either family
+                families = (socket.AF_INET, socket.AF_INET6)
+        for sock in self._inherited:
+            if sock.family not in families:
+                continue
+            bound = sock.getsockname()
+            if port in (0, bound[1]) \
+            and _ip_address(bound[0]) in _local_addresses(sock.family, host):
+                self._inherited.remove(sock)
+                return sock
+        return None
+
+    def create_server(self, server_factory, local_addr, **kwargs):
+        '''Creates a server dispatcher, using the inherited socket bound to
+        `local_addr' if there is one.
+
+        Args:
+          server_factory: callable with the signature of the constructor of
+                          TcpServerDispatcher, e.g. a subclass of it
+          local_addr:     local address to listen on
+          kwargs:         passed to initialize() of the new server; of an
+                          inherited socket, only `profile' is used, for
+                          connections accepted
+
+        Returns:
+          The server dispatcher, not registered yet.
+        '''
+
+        sock = self.listening_socket(local_addr)
+        if sock is not None:
+            server = server_factory(sock = sock, log_handle = self.get_log_handle())
+            if kwargs.get('profile') is not None:
+                server.set_socket_profile(kwargs['profile'])
+        else:
+            server = server_factory(log_handle = self.get_log_handle())
+            server.initialize(local_addr, **kwargs)
+        self._servers.append(server)
+        return server
+
+    def ready(self):
+        '''Tells the predecessor (if any) to stop accepting, and closes
+        inherited sockets no server was created for. Call it once all
+        servers are registered, and the process is warmed up.'''
+
+        for sock in self._inherited:
+            self.log_notice("closing unused inherited socket, local address {:s}".format(
+                str(sock.getsockname())))
+            sock.close()
+        self._inherited = []
+
+        if self._ready_sock is not None:
+            sock, self._ready_sock = self._ready_sock, None
+            try:
+                sock.sendall(_READY_MARKER)
+            except OSError as why:
+                self.log_warning("failed notifying predecessor: {:s}".format(str(why)))
+            finally:
+                sock.close()
+
+    def install(self, ae, signum = signal.SIGUSR2):
+        '''Starts the successor upon signal `signum', from within the loop.'''
+
+        def on_signal(unused_signum, unused_frame):
+            # do the real work in the loop, not in the signal handler
+            ae.call_soon_threadsafe(self.upgrade, ae)
+
+        signal.signal(signum, on_signal)
+
+    def upgrade(self, ae):
+        '''Starts the successor, passing it the listening sockets of servers
+        registered with `ae'.
+
+        Returns:
+          True if the successor was started.
+        '''
+
+        if self._successor is not None:
+            self.log_notice("upgrade in progress already, ignored")
+            return False
+
+        socks = [server._sock for server in self._servers if server.pollster(False)]
+        if not socks:
+            self.log_warning("no listening socket to hand over, upgrade ignored")
+            return False
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        fds = [sock.fileno() for sock in socks]
+        env = dict(os.environ)
+        env[ENV_LISTEN_FDS] = ",".join(str(fd) for fd in fds)
+        env[ENV_READY_FD] = str(child_end.fileno())
+        try:
+            self._successor = subprocess.Popen(self._argv, env = env,
+                                               pass_fds = fds + [child_end.fileno()])
+        except OSError as why:
+            self.log_err("failed starting successor {:s}: {:s}".format(
+                str(self._argv), str(why)))
+            parent_end.close()
+            return False
+        finally:
+            child_end.close()
+
+        self.log_notice("successor started, pid {:d}, listening fds {:s}".format(
+            self._successor.pid, env[ENV_LISTEN_FDS]))
+        ae.register(_SuccessorChannel(self, ae, parent_end,
+                                      time.time() + self._ready_timeout,
+                                      log_handle = self.get_log_handle()))
+        return True
+
+    def _handover(self, ae):
+        '''The successor is ready: stops accepting, and drains.'''
+
+        self.log_notice("successor is ready, pid {:d}, stops accepting".format(
+            self._successor.pid))
+        self._draining = True
+        for server in self._servers:
+            if server.pollster(False):
+                # the successor keeps the socket open
+                server.handle_close()
+        ae.add_scheduled_job(_asyncevent.DrainJob(ae, time.time() + self._drain_timeout,
+                                                  log_handle = self.get_log_handle()))
+
+    def _abandon(self, ae, reason):
+        successor, self._successor = self._successor, None
+        self.log_err("upgrade abandoned, pid {:d}: {:s}".format(successor.pid, reason))
+        if successor.poll() is None:
+            successor.kill()
+            # reaped once it's gone, which might take a while, e.g. if it's
+            # in uninterruptible sleep
+            ae.add_scheduled_job(_ReapJob(successor, log_handle = self.get_log_handle()))
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import fcntl
+import os
+import signal
+import subprocess
+
+from . import _asyncevent
+from . import _stream_dispatcher
+
+#------------------------------------------------------------------------------
+
+# None if pidfds are not supported, see SubprocessDispatcher
+_pidfd_open = getattr(os, 'pidfd_open', None)
+
+class PipeDispatcher(_stream_dispatcher._BufferedStreamMixin, _asyncevent.Dispatcher):
+    '''Buffered dispatcher of a pipe, or another non-socket stream (e.g. a
+    FIFO, or a tty).
+
+    Works like BufferedStreamDispatcher: write() queues data, which is written
+    with os.writev(); data read is passed to on_data(). The read end of a pipe
+    is only read, the write end only written to.
+    '''
+
+    def __init__(self, fd, log_handle = None, read_size = None):
+        '''Creates a pipe dispatcher, owning `fd', which is closed by close().
+
+        Args:
+          fd:         file descriptor, set to non-blocking mode
+          log_handle: a log handle to be used, None to disable logging
+          read_size:  see BufferedStreamDispatcher
+        '''
+
+        _asyncevent.Dispatcher.__init__(self, log_handle = log_handle)
+        self._fd = fd
+        os.set_blocking(fd, False)
+        mode = fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_ACCMODE
+        self._read_end = mode != os.O_WRONLY
+        self._write_end = mode != os.O_RDONLY
+        self._init_buffers(read_size)
+        self.want_read(self._read_end)
+
+    def __str__(self):
+        return "<%s.%s at %s {fd:%d, read:%d, write:%d}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            self._fd, self._read_end, self._write_end)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _write_buffers(self, buffers):
+        return os.writev(self._fd, buffers)
+
+    def _read_into(self, view):
+        return os.readv(self._fd, [view])
+
+    def handle_hup_event(self):
+        if self._read_end:
+            _stream_dispatcher._BufferedStreamMixin.handle_hup_event(self)
+        else:
+            # the read end was closed, nothing can be written any more
+            self.log_info("fd {:d}, read end of pipe closed".format(self._fd))
+            self.handle_close()
+
+    def handle_close(self):
+        self._release_buffers()
+        _asyncevent.Dispatcher.handle_close(self)
+
+#------------------------------------------------------------------------------
+
+class _ChildWatcher(object):
+    '''Wakes up SubprocessDispatcher objects upon SIGCHLD, by writing to their
+    wakeup pipes, if pidfds are not available. The handler is installed while
+    there's any of them, the previous one is restored afterwards.'''
+
+    def __init__(self):
+        self._fds = set()
+        self._previous = None
+        self._installed = False
+
+    def add(self, fd):
+        if not self._installed:
+            # raises ValueError if not called in the main thread
+            self._previous = signal.signal(signal.SIGCHLD, self._on_signal)
+            self._installed = True
+        self._fds.add(fd)
+
+    def remove(self, fd):
+        self._fds.discard(fd)
+        if self._fds or not self._installed:
+            return
+        # None if not installed from Python
+        previous = signal.SIG_DFL if self._previous is None else self._previous
+        try:
+            signal.signal(signal.SIGCHLD, previous)
+        except ValueError:
+            # not in the main thread, stays installed until the next time
+            return
+        self._previous = None
+        self._installed = False
+
+    def _on_signal(self, signum, frame):
+        for fd in list(self._fds):
+            try:
+                os.write(fd, b'\0')
+            except OSError:
+                # full already, or closed meanwhile
+                pass
+        if callable(self._previous):
+            self._previous(signum, frame)
+
+_child_watcher = _ChildWatcher()
+
+class _ChildPipe(PipeDispatcher):
+    '''stdin, stdout or stderr of a SubprocessDispatcher.'''
+
+    def __init__(self, owner, name, fd, log_handle = None, read_size = None):
+        PipeDispatcher.__init__(self, fd, log_handle = log_handle, read_size = read_size)
+        self._owner = owner
+        self._name = name
+
+    def on_data(self, data):
+        return self._owner._on_output(self._name, data)
+
+    def on_drain(self):
+        self._owner.on_drain()
+
+    def pause_writing(self):
+        PipeDispatcher.pause_writing(self)
+        self._owner.pause_writing()
+
+    def resume_writing(self):
+        PipeDispatcher.resume_writing(self)
+        self._owner.resume_writing()
+
+    def handle_close(self):
+        PipeDispatcher.handle_close(self)
+        if self._owner is not None:
+            owner, self._owner = self._owner, None
+            owner._pipe_closed(self._name)
+
+class SubprocessDispatcher(_asyncevent.Dispatcher):
+    '''Child process, with non-blocking pipes to its stdin, stdout and stderr.
+
+    Once registered, the pipes are registered as well: output of the child is
+    passed to on_stdout() and on_stderr(), data passed to write() is queued
+    and written to its stdin. The exit of the child is noticed through a pidfd
+    (Linux 5.3 or later), or by SIGCHLD otherwise (then the dispatcher must be
+    created by the main thread); on_exit() is called once the child exited,
+    and its output was read to the end, then the dispatcher is closed.
+
+    Flow control works as for BufferedStreamDispatcher: pause_writing() is
+    called while too much data is queued for stdin, and reading of stdout (or
+    stderr) stops while on_stdout() leaves too much unconsumed, see stdout()
+    and set_read_buffer_limit(); pipes may be paired with sockets, see
+    pair_with().
+
+    Usage:
+      >>> class Gzip(SubprocessDispatcher):
+      >>>     def on_stdout(self, data):
+      >>>         client.write(bytes(data))
+      >>>     def on_exit(self, returncode):
+      >>>         client.close_when_done()
+      >>> child = Gzip(['gzip', '-c'])
+      >>> ae.register(child)
+      >>> child.write(payload)
+      >>> child.close_stdin()
+    '''
+
+    def __init__(self, args, stdin = True, stdout = True, stderr = True,
+                 log_handle = None, read_size = None, **popen_kwargs):
+        '''Starts the child process.
+
+        Args:
+          args:         program and arguments, see subprocess.Popen
+          stdin:        True for a pipe, otherwise passed to subprocess.Popen,
+                        e.g. None to inherit it, or subprocess.DEVNULL
+          stdout:       see stdin
+          stderr:       see stdin, subprocess.STDOUT merges it into stdout
+          log_handle:   a log handle to be used, None to disable logging
+          read_size:    see BufferedStreamDispatcher
+          popen_kwargs: other arguments of subprocess.Popen, e.g. cwd, env
+
+        Raises:
+          OSError (or subprocess.SubprocessError) if the child could not be
+          started.
+        '''
+
+        _asyncevent.Dispatcher.__init__(self, log_handle = log_handle)
+
+        # mapping from name to 2-tuple of (parent end, child end)
+        ends = {}
+        try:
+            for name, wanted in (('stdin', stdin), ('stdout', stdout), ('stderr', stderr)):
+                if wanted is True:
+                    rd, wr = os.pipe2(os.O_CLOEXEC)
+                    ends[name] = (wr, rd) if name == 'stdin' else (rd, wr)
+            try:
+                self._popen = subprocess.Popen(
+                    args, stdin = ends['stdin'][1] if 'stdin' in ends else stdin,
+                    stdout = ends['stdout'][1] if 'stdout' in ends else stdout,
+                    stderr = ends['stderr'][1] if 'stderr' in ends else stderr,
+                    **popen_kwargs)
+            finally:
+                for parent_end, child_end in ends.values():
+                    os.close(child_end)
+        except:
+            for parent_end, child_end in ends.values():
+                os.close(parent_end)
+            raise
+
+        self._pipes = {}
+        for name, (parent_end, unused_child_end) in ends.items():
+            self._pipes[name] = _ChildPipe(self, name, parent_end,
+                                           log_handle = log_handle,
+                                           read_size = read_size)
+        self._returncode = None
+        self._exit_reported = False
+        self._closing = False
+
+        self._pidfd = None
+        self._wakeup_fds = None
+        if _pidfd_open is not None:
+            try:
+                self._pidfd = _pidfd_open(self._popen.pid)
+            except OSError as why:
+                self.log_info("pidfd_open() failed, using SIGCHLD: {:s}".format(str(why)))
+        if self._pidfd is None:
+            self._wakeup_fds = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            _child_watcher.add(self._wakeup_fds[1])
+        self.log_info("child started, pid {:d}, args {:s}".format(self._popen.pid, str(args)))
+
+        # readable once the child exited
+        self.want_read(True)
+
+    def __str__(self):
+        return "<%s.%s at %s {pid:%d, returncode:%s, pipes:%s}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            self._popen.pid, str(self._returncode), ",".join(sorted(self._pipes)))
+
+    def fileno(self):
+        return self._pidfd if self._wakeup_fds is None else self._wakeup_fds[0]
+
+    def close(self):
+        if self._wakeup_fds is not None:
+            _child_watcher.remove(self._wakeup_fds[1])
+            os.close(self._wakeup_fds[1])
+            os.close(self._wakeup_fds[0])
+        else:
+            os.close(self._pidfd)
+
+    def pid(self):
+        return self._popen.pid
+
+    def returncode(self):
+        '''Exit status of the child, None while it's running; -N if it was
+        terminated by signal N.'''
+
+        return self._returncode
+
+    def stdin(self):
+        '''PipeDispatcher of stdin, None if not a pipe or closed.'''
+
+        return self._pipes.get('stdin')
+
+    def stdout(self):
+        return self._pipes.get('stdout')
+
+    def stderr(self):
+        return self._pipes.get('stderr')
+
+    def write(self, data):
+        '''Queues data to be written to stdin of the child.
+
+        Raises:
+          ValueError if stdin is not a pipe, or was closed.
+        '''
+
+        self.__stdin().write(data)
+
+    def writelines(self, list_of_data):
+        self.__stdin().writelines(list_of_data)
+
+    def close_stdin(self):
+        '''Closes stdin of the child, once all data queued was written.'''
+
+        if 'stdin' in self._pipes:
+            self._pipes['stdin'].close_when_done()
+
+    def __stdin(self):
+        try:
+            return self._pipes['stdin']
+        except KeyError:
+            raise ValueError("stdin of pid {:d} is not a pipe, or closed".format(
+                self._popen.pid))
+
+    def send_signal(self, signum):
+        '''Sends signal `signum' to the child, unless it has been reaped.'''
+
+        if self._returncode is None:
+            self._popen.send_signal(signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def attach_to_pollster(self, pollster):
+        _asyncevent.Dispatcher.attach_to_pollster(self, pollster)
+        for pipe in list(self._pipes.values()):
+            pollster.register(pipe)
+        # the child might have exited before SIGCHLD was handled
+        pollster.call_soon_threadsafe(self.__check_exit)
+
+    def handle_read(self):
+        if self._wakeup_fds is not None:
+            try:
+                while os.read(self._wakeup_fds[0], 64):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+        self.__check_exit()
+
+    def __check_exit(self):
+        if self._returncode is not None or not self.pollster(False):
+            return
+        returncode = self._popen.poll()
+        if returncode is None:
+            # SIGCHLD of another child
+            return
+        self._returncode = returncode
+        self.log_info("child exited, pid {:d}, returncode {:d}".format(
+            self._popen.pid, returncode))
+        if self._closing:
+            # killed by handle_close()
+            _asyncevent.Dispatcher.handle_close(self)
+            return
+        # the pidfd stays readable
+        self.want_read(False)
+        self.__finish()
+
+    def _on_output(self, name, data):
+        if name == 'stdout':
+            return self.on_stdout(data)
+        return self.on_stderr(data)
+
+    def _pipe_closed(self, name):
+        del self._pipes[name]
+        if self._returncode is not None:
+            self.__finish()
+
+    def __finish(self):
+        if self._exit_reported or self._closing \
+        or 'stdout' in self._pipes or 'stderr' in self._pipes:
+            # output not read to the end yet
+            return
+        self._exit_reported = True
+        self.on_exit(self._returncode)
+        if self.pollster(False):
+            self.handle_close()
+
+    def handle_close(self):
+        '''Closes the pipes, and unregisters the dispatcher; the child is
+        killed if it's still running, and the dispatcher stays registered
+        until the child was reaped (without calling on_exit()).'''
+
+        if self._closing:
+            return
+        self._closing = True
+        for pipe in list(self._pipes.values()):
+            pipe.handle_close()
+        if self._returncode is None:
+            self.log_notice("killing child, pid {:d}".format(self._popen.pid))
+            self._popen.kill()
+            # without blocking, usually the child is not gone yet
+            self._returncode = self._popen.poll()
+            if self._returncode is None and self.pollster(False):
+                # reaped by __check_exit(), once the pidfd (or the wakeup
+                # pipe) becomes readable
+                return
+        _asyncevent.Dispatcher.handle_close(self)
+
+    # callbacks, implement these methods in derived classes
+
+    def on_stdout(self, data):
+        '''Called with output of the child, see BufferedStreamDispatcher.on_data().'''
+
+        self.log_notice("{:s}.{:s}: using default on_stdout()".format(
+            self.__class__.__module__, self.__class__.__name__))
+        return None
+
+    def on_stderr(self, data):
+        '''Called with error output of the child, logged by default.'''
+
+        self.log_info("pid {:d}, stderr: {:s}".format(self._popen.pid,
+                                                    repr(bytes(data))))
+        return None
+
+    def on_exit(self, returncode):
+        '''Called once the child exited, and its output was read.'''
+
+        pass
+
+    def on_drain(self):
+        '''Called when all data queued for stdin was written.'''
+
+        pass
+
+    def pause_writing(self):
+        '''Called when more than the high watermark is queued for stdin,
+        see BufferedStreamDispatcher.pause_writing().'''
+
+        pass
+
+    def resume_writing(self):
+        pass
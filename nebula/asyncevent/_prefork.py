@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import signal
+import socket
+import time
+
+from .. import log as _log
+from .. import sig_num as _sig_num
+from . import _asyncevent
+from . import _socket_dispatcher
+
+#------------------------------------------------------------------------------
+
+class PreforkServer(_log.WrappedLogger):
+    '''Runs a TCP server in several worker processes, each with its own
+    AsyncEvent, supervised by a master process.
+
+    Two modes are supported:
+      MODE_REUSEPORT: every worker binds its own listening socket with
+                      SO_REUSEPORT, the kernel balances new connections among
+                      them.
+      MODE_SHARED:    the master binds one listening socket shared by all
+                      workers, which register it with EPOLLEXCLUSIVE (if
+                      available), so a new connection wakes up one worker only.
+
+    The master restarts workers exiting unexpectedly. On SIGTERM or SIGINT, it
+    forwards SIGTERM to all workers, which stop accepting, wait for their
+    dispatchers to finish (for at most `shutdown_timeout' seconds), and exit;
+    workers still alive after `shutdown_timeout' plus `kill_grace' seconds are
+    killed.
+    '''
+
+    MODE_REUSEPORT, MODE_SHARED = 0, 1
+
+    __mode_names = {MODE_REUSEPORT: "reuseport", MODE_SHARED: "shared"}
+
+    def __init__(self, local_addr, server_factory, num_workers = None,
+                 mode = MODE_REUSEPORT, listen_backlog = socket.SOMAXCONN,
+                 worker_init = None, ae_kwargs = None, restart_delay = 1.0,
+                 shutdown_timeout = 10.0, kill_grace = 5.0, log_handle = None):
+        '''Creates a pre-forking server, the listening address is bound
+        immediately, but no process is forked before run() was called.
+
+        Args:
+          local_addr:       local address to bind to, if the port number is 0,
+                            a port is chosen once and shared by all workers
+          server_factory:   callable with the signature of the constructor of
+                            TcpServerDispatcher (e.g. a subclass of it),
+                            called in each worker to create the server
+                            dispatcher
+          num_workers:      number of worker processes, defaults to the number
+                            of CPUs
+          mode:             MODE_REUSEPORT or MODE_SHARED
+          listen_backlog:   max length of the queue of pending connections
+          worker_init:      optional callable, called in each worker as
+                            `worker_init(ae, server, worker_index)' before the
+                            loop starts, e.g. to add scheduled jobs
+          ae_kwargs:        optional dict of keyword arguments passed to
+                            AsyncEvent() in each worker
+          restart_delay:    seconds to wait before restarting a worker
+          shutdown_timeout: seconds a worker waits for its dispatchers to
+                            finish during graceful shutdown
+          kill_grace:       extra seconds before the master kills workers
+          log_handle:       a log handle to be used, None to disable logging
+        '''
+
+        _log.WrappedLogger.__init__(self, log_handle = log_handle)
+
+        if mode not in self.__mode_names:
+            raise ValueError("mode {:d} is not supported".format(mode))
+        if mode == self.MODE_REUSEPORT and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported, use MODE_SHARED instead")
+
+        self._server_factory = server_factory
+        self._num_workers = num_workers or os.cpu_count() or 1
+        self._mode = mode
+        self._listen_backlog = listen_backlog
+        self._worker_init = worker_init
+        self._ae_kwargs = ae_kwargs or {}
+        self._restart_delay = restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        self._kill_grace = kill_grace
+
+        # In MODE_SHARED, the listening socket shared by workers; in
+        # MODE_REUSEPORT, a bound (but not listening) socket reserving the
+        # port, which does not receive any connection.
+        family = _socket_dispatcher._address_family(local_addr)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET6:
+            # same as TcpServerDispatcher.initialize() of workers
+            self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if mode == self.MODE_REUSEPORT:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind(local_addr)
+        if mode == self.MODE_SHARED:
+            self._sock.listen(listen_backlog)
+            self._sock.setblocking(0)
+        self._local_addr = self._sock.getsockname()
+
+        # mapping from pid to worker index
+        self._workers = {}
+        self._stopping = False
+
+    def local_addr(self):
+        '''Address the workers are listening on.'''
+
+        return self._local_addr
+
+    def mode_name(self):
+        return self.__mode_names[self._mode]
+
+    def num_workers(self):
+        return self._num_workers
+
+    def worker_pids(self):
+        return sorted(self._workers.keys())
+
+    def __str__(self):
+        return "<%s.%s at %s {mode:%s, local:%s:%d, workers:%d/%d, stopping:%d}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            self.mode_name(), self._local_addr[0], self._local_addr[1],
+            len(self._workers), self._num_workers, self._stopping)
+
+    def close(self):
+        '''Closes the listening socket, without running the server.'''
+
+        self._sock.close()
+
+    def run(self):
+        '''Forks the workers, and supervises them until shutdown.
+
+        Returns after all workers exited, the listening socket is closed.
+        '''
+
+        handled = set((signal.SIGCHLD, signal.SIGTERM, signal.SIGINT))
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, handled)
+        try:
+            self.log_notice("starting {:s}".format(str(self)))
+            for index in range(self._num_workers):
+                self.__spawn(index, old_mask)
+            self.__supervise(handled, old_mask)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+            self.close()
+        self.log_notice("finished {:s}".format(str(self)))
+
+    def __spawn(self, index, old_mask):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = index
+            self.log_info("worker {:d} started, pid {:d}".format(index, pid))
+            return
+
+        status = 1
+        try:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+            status = self.__worker_main(index)
+        except BaseException:
+            self.log_err("worker {:d} died, pid {:d}".format(index, os.getpid()))
+        finally:
+            os._exit(status)
+
+    def __supervise(self, handled, old_mask):
+        # pending restarts, items are 2-tuples of (time, worker index)
+        restarts = []
+        kill_at = None
+
+        while self._workers or (restarts and not self._stopping):
+            timeout = 1.0
+            if restarts and not self._stopping:
+                timeout = max(0.0, min(timeout, restarts[0][0] - time.time()))
+            info = signal.sigtimedwait(handled, timeout)
+
+            if info is not None and info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                if not self._stopping:
+                    self.log_notice("caught {:s}, shutting down workers".format(
+                        _sig_num.SignalNumbers.signal_name(info.si_signo)))
+                    self._stopping = True
+                    kill_at = time.time() + self._shutdown_timeout + self._kill_grace
+                    self.__signal_workers(signal.SIGTERM)
+
+            # reap exited workers
+            while self._workers:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    break
+                index = self._workers.pop(pid, None)
+                if index is None:
+                    continue
+                if self._stopping:
+                    self.log_info("worker {:d} exited, pid {:d}, status {:d}".format(
+                        index, pid, status))
+                else:
+                    self.log_warning("worker {:d} exited unexpectedly, pid {:d}, status {:d}, restarting".format(
+                        index, pid, status))
+                    restarts.append((time.time() + self._restart_delay, index))
+
+            now = time.time()
+            while restarts and not self._stopping and restarts[0][0] <= now:
+                unused_time, index = restarts.pop(0)
+                self.__spawn(index, old_mask)
+
+            if kill_at is not None and now >= kill_at and self._workers:
+                self.log_warning("killing {:d} workers still alive".format(len(self._workers)))
+                self.__signal_workers(signal.SIGKILL)
+                kill_at = None
+
+    def __signal_workers(self, signum):
+        for pid in self._workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def __worker_main(self, index):
+        ae = _asyncevent.AsyncEvent(log_handle = self.get_log_handle(),
+                                    **self._ae_kwargs)
+
+        if self._mode == self.MODE_SHARED:
+            server = self._server_factory(sock = self._sock,
+                                          log_handle = self.get_log_handle())
+            server.set_exclusive_wakeup(True)
+        else:
+            self._sock.close()
+            server = self._server_factory(log_handle = self.get_log_handle())
+            server.initialize(self._local_addr, reuse_addr = True,
+                              listen_backlog = self._listen_backlog,
+                              reuse_port = True)
+        ae.register(server)
+
+        if self._worker_init:
+            self._worker_init(ae, server, index)
+
+        def on_signal(signum, unused_frame):
+            # do the real work in the loop, not in the signal handler
+            ae.call_soon_threadsafe(self.__worker_shutdown, ae, server)
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        ae.loop()
+        ae.close()
+        return 0
+
+    def __worker_shutdown(self, ae, server):
+        if server.pollster(False):
+            self.log_info("worker {:d} stops accepting".format(os.getpid()))
+            server.handle_close()
+        ae.add_scheduled_job(_asyncevent.DrainJob(
+            ae, time.time() + self._shutdown_timeout, log_handle = self.get_log_handle()))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import fcntl
+import os
+import socket
+
+from . import _socket_dispatcher
+
+#------------------------------------------------------------------------------
+
+def splice_available():
+    '''Whether os.splice() (Linux, Python 3.10 or later) can be used.'''
+
+    return hasattr(os, 'splice')
+
+class _CopyChannel(object):
+    '''Moves data in one direction, through a slab leased from the buffer pool
+    of the AsyncEvent object.'''
+
+    def __init__(self, src, dst, buffer_size):
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.shut = False
+        self.total = 0
+        self._buffer_size = buffer_size
+        self._pool = None
+        self._slab = None
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        return self._end - self._start
+
+    def has_room(self):
+        return self._slab is None or self._end < len(self._slab)
+
+    def fill(self):
+        if self._slab is None:
+            # one of the legs might have been unregistered already, see
+            # RelayDispatcher.handle_hup_event()
+            self._pool = (self.src.pollster(False) or self.dst.pollster()).buffer_pool()
+            self._slab = self._pool.lease(self._buffer_size)
+        with memoryview(self._slab) as view:
+            received = self.src._sock.recv_into(view[self._end:])
+        if not received:
+            self.eof = True
+        self._end += received
+        return received
+
+    def drain(self):
+        with memoryview(self._slab) as view:
+            sent = self.dst._sock.send(view[self._start:self._end])
+        self._start += sent
+        self.total += sent
+        if self._start == self._end:
+            self._start = self._end = 0
+        return sent
+
+    def close(self):
+        if self._slab is not None:
+            self._pool.release(self._slab)
+            self._slab = None
+        self._start = self._end = 0
+
+class _SpliceChannel(object):
+    '''Moves data in one direction with os.splice(), through a pipe, so the
+    data never enters user space.'''
+
+    _FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+    def __init__(self, src, dst, buffer_size):
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.shut = False
+        self.total = 0
+        self._pipe_rd, self._pipe_wr = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._capacity = buffer_size
+        try:
+            self._capacity = fcntl.fcntl(self._pipe_wr, fcntl.F_SETPIPE_SZ, buffer_size)
+        except (AttributeError, OSError):
+            # the default capacity of a pipe is at least 4096 bytes
+            self._capacity = 4096
+        self._in_pipe = 0
+
+    def pending(self):
+        return self._in_pipe
+
+    def has_room(self):
+        return self._in_pipe < self._capacity
+
+    def fill(self):
+        received = os.splice(self.src.fileno(), self._pipe_wr,
+                             self._capacity - self._in_pipe, flags = self._FLAGS)
+        if not received:
+            self.eof = True
+        self._in_pipe += received
+        return received
+
+    def drain(self):
+        sent = os.splice(self._pipe_rd, self.dst.fileno(), self._in_pipe,
+                         flags = self._FLAGS)
+        self._in_pipe -= sent
+        self.total += sent
+        return sent
+
+    def close(self):
+        for fd in (self._pipe_rd, self._pipe_wr):
+            if fd >= 0:
+                os.close(fd)
+        self._pipe_rd = self._pipe_wr = -1
+        self._in_pipe = 0
+
+#------------------------------------------------------------------------------
+
+class RelayDispatcher(_socket_dispatcher.TcpClientDispatcher):
+    '''One leg of a relay, which copies data between two connected sockets
+    in both directions.
+
+    Create both legs with pair(), and register both of them. Each direction
+    has a bounded buffer (a pipe if os.splice() is used, a slab of the buffer
+    pool otherwise), reading stops while it's full, so a fast sender is
+    slowed down to the speed of the receiver.
+
+    Half-close: once one side shuts down its sending direction, and all of
+    its data was delivered, the relay shuts down sending to the other side,
+    and keeps relaying the other direction. Both legs are closed once both
+    directions finished, or either socket failed.
+    '''
+
+    DEFAULT_BUFFER_SIZE = 65536
+
+    @classmethod
+    def pair(cls, sock_a, sock_b, use_splice = None,
+             buffer_size = DEFAULT_BUFFER_SIZE, log_handle = None):
+        '''Creates both legs of a relay.
+
+        Args:
+          sock_a, sock_b: connected stream sockets
+          use_splice:     whether to use os.splice(), None to use it if
+                          available
+          buffer_size:    max number of bytes buffered per direction
+          log_handle:     a log handle to be used, None to disable logging
+
+        Returns:
+          2-tuple of dispatchers of (sock_a, sock_b), not registered yet.
+        '''
+
+        if use_splice is None:
+            use_splice = splice_available()
+        elif use_splice and not splice_available():
+            raise ValueError("os.splice() is not available")
+        channel_class = use_splice and _SpliceChannel or _CopyChannel
+
+        leg_a = cls(sock_a, log_handle = log_handle)
+        leg_b = cls(sock_b, log_handle = log_handle)
+        leg_a._peer, leg_b._peer = leg_b, leg_a
+        leg_a._out = channel_class(leg_a, leg_b, buffer_size)
+        leg_b._out = channel_class(leg_b, leg_a, buffer_size)
+        leg_a.want_read(True)
+        leg_b.want_read(True)
+        return leg_a, leg_b
+
+    def __init__(self, sock, log_handle = None):
+        _socket_dispatcher.TcpClientDispatcher.__init__(self, sock = sock,
+                                                        log_handle = log_handle)
+        self._peer = None
+        # channel carrying data read from this leg to the peer
+        self._out = None
+        self._closing = False
+
+    def peer(self):
+        return self._peer
+
+    def uses_splice(self):
+        return isinstance(self._out, _SpliceChannel)
+
+    def bytes_relayed(self):
+        '''Number of bytes read from this leg and delivered to its peer.'''
+
+        return self._out.total
+
+    def handle_hup_event(self):
+        # Both directions of this socket are shut down, but data received
+        # might not be delivered yet. Stop polling this leg (HUP would be
+        # reported again and again), and let the peer pump the rest.
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err or self._peer.pollster(False) is None:
+            self.handle_close()
+            return
+        self.pollster().unregister(self)
+        self.__pump()
+
+    def handle_read(self):
+        self.__pump()
+
+    def handle_write(self):
+        self.__pump()
+
+    def __pump(self):
+        try:
+            for channel in (self._out, self._peer._out):
+                self.__pump_channel(channel)
+        except OSError as why:
+            if why.errno in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN,
+                             errno.ECONNABORTED, errno.ETIMEDOUT):
+                self.log_info("fd {:d}, relay failed: {:s}".format(self.fileno(), str(why)))
+                self.handle_close()
+                return
+            raise
+
+        if self._out.shut and self._peer._out.shut:
+            self.log_info("fd {:d}, relay finished, {:d} bytes sent, {:d} bytes received".format(
+                self.fileno(), self._out.total, self._peer._out.total))
+            self.handle_close()
+            return
+
+        self.__update_legs()
+
+    @staticmethod
+    def __pump_channel(channel):
+        progress = True
+        while progress:
+            progress = False
+            if not channel.eof and channel.has_room():
+                try:
+                    progress = channel.fill() > 0
+                except (BlockingIOError, InterruptedError):
+                    pass
+            if channel.pending():
+                try:
+                    progress = channel.drain() > 0 or progress
+                except (BlockingIOError, InterruptedError):
+                    pass
+
+        if channel.eof and not channel.pending() and not channel.shut:
+            # propagate half-close
+            channel.shut = True
+            try:
+                channel.dst._sock.shutdown(socket.SHUT_WR)
+            except OSError as why:
+                if why.errno != errno.ENOTCONN:
+                    raise
+
+    def __update_legs(self):
+        for leg in (self, self._peer):
+            want_read = not leg._out.eof and leg._out.has_room()
+            want_write = leg._peer._out.pending() > 0
+            if leg.readable() != want_read:
+                leg.want_read(want_read)
+            if leg.writable() != want_write:
+                leg.want_write(want_write)
+
+    def handle_close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self._out is not None:
+            self._out.close()
+        _socket_dispatcher.TcpClientDispatcher.handle_close(self)
+        if self._peer is not None:
+            self._peer.handle_close()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import concurrent.futures
+import socket
+import threading
+import time
+
+from .. import log as _log
+
+#------------------------------------------------------------------------------
+
+class Resolver(_log.WrappedLogger):
+    '''Asynchronous getaddrinfo(), with a cache of results.
+
+    Lookups run in a small thread pool of the resolver, separate from the
+    executor of AsyncEvent objects (see AsyncEvent.run_in_executor()), so the
+    loop is never blocked, and slow jobs submitted there don't delay DNS
+    lookups. Results are cached for `ttl' seconds, failures (socket.gaierror)
+    for `negative_ttl' seconds; the least recently used entries are dropped
+    once the cache holds `max_entries' entries. Concurrent lookups of the same
+    name are coalesced, only the first one calls getaddrinfo().
+
+    A resolver may be shared by AsyncEvent objects running in different
+    threads, by default all of them use the one returned by
+    default_resolver().
+    '''
+
+    DEFAULT_MAX_ENTRIES = 1024
+    DEFAULT_TTL = 60.0
+    DEFAULT_NEGATIVE_TTL = 10.0
+    DEFAULT_WORKERS = 2
+
+    def __init__(self, max_entries = DEFAULT_MAX_ENTRIES, ttl = DEFAULT_TTL,
+                 negative_ttl = DEFAULT_NEGATIVE_TTL, workers = DEFAULT_WORKERS,
+                 log_handle = None):
+        '''Creates a resolver.
+
+        Args:
+          max_entries:  max number of cached results (positive and negative)
+          ttl:          seconds a successful lookup is cached, 0 to disable
+          negative_ttl: seconds a failed lookup is cached, 0 to disable
+          workers:      max number of threads calling getaddrinfo(), the
+                        pool is created on first lookup
+          log_handle:   a log handle to be used, None to disable logging
+        '''
+
+        _log.WrappedLogger.__init__(self, log_handle = log_handle)
+
+        if max_entries <= 0:
+            raise ValueError("max_entries must be positive: {:d}".format(max_entries))
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._workers = workers
+        self._executor = None
+
+        self._lock = threading.Lock()
+        # mapping from lookup key to 3-tuple of (expires_at, result, error),
+        # in order of last use
+        self._cache = collections.OrderedDict()
+        # mapping from lookup key to list of futures waiting for it
+        self._in_flight = {}
+        self._stats = dict.fromkeys(('lookups', 'hits', 'negative_hits',
+                                     'misses', 'coalesced', 'failures',
+                                     'evictions'), 0)
+
+    def resolve(self, pollster, host, port, callback = None, family = 0,
+                type = 0, proto = 0, flags = 0):
+        '''Looks up `host' and `port' like socket.getaddrinfo(), without
+        blocking.
+
+        Args:
+          pollster: the AsyncEvent object running in the calling thread
+          callback: optional callable, called with the finished future as its
+                    only argument, in the thread running `pollster', never
+                    from within this method
+
+        Returns:
+          A concurrent.futures.Future object, the result of which is the list
+          returned by getaddrinfo(), or the socket.gaierror raised by it.
+        '''
+
+        key = (host, port, family, type, proto, flags)
+        future = concurrent.futures.Future()
+        if callback is not None:
+            pollster.call_when_done(future, callback)
+
+        with self._lock:
+            self._stats['lookups'] += 1
+            entry = self.__cached(key)
+            if entry is None:
+                waiters = self._in_flight.get(key)
+                if waiters is not None:
+                    self._stats['coalesced'] += 1
+                    waiters.append(future)
+                    return future
+                self._stats['misses'] += 1
+                self._in_flight[key] = [future]
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers = self._workers,
+                        thread_name_prefix = 'Resolver')
+                executor = self._executor
+
+        if entry is not None:
+            self.__complete(future, entry[1], entry[2])
+            return future
+
+        try:
+            job = executor.submit(socket.getaddrinfo, host, port, family,
+                                  type, proto, flags)
+            # not marshalled to the loop: waiters of this name must not
+            # depend on the loop which started the lookup to keep running
+            job.add_done_callback(lambda f: self.__resolved(key, f))
+        except Exception as e:
+            # don't leave waiters of this name hanging
+            job = concurrent.futures.Future()
+            job.set_exception(e)
+            self.__resolved(key, job)
+        return future
+
+    def lookup(self, host, port, family = 0, type = 0, proto = 0, flags = 0):
+        '''Returns the cached result of a successful lookup, or None.'''
+
+        key = (host, port, family, type, proto, flags)
+        with self._lock:
+            entry = self.__cached(key, count = False)
+        if entry is None or entry[2] is not None:
+            return None
+        return list(entry[1])
+
+    def __cached(self, key, count = True):
+        # called with the lock held
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        if count:
+            self._stats[entry[2] is None and 'hits' or 'negative_hits'] += 1
+        return entry
+
+    def __resolved(self, key, job):
+        # called in the worker thread, waiters deliver their results to their
+        # own loops, see resolve()
+        result, error = None, None
+        try:
+            result = job.result()
+        except Exception as e:
+            error = e
+            self.log_info("failed resolving {:s}: {:s}".format(str(key[0]), str(e)))
+
+        with self._lock:
+            waiters = self._in_flight.pop(key, [])
+            if error is not None:
+                self._stats['failures'] += 1
+            if error is None:
+                ttl = self._ttl
+            elif isinstance(error, socket.gaierror):
+                ttl = self._negative_ttl
+            else:
+                # e.g. the executor was shut down, don't cache it
+                ttl = 0
+            if ttl:
+                self._cache[key] = (time.time() + ttl, result, error)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self._max_entries:
+                    self._cache.popitem(last = False)
+                    self._stats['evictions'] += 1
+
+        for future in waiters:
+            self.__complete(future, result, error)
+
+    @staticmethod
+    def __complete(future, result, error):
+        if error is None:
+            # each waiter gets its own list
+            future.set_result(list(result))
+        elif isinstance(error, socket.gaierror):
+            # don't share the exception (and its traceback) among waiters
+            future.set_exception(socket.gaierror(*error.args))
+        else:
+            future.set_exception(error)
+
+    def clear(self):
+        '''Drops all cached results.'''
+
+        with self._lock:
+            self._cache.clear()
+
+    def shutdown(self):
+        '''Stops the threads of the resolver once lookups in flight are
+        finished; a later lookup starts a new pool.'''
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait = False)
+
+    def stats(self):
+        '''Returns a dict of statistics:
+
+          lookups:       calls of resolve()
+          hits:          lookups answered by a cached result
+          negative_hits: lookups answered by a cached failure
+          misses:        lookups which called getaddrinfo()
+          coalesced:     lookups which waited for a lookup of the same name
+                         already in flight
+          failures:      calls of getaddrinfo() which failed
+          evictions:     entries dropped because the cache was full
+          entries:       entries in the cache, some might be expired
+          in_flight:     names being looked up
+        '''
+
+        with self._lock:
+            result = dict(self._stats)
+            result['entries'] = len(self._cache)
+            result['in_flight'] = len(self._in_flight)
+        return result
+
+    def __str__(self):
+        return "<%s.%s at %s {entries:%d, max_entries:%d, ttl:%s, negative_ttl:%s}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            len(self._cache), self._max_entries, str(self._ttl),
+            str(self._negative_ttl))
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+def default_resolver():
+    '''Returns the Resolver shared by all AsyncEvent objects not given one by
+    AsyncEvent.set_resolver().'''
+
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = Resolver()
+        return _default_resolver
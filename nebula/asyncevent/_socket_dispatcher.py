@@ -18,19 +18,127 @@
 # along with pynebula. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import array
+import collections
 import errno
+import os
 import socket
 import time
 
 from .. import log as _log
 from . import _asyncevent
+from . import _resolver
+from . import _socket_profile
 
 #------------------------------------------------------------------------------ 
 
+def _unix_addr_repr(addr):
+    '''Address of an AF_UNIX socket: a path, a name in the abstract namespace
+    (as bytes, starting with a null byte), or empty if unnamed.'''
+
+    if not addr:
+        return "unnamed"
+    if isinstance(addr, bytes):
+        return repr(addr)
+    return addr
+
+def _needs_lookup(so_family, addr):
+    '''Whether the host of an AF_INET or AF_INET6 address is a name.'''
+
+    if so_family not in (socket.AF_INET, socket.AF_INET6):
+        return False
+    host = addr[0]
+    if not isinstance(host, str) or host in ('', '<broadcast>'):
+        return False
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return False
+        except OSError:
+            pass
+    return True
+
+def _address_family(addr, default = socket.AF_INET):
+    '''Family of a socket for `addr': AF_INET6 for an IPv6 address (the host
+    of which is a literal containing colons, or a 4-tuple), `default' for IPv4
+    addresses and host names.'''
+
+    if not addr:
+        return default
+    if len(addr) == 4 or (isinstance(addr[0], str) and ':' in addr[0]):
+        return socket.AF_INET6
+    return default
+
+def _interleave_families(infos):
+    '''Sorts addresses returned by getaddrinfo() for Happy Eyeballs (RFC 8305,
+    section 4): alternating families, starting with the one getaddrinfo()
+    preferred, otherwise in their original order.
+
+    Returns:
+      List of 2-tuples of (family, sockaddr), without duplicates.
+    '''
+
+    by_family = collections.OrderedDict()
+    seen = set()
+    for family, unused_type, unused_proto, unused_name, sockaddr in infos:
+        if (family, sockaddr) in seen:
+            continue
+        seen.add((family, sockaddr))
+        by_family.setdefault(family, collections.deque()).append(sockaddr)
+
+    result = []
+    queues = list(by_family.items())
+    while queues:
+        for family, queue in queues:
+            result.append((family, queue.popleft()))
+        queues = [(family, queue) for family, queue in queues if queue]
+    return result
+
+class _FdsChunk(object):
+    '''Data queued for output together with file descriptors, which are
+    passed as SCM_RIGHTS ancillary data over an AF_UNIX socket.'''
+
+    __slots__ = ('view', 'fds', 'close_fds')
+
+    def __init__(self, view, fds, close_fds):
+        self.view = view
+        # integers, or objects with a fileno() method
+        self.fds = fds
+        self.close_fds = close_fds
+
+    def fd_numbers(self):
+        return [fd if isinstance(fd, int) else fd.fileno() for fd in self.fds]
+
+    def ancdata(self):
+        return [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                 array.array('i', self.fd_numbers()))]
+
+    def release_fds(self):
+        '''Closes the descriptors if owned, once sent or dropped.'''
+
+        fds, self.fds = self.fds, ()
+        if not self.close_fds:
+            return
+        for fd in fds:
+            if isinstance(fd, int):
+                os.close(fd)
+            else:
+                fd.close()
+
+def _fds_from_ancdata(ancdata):
+    '''Returns list of file descriptors received as SCM_RIGHTS.'''
+
+    fds = array.array('i')
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    return list(fds)
+
 class _SocketDispatcher(_asyncevent.Dispatcher):
     __socket_family_names = {
                              socket.AF_INET:  "AF_INET",
                              socket.AF_INET6: "AF_INET6",
+                             socket.AF_UNIX:  "AF_UNIX",
                              }
 
     __socket_type_names = {
@@ -46,6 +154,7 @@ class _SocketDispatcher(_asyncevent.Dispatcher):
         else:
             self.__so_family, self.__so_type = None, None
         self.__local_addr = None
+        self.__profile = None
 
     def local_addr(self):
         return self.__local_addr
@@ -61,6 +170,8 @@ class _SocketDispatcher(_asyncevent.Dispatcher):
                 return "{:s}:{:d}".format(self.__local_addr[0], self.__local_addr[1])
             elif self.__so_family == socket.AF_INET6:
                 return "[{:s}]:{:d}".format(self.__local_addr[0], self.__local_addr[1])
+            elif self.__so_family == socket.AF_UNIX:
+                return _unix_addr_repr(self.__local_addr)
             else:
                 return "unknown_type"
 
@@ -78,7 +189,47 @@ class _SocketDispatcher(_asyncevent.Dispatcher):
         return self._sock.fileno()
 
     def close(self):
-        self._sock.close()
+        # None if detached, see detach_socket()
+        if self._sock is not None:
+            self._sock.close()
+
+    def detach_socket(self):
+        '''Unregisters this dispatcher (if registered), and returns its socket,
+        which is not closed, e.g. to give a connection back to a
+        ConnectionPool; the dispatcher can't be used any more.'''
+
+        if self.pollster(False):
+            self.pollster().unregister(self)
+        sock, self._sock = self._sock, None
+        return sock
+
+    def recv_pooled(self, max_size = 65536):
+        '''Receives at most `max_size' bytes into a slab leased from the
+        buffer pool of the AsyncEvent object, without allocating new objects
+        for the data.
+
+        Returns:
+          A memoryview of the received data, which must be given back by
+          `self.pollster().buffer_pool().release(view)' once consumed; an
+          empty memoryview if the peer closed the connection, which needs not
+          be released; or None if no data is available.
+        '''
+
+        pool = self.pollster().buffer_pool()
+        slab = pool.lease(max_size)
+        try:
+            received = self._sock.recv_into(slab, max_size)
+        except (BlockingIOError, InterruptedError):
+            pool.release(slab)
+            return None
+        except:
+            pool.release(slab)
+            raise
+
+        if not received:
+            pool.release(slab)
+            return memoryview(b'')
+        return memoryview(slab)[:received]
 
     def socket_family(self):
         return self.__so_family
@@ -111,21 +262,42 @@ class _SocketDispatcher(_asyncevent.Dispatcher):
         self._sock = socket.socket(self.__so_family, self.__so_type)
         self._sock.setblocking(0)
 
-    def bind(self, addr, reuse_addr = False):
+    def _replace_socket(self, sock):
+        '''Replaces the socket object by `sock', which is closed, keeping the
+        file descriptor number, so the dispatcher needs not be registered
+        again. The old socket must not be polled, see monitor_fd().
+        '''
+
+        fd = self._sock.fileno()
+        # the file referred to by `fd' is closed, and replaced
+        os.dup2(sock.fileno(), fd, inheritable = False)
+        sock.close()
+        self._sock.detach()
+        self._sock = socket.socket(fileno = fd)
+        self._sock.setblocking(0)
+        self.__so_family, self.__so_type = self._sock.family, self._sock.type
+
+    def bind(self, addr, reuse_addr = False, reuse_port = False):
         '''Binds to local address.
 
         Args:
           addr:       local address to bind to
-          reuse_addr: if True and addr[0] (viz. port number) is non-zero, set
-                      socket option SO_REUSEADDR
+          reuse_addr: if True and addr[1] (viz. port number) is non-zero, set
+                      socket option SO_REUSEADDR, ignored for AF_UNIX sockets
+          reuse_port: if True, set socket option SO_REUSEPORT, so that several
+                      sockets (e.g. one per worker process) can be bound to the
+                      same address, and the kernel balances connections among
+                      them
         '''
 
         self.__local_addr = addr
-        self.log_info("binding to local address {:s}, SO_REUSEADDR {:d}".format(
-            self.local_addr_repr(), reuse_addr))
-        if reuse_addr and addr[1]:
+        self.log_info("binding to local address {:s}, SO_REUSEADDR {:d}, SO_REUSEPORT {:d}".format(
+            self.local_addr_repr(), reuse_addr, reuse_port))
+        if reuse_addr and self.__so_family != socket.AF_UNIX and addr[1]:
             # only if port number is not zero
             self.set_reuse_addr()
+        if reuse_port:
+            self.set_reuse_port()
         return self._sock.bind(self.__local_addr)
 
     def set_reuse_addr(self):
@@ -136,9 +308,113 @@ class _SocketDispatcher(_asyncevent.Dispatcher):
         except socket.error:
             self.log_notice("failed setting option SO_REUSEADDR")
 
+    def set_socket_profile(self, profile):
+        '''Sets the SocketProfile applied to sockets created (or accepted) by
+        this dispatcher from now on, None for system defaults.'''
+
+        if profile is not None and not isinstance(profile, _socket_profile.SocketProfile):
+            raise TypeError("{:s} is not an instance of SocketProfile".format(repr(profile)))
+        self.__profile = profile
+
+    def socket_profile(self):
+        return self.__profile
+
+    def _apply_profile(self, sock, role):
+        if self.__profile is not None:
+            self.__profile.apply(sock, role, self)
+
+    def set_v6only(self, flag = True):
+        '''Sets socket option IPV6_V6ONLY of an AF_INET6 socket, if False
+        IPv4 traffic is handled as well, using IPv4-mapped addresses.'''
+
+        self._sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY,
+                              flag and 1 or 0)
+
+    def set_reuse_port(self):
+        '''Sets socket option SO_REUSEPORT.
+
+        Raises:
+          socket.error if the option is not supported.
+        '''
+
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise socket.error(errno.ENOPROTOOPT, "SO_REUSEPORT is not supported")
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
 #------------------------------------------------------------------------------ 
 
+class _ConnectAttempt(_SocketDispatcher):
+    '''One of the connection attempts raced by TcpClientDispatcher, see
+    TcpClientDispatcher.connect().'''
+
+    def __init__(self, family, addr, on_connected, on_failed, profile = None,
+                 log_handle = None):
+        _SocketDispatcher.__init__(self, log_handle = log_handle)
+        self._addr = addr
+        self._on_connected = on_connected
+        self._on_failed = on_failed
+        self.socket(family, socket.SOCK_STREAM)
+        self.set_socket_profile(profile)
+        self._apply_profile(self._sock, _socket_profile.SocketProfile.ROLE_CLIENT)
+
+    def connect(self):
+        err = self._sock.connect_ex(self._addr)
+        if err not in (0, errno.EISCONN, errno.EWOULDBLOCK, errno.EAGAIN,
+                       errno.EALREADY, errno.EINPROGRESS):
+            raise socket.error(err, errno.errorcode[err])
+        self.log_info("fd {:d}, attempting connection to {:s}".format(
+            self.fileno(), self.peer_addr_repr()))
+
+    def addr(self):
+        return self._addr
+
+    def peer_addr_repr(self):
+        if self.socket_family() == socket.AF_INET6:
+            return "[{:s}]:{:d}".format(self._addr[0], self._addr[1])
+        return "{:s}:{:d}".format(self._addr[0], self._addr[1])
+
+    def is_connected(self):
+        return False
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def timeout(self):
+        return None
+
+    def handle_write_event(self, call_user_func = True):
+        err = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, errno.errorcode[err])
+        self._on_connected(self)
+
+    def handle_hup_event(self):
+        # not handled by handle_write_event() in this iteration
+        self.handle_write_event()
+
+    def handle_error(self, exception_obj):
+        self.log_info("fd {:d}, connection to {:s} failed: {:s}".format(
+            self.fileno(), self.peer_addr_repr(), str(exception_obj)))
+        self.handle_close()
+        self._on_failed(self, exception_obj)
+
 class TcpClientDispatcher(_SocketDispatcher):
+    '''TCP client socket dispatcher, connecting without blocking.
+
+    A host name passed to connect() is looked up asynchronously. If more than
+    one address is found (e.g. an IPv6 and an IPv4 one), connection attempts
+    are raced as described by RFC 8305 (Happy Eyeballs): addresses of both
+    families are tried in turn, a new attempt is started every
+    attempt_delay() seconds or as soon as the previous one failed, the first
+    one connected is kept, and the others are cancelled.
+    '''
+
+    # Connection Attempt Delay, recommended by RFC 8305
+    DEFAULT_ATTEMPT_DELAY = 0.25
+
     def __init__(self, sock = None, log_handle = None):
         '''Creates a TCP client socket Dispatcher instance.
 
@@ -156,6 +432,19 @@ class TcpClientDispatcher(_SocketDispatcher):
         self.__peer_addr = None
         # absolute time in seconds (as float) since the Epoch
         self.__connect_timeout_at = None
+        # host name of peer address being looked up, see connect()
+        self.__resolving = None
+        self.__resolve_future = None
+        # whether host names may be resolved to addresses of any family, see
+        # initialize()
+        self.__any_family = False
+        # Happy Eyeballs: addresses not tried yet (as 2-tuples of family and
+        # address), attempts in flight, and when to start the next one
+        self.__candidates = collections.deque()
+        self.__attempts = []
+        self.__next_attempt_at = None
+        self.__attempt_delay = self.DEFAULT_ATTEMPT_DELAY
+        self.__last_error = None
 
         if sock is not None:
             self._sock.setblocking(0)
@@ -174,19 +463,34 @@ class TcpClientDispatcher(_SocketDispatcher):
                     raise
 
     def initialize(self, peer_addr = None, connect_timeout = None,
-                   local_addr = None, reuse_addr = True):
-        '''Creates a non-blocking TCP socket (IPv6 is NOT supported yet).
+                   local_addr = None, reuse_addr = True, family = None,
+                   profile = None):
+        '''Creates a non-blocking TCP socket.
 
         Args:
-          peer_addr:       remote address to connect to
+          peer_addr:       remote address to connect to, the host may be a
+                           name, see connect()
           connect_timeout: number of seconds (as float) to wait before aborting
                            the connection attempt
           local_addr:      local address to bind to
           reuse_addr:      whether to set socket option SO_REUSEADDR or not,
                            ignored if `local_addr' is not provied
+          family:          socket.AF_INET or socket.AF_INET6; if None, the
+                           family of `local_addr' or `peer_addr' (IPv6 if the
+                           host is an IPv6 address), and host names may be
+                           resolved to addresses of both families unless
+                           `local_addr' is provided
+          profile:         SocketProfile applied to the socket (and to those
+                           of connection attempts, see connect())
         '''
 
-        self.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__any_family = family is None and not local_addr
+        if family is None:
+            family = _address_family(local_addr or peer_addr)
+        self.socket(family, socket.SOCK_STREAM)
+        if profile is not None:
+            self.set_socket_profile(profile)
+        self._apply_profile(self._sock, _socket_profile.SocketProfile.ROLE_CLIENT)
         if local_addr:
             self.bind(local_addr, reuse_addr)
         if peer_addr:
@@ -201,6 +505,8 @@ class TcpClientDispatcher(_SocketDispatcher):
                 return "%s:%d" % (self.__peer_addr[0], self.__peer_addr[1])
             elif self.socket_family() == socket.AF_INET6:
                 return "[%s]:%d" % (self.__peer_addr[0], self.__peer_addr[1])
+            elif self.socket_family() == socket.AF_UNIX:
+                return _unix_addr_repr(self.__peer_addr)
             else:
                 return "unknown_type"
 
@@ -214,25 +520,79 @@ class TcpClientDispatcher(_SocketDispatcher):
     def is_connected(self):
         return self.__connected
 
+    def is_resolving(self):
+        '''Whether the host name passed to connect() is being looked up.'''
+
+        return self.__resolving is not None
+
+    def set_attempt_delay(self, delay):
+        '''Sets seconds to wait for a connection attempt before racing it with
+        an attempt to the next address, see connect(). None to try addresses
+        one after another, only once the previous attempt failed.'''
+
+        if delay is not None and delay <= 0:
+            raise ValueError("delay must be positive: {:s}".format(str(delay)))
+        self.__attempt_delay = delay
+
+    def attempt_delay(self):
+        return self.__attempt_delay
+
     def connect(self, addr, timeout = None):
         '''Attempts to make a connection to the specified address.
 
+        If the host of `addr' is a name instead of an IP address, it's looked
+        up by the Resolver of the AsyncEvent object (see AsyncEvent.resolver())
+        without blocking once this dispatcher was registered; a failed lookup
+        raises socket.gaierror, which is handled by handle_error(), i.e. the
+        dispatcher is closed. If more than one address was found, connection
+        attempts are raced (see the class documentation), each with a socket
+        of its own, the one connected first replaces the socket of this
+        dispatcher, keeping its fd; if all of them failed, the error of the
+        last one is handled by handle_error(). Connecting to an address of the
+        other family works the same way.
+
         Args:
           addr:    address to connect to
           timeout: number of seconds (as float) to wait before aborting the
-                   connection attempt
+                   connection attempt, including the lookup of the host name
 
-        NOTES:
-          Beware that if the supplied `addr' is a domain name instead of an IP,
-          then this method will use DNS to lookup the host IP, which might block
-          the calling thread for a while.
+        Returns:
+          errno of the connection attempt, EINPROGRESS if a name is being
+          looked up.
         '''
 
         # try connect to the remote server, and timeout if required
         self.__peer_addr = addr
-        err = self._sock.connect_ex(self.__peer_addr)
         if timeout:
             self.__connect_timeout_at = time.time() + timeout
+        if _needs_lookup(self.socket_family(), addr):
+            infos = self.__resolver().lookup(addr[0], addr[1], self.__lookup_family(),
+                                             socket.SOCK_STREAM)
+            if infos:
+                return self.__connect_to_any(infos)
+            else:
+                self.log_info("fd {:d}, resolving {:s}".format(self.fileno(), str(addr[0])))
+                self.__resolving = addr[0]
+                if self.pollster(False):
+                    self.__start_resolving()
+                    # stop polling the socket, see monitor_fd()
+                    self.update_interest()
+                # otherwise once registered, see attach_to_pollster()
+                return errno.EINPROGRESS
+        family = _address_family(addr)
+        if family != self.socket_family() and self.__lookup_family() == 0:
+            # e.g. an IPv6 address, but the socket was created for IPv4
+            return self.__connect_to_any([(family, socket.SOCK_STREAM, 0, '', addr)])
+        return self.__connect_to_peer()
+
+    def __lookup_family(self):
+        # a bound socket can't be replaced by one of the other family
+        if self.__any_family and not self.local_addr():
+            return 0
+        return self.socket_family()
+
+    def __connect_to_peer(self):
+        err = self._sock.connect_ex(self.__peer_addr)
         if err in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EALREADY, errno.EINPROGRESS):
             self.log_info("fd {:d}, connecting to {:s}, errno {:s}".format(
                 self.fileno(), self.peer_addr_repr(), errno.errorcode[err]))
@@ -242,10 +602,144 @@ class TcpClientDispatcher(_SocketDispatcher):
                 self.fileno(), self.peer_addr_repr(), errno.errorcode[err]))
             self.__connected = True
             self.set_local_addr(self._sock.getsockname())
+            self.update_interest()
             return err
         else:
             raise socket.error(err, errno.errorcode[err])
 
+    def __resolver(self):
+        pollster = self.pollster(False)
+        return pollster and pollster.resolver() or _resolver.default_resolver()
+
+    def __start_resolving(self):
+        self.__resolve_future = self.__resolver().resolve(
+            self.pollster(), self.__peer_addr[0], self.__peer_addr[1],
+            self.__on_resolved, family = self.__lookup_family(),
+            type = socket.SOCK_STREAM)
+
+    def __on_resolved(self, future):
+        if future is not self.__resolve_future or not self.pollster(False):
+            # closed meanwhile
+            return
+        self.__resolve_future = None
+        name, self.__resolving = self.__resolving, None
+        try:
+            infos = future.result()
+            self.log_info("fd {:d}, resolved {:s} to {:s}".format(
+                self.fileno(), str(name), ", ".join(str(info[4][0]) for info in infos)))
+            self.__connect_to_any(infos)
+            # wait for the connection to be established
+            self.update_interest()
+        except Exception as e:
+            self.handle_error(e)
+
+    def __connect_to_any(self, infos):
+        addrs = _interleave_families(infos)
+        if (len(addrs) == 1 and addrs[0][0] == self.socket_family()) \
+        or self.local_addr():
+            self.__peer_addr = addrs[0][1]
+            return self.__connect_to_peer()
+
+        self.__candidates = collections.deque(addrs)
+        if self.pollster(False):
+            self.__start_next_attempt()
+        # otherwise once registered, see attach_to_pollster()
+        return errno.EINPROGRESS
+
+    def __start_next_attempt(self):
+        '''Starts an attempt to connect to the next candidate address, raises
+        the last error if all of them failed.'''
+
+        while self.__candidates:
+            family, addr = self.__candidates.popleft()
+            attempt = _ConnectAttempt(family, addr, self.__attempt_connected,
+                                      self.__attempt_failed, self.socket_profile(),
+                                      log_handle = self.get_log_handle())
+            try:
+                attempt.connect()
+            except socket.error as err:
+                # e.g. ENETUNREACH, if there's no IPv6 route
+                self.log_info("fd {:d}, connection to {:s} failed: {:s}".format(
+                    attempt.fileno(), attempt.peer_addr_repr(), str(err)))
+                attempt.close()
+                self.__last_error = err
+                continue
+            self.pollster().register(attempt)
+            self.__attempts.append(attempt)
+            break
+
+        if self.__candidates and self.__attempt_delay is not None:
+            self.__next_attempt_at = time.time() + self.__attempt_delay
+        else:
+            self.__next_attempt_at = None
+        self.update_interest()
+        if not self.__attempts:
+            raise self.__last_error
+
+    def __start_attempts(self):
+        # called soon after registered
+        if self.pollster(False) and not self.__attempts and self.__candidates:
+            try:
+                self.__start_next_attempt()
+            except Exception as e:
+                self.handle_error(e)
+
+    def __attempt_connected(self, attempt):
+        self.__attempts.remove(attempt)
+        sock = attempt.detach_socket()
+        self.__cancel_attempts()
+
+        self.__peer_addr = attempt.addr()
+        self._replace_socket(sock)
+        self.log_info("fd {:d}, connected to {:s}".format(self.fileno(),
+                                                          self.peer_addr_repr()))
+        self.__connected = True
+        self.set_local_addr(self._sock.getsockname())
+        # the socket is polled from now on
+        self.update_interest()
+
+    def __attempt_failed(self, attempt, exception_obj):
+        # called by attempt.handle_error()
+        if attempt not in self.__attempts:
+            return
+        self.__attempts.remove(attempt)
+        self.__last_error = exception_obj
+        if self.__candidates:
+            # don't wait for the delay to expire
+            try:
+                self.__start_next_attempt()
+            except Exception as e:
+                self.handle_error(e)
+        elif not self.__attempts:
+            self.handle_error(exception_obj)
+
+    def __cancel_attempts(self):
+        attempts, self.__attempts = self.__attempts, []
+        for attempt in attempts:
+            attempt.handle_close()
+        self.__candidates.clear()
+        self.__next_attempt_at = None
+
+    def attach_to_pollster(self, pollster):
+        _SocketDispatcher.attach_to_pollster(self, pollster)
+        if self.__resolving is not None and self.__resolve_future is None:
+            self.__start_resolving()
+        elif self.__candidates and not self.__attempts:
+            # errors are handled once registered
+            pollster.call_soon_threadsafe(self.__start_attempts)
+
+    def detach_from_pollster(self, pollster):
+        _SocketDispatcher.detach_from_pollster(self, pollster)
+        # a lookup finishing later is ignored
+        self.__resolve_future = None
+        self.__cancel_attempts()
+
+    def monitor_fd(self):
+        # the socket reports HUP until the connection attempt is started on it,
+        # and is replaced by the one of the winner of a race
+        return self.__resolving is None and not self.__candidates \
+               and not self.__attempts
+
     def monitor_readable(self, call_user_func = True):
         # if not connected, do not wait for INPUT event
         if not self.__connected:
@@ -273,6 +767,9 @@ class TcpClientDispatcher(_SocketDispatcher):
             if self.__connect_timeout_at:
                 self.log_info("fd {:d}, connection attempt will be aborted at {:s}".format(
                     self.fileno(), _log.Logger.timestamp_str(self.__connect_timeout_at)))
+            if self.__next_attempt_at and (not self.__connect_timeout_at
+                    or self.__next_attempt_at < self.__connect_timeout_at):
+                return self.__next_attempt_at
             return self.__connect_timeout_at
 
         if call_user_func:
@@ -289,6 +786,8 @@ class TcpClientDispatcher(_SocketDispatcher):
                                                               self.peer_addr_repr()))
             self.__connected = True
             self.set_local_addr(self._sock.getsockname())
+            # interest in events changes once connected
+            self.update_interest()
         else:
             if call_user_func:
                 self.handle_write()
@@ -300,6 +799,13 @@ class TcpClientDispatcher(_SocketDispatcher):
           It is the derived class' responsibility to decide what to do when the
           connect attempt failed.
         '''
+        if self.__next_attempt_at and not self.__connected \
+        and self.__next_attempt_at <= time.time():
+            # race the next address, see connect()
+            self.__start_next_attempt()
+            if not self.__connect_timeout_at \
+            or self.__connect_timeout_at > time.time():
+                return
         if self.__connect_timeout_at and not self.__connected:
             self.log_info("fd {:d}, connection to {:s} timedout".format(
                 self.fileno(), self.peer_addr_repr()))
@@ -310,6 +816,8 @@ class TcpClientDispatcher(_SocketDispatcher):
 
 class TcpServerDispatcher(_SocketDispatcher):
 
+    DEFAULT_MAX_ACCEPTS_PER_EVENT = 64
+
     def __init__(self, sock = None, log_handle = None):
         '''Creates a TCP server socket Dispatcher instance.
 
@@ -326,17 +834,25 @@ class TcpServerDispatcher(_SocketDispatcher):
 
         self._listen_backlog = None
         self._accepting = False
+        self._exclusive_wakeup = False
+        self._max_accepts_per_event = self.DEFAULT_MAX_ACCEPTS_PER_EVENT
 
         if sock is not None:
             self._sock.setblocking(0)
             self.set_local_addr(self._sock.getsockname())
+            # listen() might have been called by another process, e.g. the
+            # master process of PreforkServer
+            self._accepting = self._sock.getsockopt(socket.SOL_SOCKET,
+                                                    socket.SO_ACCEPTCONN) and True or False
 
     def is_connected(self):
         return False
 
     def initialize(self, local_addr, reuse_addr = True,
-                   listen_backlog = socket.SOMAXCONN):
-        '''Creates a non-blocking TCP server socket (IPv6 is NOT supported yet).
+                   listen_backlog = socket.SOMAXCONN, reuse_port = False,
+                   dual_stack = False, profile = None):
+        '''Creates a non-blocking TCP server socket, an IPv6 one if the host of
+        `local_addr' is an IPv6 address.
 
         local_addr:
           local address to bind to
@@ -344,12 +860,60 @@ class TcpServerDispatcher(_SocketDispatcher):
           whether to set socket option SO_REUSEADDR or not
         listen_backlog:
           max length of the queue of pending connections
+        reuse_port:
+          whether to set socket option SO_REUSEPORT or not
+        dual_stack:
+          if True, create an IPv6 socket accepting IPv4 connections as well
+          (with IPv4-mapped peer addresses), an empty host (or "0.0.0.0") is
+          replaced by "::"
+        profile:
+          SocketProfile applied to the listening socket, and to connections
+          accepted, see set_socket_profile()
         '''
 
-        self.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.bind(local_addr, reuse_addr)
+        if dual_stack:
+            if local_addr[0] in ('', '0.0.0.0'):
+                local_addr = ('::',) + tuple(local_addr[1:])
+            family = socket.AF_INET6
+        else:
+            family = _address_family(local_addr)
+        self.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET6:
+            self.set_v6only(not dual_stack)
+        if profile is not None:
+            self.set_socket_profile(profile)
+        self._apply_profile(self._sock, _socket_profile.SocketProfile.ROLE_LISTENER)
+        self.bind(local_addr, reuse_addr, reuse_port)
         self.listen(listen_backlog)
 
+    def set_exclusive_wakeup(self, flag = True):
+        '''Asks AsyncEvent to register the listening socket with EPOLLEXCLUSIVE.
+
+        Use it if the same listening socket is shared by several processes,
+        each with its own AsyncEvent, so that a new connection wakes up only
+        one of them. Must be called before the dispatcher was registered.
+        '''
+
+        self._exclusive_wakeup = flag and True or False
+
+    def exclusive_wakeup(self):
+        return self._exclusive_wakeup
+
+    def set_max_accepts_per_event(self, limit):
+        '''Sets max number of connections accepted per read event.
+
+        A large value drains a burst of new connections in few iterations of
+        the loop, a small one keeps the latency of other dispatchers low while
+        the burst lasts. None for no limit.
+        '''
+
+        if limit is not None and limit <= 0:
+            raise ValueError("limit must be positive: {:d}".format(limit))
+        self._max_accepts_per_event = limit
+
+    def max_accepts_per_event(self):
+        return self._max_accepts_per_event
+
     def __str__(self):
         return "<%s.%s at %s {sock_fd:%d, sock_family:%s, sock_type:%s, accepting:%d, local:%s, backlog:%s}>" % (
             self.__class__.__module__, self.__class__.__name__, hex(id(self)),
@@ -361,13 +925,15 @@ class TcpServerDispatcher(_SocketDispatcher):
         self._sock.listen(backlog)
         self._listen_backlog = backlog
         self._accepting = True
-        self.log_notice("server socket is ready {:s}".format(self))
+        self.log_notice("server socket is ready {:s}".format(str(self)))
 
     def __new_peer_addr(self, conn_sock, conn_addr):
         if conn_sock.family == socket.AF_INET:
             return "{:s}:{:d}".format(conn_addr[0], conn_addr[1])
         elif conn_sock.family == socket.AF_INET6:
             return "[{:s}]:{:d}".format(conn_addr[0], conn_addr[1])
+        elif conn_sock.family == socket.AF_UNIX:
+            return _unix_addr_repr(conn_addr)
         else:
             return "unknown_type"
 
@@ -376,15 +942,16 @@ class TcpServerDispatcher(_SocketDispatcher):
             conn_sock, conn_addr = self._sock.accept()
             self.log_info("new connection accepted, fd {:d}, peer address {:s}".format(
                 conn_sock.fileno(), self.__new_peer_addr(conn_sock, conn_addr)))
+            self._apply_profile(conn_sock, _socket_profile.SocketProfile.ROLE_ACCEPTED)
             return conn_sock, conn_addr
         except TypeError as e:
-            self.log_notice("caught exception TypeError: {:s}".format(e))
+            self.log_notice("caught exception TypeError: {:s}".format(str(e)))
             return None
         except socket.error as why:
             if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.ECONNABORTED):
                 return None
             else:
-                self.log_warning("caught UNEXPECTED exception socket.error: {:s}".format(e))
+                self.log_warning("caught UNEXPECTED exception socket.error: {:s}".format(str(why)))
                 raise
 
     def prepare_serving_client(self, conn_sock, conn_addr):
@@ -394,6 +961,19 @@ class TcpServerDispatcher(_SocketDispatcher):
             conn_sock.fileno(), str(conn_addr)))
         conn_sock.close()
 
+    def prepare_serving_clients(self, new_clients):
+        '''Serves connections accepted by one read event.
+
+        Args:
+          new_clients: list of 2-tuples of (conn_sock, conn_addr)
+
+        By default calls prepare_serving_client() for each connection, override
+        it to set up many connections at once.
+        '''
+
+        for conn_sock, conn_addr in new_clients:
+            self.prepare_serving_client(conn_sock, conn_addr)
+
     def monitor_readable(self):
         return (self._accepting and True or False)
 
@@ -407,8 +987,328 @@ class TcpServerDispatcher(_SocketDispatcher):
     # user can derive from this class, and use a customized handle_read() with
     # enhanced features (e.g. access control beased on white-list or black-list).
     # It is strange to force the user to re-implement handle_read_event().
+    #
+    # Connections are accepted until there's no pending one, or
+    # max_accepts_per_event() is reached. In edge-triggered mode we won't be
+    # notified again about connections left pending, so go on accepting them
+    # at the end of this iteration of the loop.
     def handle_read(self):
-        new_client = self.accept()
-        if new_client:
-            conn_sock, conn_addr = new_client[0], new_client[1]
-            self.prepare_serving_client(conn_sock, conn_addr)
+        limit = self._max_accepts_per_event
+        new_clients = []
+        try:
+            while limit is None or len(new_clients) < limit:
+                new_client = self.accept()
+                if not new_client:
+                    break
+                new_clients.append(new_client)
+        finally:
+            if new_clients:
+                self.prepare_serving_clients(new_clients)
+
+        if limit is not None and len(new_clients) >= limit and self._accepting:
+            pollster = self.pollster(False)
+            if pollster and pollster.edge_triggered():
+                pollster.call_soon_threadsafe(self.__accept_more)
+
+    def __accept_more(self):
+        # the server might have been closed meanwhile
+        if self._accepting and self.pollster(False):
+            self.handle_read()
+
+#------------------------------------------------------------------------------ 
+
+class UdpDispatcher(_SocketDispatcher):
+    '''UDP socket dispatcher, receiving and sending datagrams in batches.
+
+    On each read event, datagrams are received until the socket would block,
+    or recv_budget() datagrams were received, each into a slab leased from the
+    buffer pool of the AsyncEvent object; then the whole batch is passed to
+    on_datagrams(). Datagrams queued by sendto() are sent in one go when the
+    socket is writable.
+
+    Usage:
+      Derive from this class, and override on_datagram() (or on_datagrams()
+      to process a batch at once).
+    '''
+
+    DEFAULT_RECV_BUDGET = 64
+    DEFAULT_MAX_DATAGRAM_SIZE = 65535
+
+    # size of the buffer for ancillary data of each received datagram, and
+    # flags of recvmsg_into(), see _handle_ancdata()
+    _ancbufsize = 0
+    _recv_flags = 0
+
+    def __init__(self, sock = None, log_handle = None):
+        '''Creates a UDP socket Dispatcher instance.
+
+        By default the underlying socket object will NOT be created immediately.
+        If a socket object is provided, use it instead of creating a new one.
+
+        Args:
+          log_handle: used to write log messages
+          sock:       used to initialize the socket object used by this Dispatcher
+        '''
+
+        _SocketDispatcher.__init__(self, sock = sock, log_handle = log_handle)
+
+        self.__peer_addr = None
+        self._recv_budget = self.DEFAULT_RECV_BUDGET
+        self._max_datagram_size = self.DEFAULT_MAX_DATAGRAM_SIZE
+        # outgoing datagrams, items are 3-tuples of (data, address, fds),
+        # where fds is a _FdsChunk object or None
+        self._send_queue = collections.deque()
+        self._stats = dict.fromkeys(('recv_batches', 'datagrams_received',
+                                     'bytes_received', 'truncated',
+                                     'max_recv_batch', 'last_recv_batch',
+                                     'send_batches', 'datagrams_sent',
+                                     'bytes_sent', 'send_errors'), 0)
+
+        if sock is not None:
+            self._sock.setblocking(0)
+            self.set_local_addr(self._sock.getsockname())
+            try:
+                self.__peer_addr = self._sock.getpeername()
+            except socket.error as err:
+                if err.args[0] != errno.ENOTCONN:
+                    raise
+        self.want_read(True)
+
+    def initialize(self, local_addr = None, peer_addr = None,
+                   reuse_addr = False, reuse_port = False):
+        '''Creates a non-blocking UDP socket, an IPv6 one if the host of
+        `local_addr' (or `peer_addr') is an IPv6 address.
+
+        Args:
+          local_addr: local address to bind to
+          peer_addr:  if not None, the socket is connected to it, viz. only
+                      datagrams from it are received, and sendto() may omit
+                      the destination
+          reuse_addr: whether to set socket option SO_REUSEADDR or not
+          reuse_port: whether to set socket option SO_REUSEPORT or not, e.g.
+                      to share the port among several worker processes
+        '''
+
+        self.socket(_address_family(local_addr or peer_addr), socket.SOCK_DGRAM)
+        if local_addr:
+            self.bind(local_addr, reuse_addr, reuse_port)
+        if peer_addr:
+            self.connect(peer_addr)
+        self.set_local_addr(self._sock.getsockname())
+
+    def connect(self, addr):
+        '''Sets the default destination, only datagrams from it are received
+        from now on.'''
+
+        self._sock.connect(addr)
+        self.__peer_addr = addr
+
+    def is_connected(self):
+        return self.__peer_addr is not None
+
+    def peer_addr_repr(self):
+        if not self.__peer_addr:
+            return "not_available"
+        if self.socket_family() == socket.AF_INET6:
+            return "[{:s}]:{:d}".format(self.__peer_addr[0], self.__peer_addr[1])
+        elif self.socket_family() == socket.AF_UNIX:
+            return _unix_addr_repr(self.__peer_addr)
+        return "{:s}:{:d}".format(self.__peer_addr[0], self.__peer_addr[1])
+
+    def __str__(self):
+        return "<%s.%s at %s {sock_fd:%d, sock_family:%s, sock_type:%s, local:%s, peer:%s, queued:%d}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            self.fileno(), self.socket_family_repr(), self.socket_type_repr(),
+            self.local_addr_repr(), self.peer_addr_repr(), len(self._send_queue))
+
+    def set_recv_budget(self, budget):
+        '''Sets max number of datagrams received per read event.'''
+
+        if budget <= 0:
+            raise ValueError("budget must be positive: {:d}".format(budget))
+        self._recv_budget = budget
+
+    def recv_budget(self):
+        return self._recv_budget
+
+    def set_max_datagram_size(self, size):
+        '''Sets the size of receive buffers, longer datagrams are truncated.
+
+        A small value (e.g. 2048 for telemetry datagrams) lets the buffer pool
+        use small slabs.
+        '''
+
+        if size <= 0:
+            raise ValueError("size must be positive: {:d}".format(size))
+        self._max_datagram_size = size
+
+    def stats(self):
+        '''Returns a dict of statistics:
+
+          recv_batches:       read events which received at least one datagram
+          datagrams_received: datagrams received
+          bytes_received:     bytes received
+          truncated:          datagrams longer than max datagram size
+          max_recv_batch:     largest number of datagrams received per event
+          last_recv_batch:    number of datagrams received by last event
+          send_batches:       write events (or sendto() calls) which sent at
+                              least one datagram
+          datagrams_sent:     datagrams sent
+          bytes_sent:         bytes sent
+          send_errors:        datagrams dropped because of errors
+          queued:             datagrams waiting to be sent
+        '''
+
+        result = dict(self._stats)
+        result['queued'] = len(self._send_queue)
+        return result
+
+    # 1. input
+
+    def handle_read(self):
+        pool = self.pollster().buffer_pool()
+        size = self._max_datagram_size
+        recvmsg_into = self._sock.recvmsg_into
+        batch = []
+        # 2-tuples of (slab, view of its first `size' bytes)
+        leased = []
+        truncated = 0
+        try:
+            while len(batch) < self._recv_budget:
+                slab = pool.lease(size)
+                buf = memoryview(slab)[:size]
+                leased.append((slab, buf))
+                try:
+                    nbytes, ancdata, flags, addr = recvmsg_into([buf], self._ancbufsize,
+                                                                   self._recv_flags)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionRefusedError as why:
+                    # ICMP port unreachable for a previous datagram
+                    self.log_info("fd {:d}, {:s}".format(self.fileno(), str(why)))
+                    continue
+                if flags & socket.MSG_TRUNC:
+                    truncated += 1
+                if ancdata or flags & socket.MSG_CTRUNC:
+                    self._handle_ancdata(ancdata, flags, addr)
+                batch.append((buf[:nbytes], addr))
+
+            if batch:
+                stats = self._stats
+                stats['recv_batches'] += 1
+                stats['datagrams_received'] += len(batch)
+                stats['bytes_received'] += sum(len(view) for (view, unused_addr) in batch)
+                stats['truncated'] += truncated
+                stats['last_recv_batch'] = len(batch)
+                stats['max_recv_batch'] = max(stats['max_recv_batch'], len(batch))
+                self.on_datagrams(batch)
+        finally:
+            for (view, unused_addr) in batch:
+                view.release()
+            for (slab, buf) in leased:
+                buf.release()
+                pool.release(slab)
+
+        if len(batch) >= self._recv_budget:
+            pollster = self.pollster(False)
+            if pollster and pollster.edge_triggered():
+                # no more read event for datagrams left pending
+                pollster.call_soon_threadsafe(self.__recv_more)
+
+    def __recv_more(self):
+        if self.pollster(False):
+            self.handle_read()
+
+    def _handle_ancdata(self, ancdata, flags, addr):
+        '''Called with ancillary data received along with a datagram, before
+        the datagram is passed to on_datagrams(). Classes setting _ancbufsize
+        must override it.'''
+
+        pass
+
+    def on_datagrams(self, batch):
+        '''Called with datagrams received by one read event.
+
+        Args:
+          batch: list of 2-tuples of (data, address), data is a memoryview
+                 only valid during this call
+        '''
+
+        for data, addr in batch:
+            self.on_datagram(data, addr)
+
+    def on_datagram(self, data, addr):
+        '''Called for each datagram received, see on_datagrams().'''
+
+        self.log_notice("{:s}.{:s}: using default on_datagram()".format(
+            self.__class__.__module__, self.__class__.__name__))
+
+    # 2. output
+
+    def sendto(self, data, addr = None):
+        '''Queues a datagram, which is sent with other queued ones once the
+        socket is writable.
+
+        Args:
+          data: bytes-like object, not copied, must not be modified until sent
+          addr: destination address, None if the socket is connected
+        '''
+
+        if addr is None and self.__peer_addr is None:
+            raise ValueError("destination address required, socket not connected")
+        self._queue_datagram(data, addr, None)
+
+    def _queue_datagram(self, data, addr, fds):
+        self._send_queue.append((data, addr, fds))
+        if len(self._send_queue) == 1:
+            self.want_write(True)
+
+    def flush(self):
+        '''Sends queued datagrams until the socket would block.
+
+        Returns:
+          Number of datagrams sent.
+        '''
+
+        queue = self._send_queue
+        sock = self._sock
+        stats = self._stats
+        sent = 0
+        while queue:
+            data, addr, fds = queue[0]
+            try:
+                if fds is not None:
+                    if addr is None:
+                        nbytes = sock.sendmsg([data], fds.ancdata())
+                    else:
+                        nbytes = sock.sendmsg([data], fds.ancdata(), 0, addr)
+                elif addr is None:
+                    nbytes = sock.send(data)
+                else:
+                    nbytes = sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as why:
+                # e.g. EMSGSIZE, ECONNREFUSED: drop this datagram
+                self.log_info("fd {:d}, dropping datagram to {:s}: {:s}".format(
+                    self.fileno(), str(addr), str(why)))
+                stats['send_errors'] += 1
+                queue.popleft()
+                if fds is not None:
+                    fds.release_fds()
+                continue
+            queue.popleft()
+            if fds is not None:
+                fds.release_fds()
+            sent += 1
+            stats['bytes_sent'] += nbytes
+
+        if sent:
+            stats['send_batches'] += 1
+            stats['datagrams_sent'] += sent
+        return sent
+
+    def handle_write(self):
+        self.flush()
+        if not self._send_queue:
+            self.want_write(False)
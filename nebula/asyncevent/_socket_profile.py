@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import socket
+import sys
+
+#------------------------------------------------------------------------------
+
+# not exported by the socket module, available since Linux 4.11
+_TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT',
+                                sys.platform.startswith('linux') and 30 or None)
+# named TCP_KEEPALIVE on macOS
+_TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+
+# roles of sockets a profile is applied to
+_ROLE_CLIENT = 'client'
+_ROLE_LISTENER = 'listener'
+_ROLE_ACCEPTED = 'accepted'
+
+class SocketProfile(object):
+    '''Declarative set of TCP socket options.
+
+    A profile is passed to TcpClientDispatcher.initialize() or
+    TcpServerDispatcher.initialize(), the latter applies it to the listening
+    socket, and to each connection accepted. Options are validated when the
+    profile is created; an option not supported by the platform, or rejected
+    by the kernel the first time it's set, is reported by report() and not
+    set on other sockets. A profile may be shared by any number of
+    dispatchers.
+
+    Options left None are not touched, viz. the system defaults are used.
+    '''
+
+    # mapping from option name to 3-tuple of (level, optname, roles)
+    _OPTIONS = {
+        'nodelay':            (socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        # set on listening sockets as well, so the TCP window scale is
+        # negotiated accordingly, and inherited by accepted sockets
+        'sndbuf':             (socket.SOL_SOCKET, socket.SO_SNDBUF,
+                               (_ROLE_CLIENT, _ROLE_LISTENER)),
+        'rcvbuf':             (socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               (_ROLE_CLIENT, _ROLE_LISTENER)),
+        'fastopen':           (socket.IPPROTO_TCP, getattr(socket, 'TCP_FASTOPEN', None),
+                               (_ROLE_LISTENER,)),
+        'fastopen_connect':   (socket.IPPROTO_TCP, _TCP_FASTOPEN_CONNECT,
+                               (_ROLE_CLIENT,)),
+        'defer_accept':       (socket.IPPROTO_TCP, getattr(socket, 'TCP_DEFER_ACCEPT', None),
+                               (_ROLE_LISTENER,)),
+        # not sticky, the kernel may leave quickack mode later
+        'quickack':           (socket.IPPROTO_TCP, getattr(socket, 'TCP_QUICKACK', None),
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        'keepalive':          (socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        'keepalive_idle':     (socket.IPPROTO_TCP, _TCP_KEEPIDLE,
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        'keepalive_interval': (socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPINTVL', None),
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        'keepalive_count':    (socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPCNT', None),
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        'user_timeout':       (socket.IPPROTO_TCP, getattr(socket, 'TCP_USER_TIMEOUT', None),
+                               (_ROLE_CLIENT, _ROLE_ACCEPTED)),
+        }
+
+    # order in which options are set, SO_KEEPALIVE before its parameters
+    _ORDER = ('sndbuf', 'rcvbuf', 'nodelay', 'quickack', 'keepalive',
+              'keepalive_idle', 'keepalive_interval', 'keepalive_count',
+              'user_timeout', 'fastopen', 'fastopen_connect', 'defer_accept')
+
+    ROLE_CLIENT = _ROLE_CLIENT
+    ROLE_LISTENER = _ROLE_LISTENER
+    ROLE_ACCEPTED = _ROLE_ACCEPTED
+
+    STATUS_NOT_APPLIED = 'not applied'
+    STATUS_OK = 'ok'
+    STATUS_UNSUPPORTED = 'unsupported'
+
+    def __init__(self, nodelay = None, sndbuf = None, rcvbuf = None,
+                 fastopen = None, defer_accept = None, quickack = None,
+                 keepalive = None, keepalive_idle = None,
+                 keepalive_interval = None, keepalive_count = None,
+                 user_timeout = None):
+        '''Creates a profile.
+
+        Args:
+          nodelay:            TCP_NODELAY, whether to disable Nagle's algorithm
+          sndbuf:             SO_SNDBUF, size of the send buffer in bytes
+          rcvbuf:             SO_RCVBUF, size of the receive buffer in bytes
+          fastopen:           TCP Fast Open: for servers, the max length of the
+                              queue of pending TFO requests (True for 16); for
+                              clients, any true value to send data in the SYN
+          defer_accept:       TCP_DEFER_ACCEPT, seconds a server waits for data
+                              before a connection is accepted
+          quickack:           TCP_QUICKACK, whether to send ACKs immediately
+          keepalive:          SO_KEEPALIVE, whether to probe idle connections;
+                              implied by the three keepalive_* parameters
+          keepalive_idle:     seconds of idleness before the first probe
+          keepalive_interval: seconds between probes
+          keepalive_count:    probes lost before the connection is dropped
+          user_timeout:       TCP_USER_TIMEOUT, seconds (as float) sent data
+                              may stay unacknowledged before the connection is
+                              dropped
+
+        Raises:
+          TypeError or ValueError if an argument is invalid.
+        '''
+
+        values = {}
+        for name, value in (('nodelay', nodelay), ('quickack', quickack),
+                            ('keepalive', keepalive)):
+            if value is not None:
+                values[name] = value and 1 or 0
+
+        for name, value in (('sndbuf', sndbuf), ('rcvbuf', rcvbuf),
+                            ('defer_accept', defer_accept),
+                            ('keepalive_idle', keepalive_idle),
+                            ('keepalive_interval', keepalive_interval),
+                            ('keepalive_count', keepalive_count)):
+            if value is not None:
+                values[name] = self.__positive_int(name, value)
+
+        if fastopen is not None and fastopen is not False:
+            values['fastopen'] = fastopen is True and 16 \
+                                 or self.__positive_int('fastopen', fastopen)
+            values['fastopen_connect'] = 1
+
+        if user_timeout is not None:
+            if user_timeout < 0:
+                raise ValueError("user_timeout must not be negative: {:s}".format(
+                    str(user_timeout)))
+            # in milliseconds
+            values['user_timeout'] = int(user_timeout * 1000)
+
+        if values.get('keepalive') is None \
+        and any(name in values for name in
+                ('keepalive_idle', 'keepalive_interval', 'keepalive_count')):
+            values['keepalive'] = 1
+
+        self._values = values
+        # mapping from option name to its status, see report()
+        self._status = {}
+        for name in values:
+            if self._OPTIONS[name][1] is None:
+                self._status[name] = self.STATUS_UNSUPPORTED
+            else:
+                self._status[name] = self.STATUS_NOT_APPLIED
+
+    @staticmethod
+    def __positive_int(name, value):
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise TypeError("{:s} must be an integer: {:s}".format(name, repr(value)))
+        if value <= 0:
+            raise ValueError("{:s} must be positive: {:d}".format(name, value))
+        return value
+
+    @classmethod
+    def low_latency(cls, **kwargs):
+        '''Profile of latency-sensitive services, e.g. RPC: small writes are
+        sent at once, ACKs are not delayed.'''
+
+        options = dict(nodelay = True, quickack = True)
+        options.update(kwargs)
+        return cls(**options)
+
+    @classmethod
+    def bulk_transfer(cls, buffer_size = 4 * 1024 * 1024, **kwargs):
+        '''Profile of bulk transfers: large buffers, so the window is not
+        limited by them on links with a high bandwidth-delay product.'''
+
+        options = dict(nodelay = False, sndbuf = buffer_size, rcvbuf = buffer_size)
+        options.update(kwargs)
+        return cls(**options)
+
+    def options(self):
+        '''Returns a dict of options of this profile, mapping from names to
+        values passed to setsockopt().'''
+
+        return dict(self._values)
+
+    def report(self):
+        '''Returns a dict mapping from option names to their status: "ok",
+        "not applied" (not set on any socket yet), "unsupported" (by the
+        platform), or the error raised by setsockopt() the first time.'''
+
+        return dict(self._status)
+
+    def apply(self, sock, role, logger = None):
+        '''Sets the options of `role' on `sock'.
+
+        Args:
+          sock:   socket object
+          role:   ROLE_CLIENT (before connecting), ROLE_LISTENER (before
+                  listening), or ROLE_ACCEPTED
+          logger: object with log_info() and log_warning() methods, used to
+                  report an option the first time it's set, or failed
+        '''
+
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+
+        for name in self._ORDER:
+            if name not in self._values:
+                continue
+            level, optname, roles = self._OPTIONS[name]
+            if role not in roles:
+                continue
+            status = self._status[name]
+            if status not in (self.STATUS_OK, self.STATUS_NOT_APPLIED):
+                # validated already, don't try again
+                continue
+
+            try:
+                sock.setsockopt(level, optname, self._values[name])
+            except OSError as why:
+                self._status[name] = str(why)
+                if logger:
+                    logger.log_warning("fd {:d}, failed setting socket option {:s} to {:d}: {:s}".format(
+                        sock.fileno(), name, self._values[name], str(why)))
+                continue
+
+            if status == self.STATUS_NOT_APPLIED:
+                self._status[name] = self.STATUS_OK
+                if logger:
+                    logger.log_info("fd {:d}, socket option {:s} set to {:d}".format(
+                        sock.fileno(), name, self._values[name]))
+
+    def __str__(self):
+        return "<%s.%s at %s {%s}>" % (
+            self.__class__.__module__, self.__class__.__name__, hex(id(self)),
+            ", ".join("%s:%d" % (name, self._values[name])
+                      for name in self._ORDER if name in self._values))
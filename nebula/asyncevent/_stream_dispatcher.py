@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import errno
+import os
+
+from . import _socket_dispatcher
+
+#------------------------------------------------------------------------------
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 16
+
+# max bytes per call of os.sendfile()
+_SENDFILE_CHUNK = 1 << 30
+# bytes read per call of os.pread(), if os.sendfile() can't be used
+_COPY_CHUNK = 256 * 1024
+
+# errors meaning os.sendfile() does not support the pair of fds
+_SENDFILE_UNSUPPORTED = frozenset((errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                                   getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+                                   errno.ENOTSOCK))
+
+# errors meaning the peer has gone away
+_DISCONNECTED = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN,
+                           errno.ECONNABORTED, errno.EPIPE, errno.EBADF))
+
+# data carrying file descriptors, see UnixStreamDispatcher.send_fds()
+_FdsChunk = _socket_dispatcher._FdsChunk
+
+class _FileChunk(object):
+    '''Range of a file in the output queue, see send_file().'''
+
+    __slots__ = ('fileobj', 'fd', 'offset', 'remaining', 'count', 'progress',
+                 'use_sendfile', 'pending')
+
+    def __init__(self, fileobj, offset, count, progress):
+        self.fileobj = fileobj
+        self.fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.offset = offset
+        self.remaining = count
+        self.count = count
+        self.progress = progress
+        self.use_sendfile = hasattr(os, 'sendfile')
+        # data read by os.pread() but not written yet, if not use_sendfile
+        self.pending = None
+
+class _BufferedStreamMixin(object):
+    '''Output queue and input buffer of a buffered stream dispatcher.
+
+    The output queue holds memoryview objects, partially written buffers are
+    advanced by slicing their memoryview, which never copies the data. The
+    input buffer is a bytearray, data is read into its free space directly.
+
+    Flow control: once more than the high watermark is queued for output,
+    pause_writing() is called, and resume_writing() once the queue drained to
+    the low watermark. Two dispatchers can be paired (e.g. both sides of a
+    proxy) with pair_with(), then each stops reading while its peer's output
+    is paused. A limit of the input buffer stops reading while on_data()
+    leaves too much data unconsumed.
+
+    Classes using this mixin must also derive from Dispatcher, call
+    _init_buffers() in their constructor, and implement _write_buffers() and
+    _read_into().
+    '''
+
+    DEFAULT_READ_SIZE = 65536
+    DEFAULT_HIGH_WATERMARK = 64 * 1024
+
+    def _init_buffers(self, read_size = None):
+        self._read_size = read_size or self.DEFAULT_READ_SIZE
+        # pending output, items are memoryview objects
+        self._out_queue = collections.deque()
+        self._out_bytes = 0
+        # received but not consumed input is self._in_buf[_in_start:_in_end]
+        self._in_buf = bytearray(self._read_size)
+        self._in_start = 0
+        self._in_end = 0
+        self._close_when_done = False
+        # the peer has gone away, see handle_hup_event()
+        self._hung_up = False
+
+        # flow control
+        self._high_watermark = self.DEFAULT_HIGH_WATERMARK
+        self._low_watermark = self.DEFAULT_HIGH_WATERMARK // 4
+        self._writing_paused = False
+        self._reading_paused = False
+        self._read_buffer_limit = None
+        self._peer = None
+        # on_drain() is running, and whether it should be called again, see
+        # __drained()
+        self._in_drain = False
+        self._drained_again = False
+
+    # 1. low level I/O, implement these methods in derived classes
+
+    def _write_buffers(self, buffers):
+        '''Writes a list of buffers at once, returns number of bytes written.
+
+        Raises:
+          BlockingIOError if nothing could be written without blocking.
+        '''
+
+        raise NotImplementedError("{:s}.{:s}: _write_buffers() not implemented".format(
+            self.__class__.__module__, self.__class__.__name__))
+
+    def _write_buffers_with_fds(self, buffers, fds):
+        '''Like _write_buffers(), and passes file descriptors along with the
+        data, only implemented by AF_UNIX stream dispatchers.'''
+
+        raise NotImplementedError("{:s}.{:s}: _write_buffers_with_fds() not implemented".format(
+            self.__class__.__module__, self.__class__.__name__))
+
+    def _read_into(self, view):
+        '''Reads into a writable memoryview, returns number of bytes read, 0 at
+        end of file.
+
+        Raises:
+          BlockingIOError if no data is available.
+        '''
+
+        raise NotImplementedError("{:s}.{:s}: _read_into() not implemented".format(
+            self.__class__.__module__, self.__class__.__name__))
+
+    def _can_write(self):
+        '''Whether the stream is ready to be written to.'''
+
+        return True
+
+    # 2. output
+
+    def write(self, data):
+        '''Queues data to be written, and tries to write it immediately.
+
+        Args:
+          data: bytes-like object, must not be modified until written, since
+                it is not copied
+        '''
+
+        if self._close_when_done:
+            raise ValueError("write() after close_when_done()")
+        view = memoryview(data).cast('B')
+        if not len(view):
+            return
+        self._out_queue.append(view)
+        self._out_bytes += len(view)
+        self.__flush_and_update()
+
+    def writelines(self, list_of_data):
+        '''Queues several buffers, which are written with a single call if
+        possible.'''
+
+        if self._close_when_done:
+            raise ValueError("writelines() after close_when_done()")
+        queue = self._out_queue
+        for data in list_of_data:
+            view = memoryview(data).cast('B')
+            if len(view):
+                queue.append(view)
+                self._out_bytes += len(view)
+        self.__flush_and_update()
+
+    def _write_with_fds(self, data, fds, close_fds):
+        '''Queues data carrying file descriptors, see
+        UnixStreamDispatcher.send_fds().'''
+
+        if self._close_when_done:
+            raise ValueError("send_fds() after close_when_done()")
+        view = memoryview(data).cast('B')
+        if not len(view):
+            # ancillary data can't be sent without data
+            raise ValueError("at least one byte must be sent along with fds")
+        self._out_queue.append(_FdsChunk(view, list(fds), close_fds))
+        self._out_bytes += len(view)
+        self.__flush_and_update()
+
+    def send_file(self, fileobj, offset = 0, count = None, progress = None):
+        '''Queues a range of a file to be written, with os.sendfile(), so the
+        data is never copied into user space.
+
+        The file is not closed after written. If os.sendfile() can't be used
+        (e.g. not available, or not supported for the file), the data is read
+        with os.pread() and written as usual.
+
+        Args:
+          fileobj:  file object (or file descriptor) of a regular file, must
+                    not be closed until written
+          offset:   offset of the first byte to be written
+          count:    number of bytes to be written, None to write until the end
+                    of the file
+          progress: optional callable, called as `progress(sent, count)' each
+                    time some data of the range was written
+
+        If the file is shorter than expected, EOFError is passed to
+        handle_error(), which closes the stream by default, whether it was
+        found by the write event handler, or by a later call of write() (or a
+        similar method).
+        '''
+
+        if self._close_when_done:
+            raise ValueError("send_file() after close_when_done()")
+        if offset < 0:
+            raise ValueError("offset must not be negative: {:d}".format(offset))
+        chunk = _FileChunk(fileobj, offset, count, progress)
+        if count is None:
+            chunk.remaining = chunk.count = max(0, os.fstat(chunk.fd).st_size - offset)
+        elif count < 0:
+            raise ValueError("count must not be negative: {:d}".format(count))
+        if not chunk.count:
+            return
+        self._out_queue.append(chunk)
+        self.__flush_and_update()
+
+    def get_write_buffer_size(self):
+        '''Number of bytes queued in memory but not yet written, file ranges
+        queued by send_file() are not counted.'''
+
+        return self._out_bytes
+
+    def close_when_done(self):
+        '''Closes the stream after all queued data was written.'''
+
+        self._close_when_done = True
+        if not self._out_queue:
+            self.handle_close()
+
+    def flush(self):
+        '''Writes as much queued data as possible without blocking.
+
+        Returns:
+          Number of bytes written.
+        '''
+
+        queue = self._out_queue
+        total = 0
+        while queue:
+            if isinstance(queue[0], _FdsChunk):
+                chunk = queue[0]
+                try:
+                    sent = self._write_buffers_with_fds([chunk.view], chunk.fd_numbers())
+                except (BlockingIOError, InterruptedError):
+                    break
+                # the descriptors went along with the first byte
+                chunk.release_fds()
+                total += sent
+                self._out_bytes -= sent
+                if sent < len(chunk.view):
+                    queue[0] = chunk.view[sent:]
+                    break
+                queue.popleft()
+                continue
+
+            if isinstance(queue[0], _FileChunk):
+                try:
+                    sent = self.__write_file_chunk(queue[0])
+                except (BlockingIOError, InterruptedError):
+                    break
+                total += sent
+                if queue[0].remaining:
+                    break
+                queue.popleft()
+                continue
+
+            buffers = []
+            for item in queue:
+                if isinstance(item, (_FileChunk, _FdsChunk)) or len(buffers) == _IOV_MAX:
+                    break
+                buffers.append(item)
+            try:
+                sent = self._write_buffers(buffers)
+            except (BlockingIOError, InterruptedError):
+                break
+
+            total += sent
+            self._out_bytes -= sent
+            short_write = sent < sum(len(view) for view in buffers)
+            while sent:
+                head = queue[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    queue.popleft()
+                else:
+                    queue[0] = head[sent:]
+                    sent = 0
+            if short_write:
+                # the kernel buffer is full
+                break
+        return total
+
+    def __write_file_chunk(self, chunk):
+        sent = 0
+        if chunk.use_sendfile:
+            try:
+                sent = os.sendfile(self.fileno(), chunk.fd, chunk.offset,
+                                   min(chunk.remaining, _SENDFILE_CHUNK))
+            except OSError as why:
+                if why.errno not in _SENDFILE_UNSUPPORTED or chunk.remaining != chunk.count:
+                    raise
+                self.log_info("fd {:d}, sendfile() not supported, copying: {:s}".format(
+                    self.fileno(), str(why)))
+                chunk.use_sendfile = False
+
+        if not chunk.use_sendfile:
+            if not chunk.pending:
+                chunk.pending = memoryview(os.pread(chunk.fd,
+                                                    min(chunk.remaining, _COPY_CHUNK),
+                                                    chunk.offset))
+            if chunk.pending:
+                sent = self._write_buffers([chunk.pending])
+                chunk.pending = chunk.pending[sent:]
+
+        if not sent:
+            raise EOFError("fd {:d} ended at offset {:d}, {:d} bytes missing".format(
+                chunk.fd, chunk.offset, chunk.remaining))
+
+        chunk.offset += sent
+        chunk.remaining -= sent
+        if chunk.progress is not None:
+            chunk.progress(chunk.count - chunk.remaining, chunk.count)
+        return sent
+
+    def __flush_and_update(self):
+        if self._can_write():
+            try:
+                self.flush()
+            except OSError as why:
+                self.__handle_io_error(why)
+                return
+            except EOFError as why:
+                # the file of send_file() is too short, as if found by the
+                # write event handler
+                self.handle_error(why)
+                return
+        if self._out_queue:
+            if not self.writable():
+                self.want_write(True)
+            self.__update_write_pressure()
+            return
+        if self._close_when_done:
+            self.handle_close()
+            return
+        if self.writable():
+            self.want_write(False)
+        self.__update_write_pressure()
+        self.__drained()
+
+    def handle_write(self):
+        try:
+            self.flush()
+        except OSError as why:
+            self.__handle_io_error(why)
+            return
+
+        if not self._out_queue:
+            self.want_write(False)
+            if self._close_when_done:
+                self.handle_close()
+                return
+            self.__update_write_pressure()
+            self.__drained()
+        else:
+            self.__update_write_pressure()
+
+    def __drained(self):
+        # on_drain() may call write(), the data of which may be written at
+        # once, draining the queue again: loop instead of recursing. Not
+        # called once closed (or before registered).
+        if self._in_drain:
+            self._drained_again = True
+            return
+        self._in_drain = True
+        try:
+            self._drained_again = True
+            while self._drained_again and self.pollster(False):
+                self._drained_again = False
+                self.on_drain()
+        finally:
+            self._in_drain = False
+
+    def __update_write_pressure(self):
+        if self._writing_paused:
+            if self._out_bytes <= self._low_watermark:
+                self._writing_paused = False
+                self.resume_writing()
+        elif self._out_bytes > self._high_watermark:
+            self._writing_paused = True
+            self.pause_writing()
+
+    # 3. flow control
+
+    def set_write_buffer_limits(self, high = None, low = None):
+        '''Sets the watermarks of the output queue.
+
+        Args:
+          high: pause_writing() is called once more than `high' bytes are
+                queued, defaults to DEFAULT_HIGH_WATERMARK
+          low:  resume_writing() is called once at most `low' bytes are
+                queued, defaults to a quarter of `high'
+        '''
+
+        if high is None:
+            high = self.DEFAULT_HIGH_WATERMARK if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not 0 <= low <= high:
+            raise ValueError("invalid watermarks, high {:d}, low {:d}".format(high, low))
+        self._high_watermark = high
+        self._low_watermark = low
+        self.__update_write_pressure()
+
+    def get_write_buffer_limits(self):
+        '''Returns 2-tuple of (low, high) watermarks.'''
+
+        return self._low_watermark, self._high_watermark
+
+    def set_read_buffer_limit(self, limit):
+        '''Stops reading while `limit' or more received bytes are not consumed
+        by on_data(), None for no limit. Call resume_reading() once on_data()
+        is ready to consume more; it is called again with the pending data.
+        '''
+
+        if limit is not None and limit <= 0:
+            raise ValueError("limit must be positive: {:d}".format(limit))
+        self._read_buffer_limit = limit
+
+    def pair_with(self, peer):
+        '''Pairs with another buffered stream dispatcher, each of them stops
+        reading while the output of the other one is paused.
+
+        Args:
+          peer: the other dispatcher, or None to dissolve the pair
+        '''
+
+        if self._peer is not None:
+            old_peer = self._peer
+            old_peer._peer = None
+            if old_peer._writing_paused:
+                self.resume_reading()
+            if self._writing_paused:
+                # paused by this dispatcher, see pause_writing()
+                old_peer.resume_reading()
+        self._peer = peer
+        if peer is not None:
+            peer._peer = self
+            if peer._writing_paused:
+                self.pause_reading()
+            if self._writing_paused:
+                peer.pause_reading()
+
+    def peer(self):
+        return self._peer
+
+    def is_writing_paused(self):
+        return self._writing_paused
+
+    def is_reading_paused(self):
+        return self._reading_paused
+
+    def pause_reading(self):
+        '''Stops reading from the stream, until resume_reading() is called.'''
+
+        if self._reading_paused:
+            return
+        self._reading_paused = True
+        self.want_read(False)
+
+    def resume_reading(self):
+        '''Starts reading again, after pause_reading().'''
+
+        if not self._reading_paused:
+            return
+        self._reading_paused = False
+        self.want_read(True)
+        pollster = self.pollster(False)
+        if pollster and (self._in_end > self._in_start or pollster.edge_triggered()):
+            # Deliver pending input (and in edge-triggered mode, read data
+            # arrived meanwhile, since there won't be another read event) at
+            # the end of this iteration, not from within the caller.
+            pollster.call_soon_threadsafe(self.__resume_pending)
+
+    def __resume_pending(self):
+        if self._reading_paused or not self.pollster(False):
+            return
+        if self._in_end > self._in_start:
+            self.__deliver()
+            if not self.pollster(False) or self.__input_full():
+                return
+        if self.pollster().edge_triggered():
+            self.handle_read()
+
+    def __input_full(self):
+        limit = self._read_buffer_limit
+        if limit is not None and self._in_end - self._in_start >= limit:
+            self.pause_reading()
+            return True
+        return False
+
+    # 4. input
+
+    def handle_read(self):
+        if self._reading_paused:
+            # edge-triggered mode, reading is resumed by resume_reading()
+            return
+        edge_triggered = self.pollster().edge_triggered()
+        while True:
+            if self.__input_full():
+                return
+            buf = self._in_buf
+            if len(buf) - self._in_end < self._read_size:
+                self.__make_room()
+                buf = self._in_buf
+
+            end = len(buf)
+            if self._read_buffer_limit is not None:
+                end = min(end, self._in_start + self._read_buffer_limit)
+            try:
+                with memoryview(buf) as view:
+                    received = self._read_into(view[self._in_end:end])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as why:
+                self.__handle_io_error(why)
+                return
+
+            if not received:
+                self.on_eof()
+                return
+
+            self._in_end += received
+            self.__deliver()
+            if not self.pollster(False) or self._reading_paused:
+                # closed or paused by on_data()
+                return
+            # in level-triggered mode, read again only if more data is likely
+            if not edge_triggered and not self._hung_up \
+            and self._in_end < len(self._in_buf):
+                return
+
+    def handle_hup_event(self):
+        # The peer has gone away, but data sent before might not be read yet
+        # (e.g. AF_UNIX stream sockets report HUP as soon as the peer closed):
+        # deliver all of it, on_eof() is called at the end as usual.
+        self._hung_up = True
+        self.handle_read()
+        if self.pollster(False):
+            # reading is paused, or on_eof() kept the stream open; HUP would
+            # be reported again and again
+            self.handle_close()
+
+    def __make_room(self):
+        buf = self._in_buf
+        unread = self._in_end - self._in_start
+        if self._in_start:
+            # move unconsumed data to the front
+            buf[:unread] = buf[self._in_start:self._in_end]
+            self._in_start, self._in_end = 0, unread
+        if len(buf) - self._in_end < self._read_size:
+            buf.extend(bytes(self._read_size - (len(buf) - self._in_end)))
+
+    def __deliver(self):
+        with memoryview(self._in_buf) as view:
+            data = view[self._in_start:self._in_end]
+            try:
+                consumed = self.on_data(data)
+            finally:
+                data.release()
+
+        if consumed is None:
+            consumed = self._in_end - self._in_start
+        self._in_start += consumed
+        if self._in_start >= self._in_end:
+            self._in_start = self._in_end = 0
+            if len(self._in_buf) > self._read_size:
+                # shrink after a large message
+                del self._in_buf[self._read_size:]
+
+    def unread_bytes(self):
+        '''Number of bytes received but not yet consumed by on_data().'''
+
+        return self._in_end - self._in_start
+
+    # 5. callbacks, implement these methods in derived classes
+
+    def on_data(self, data):
+        '''Called when data was received.
+
+        Args:
+          data: memoryview of all received but not yet consumed data, only
+                valid during this call
+
+        Returns:
+          Number of bytes consumed, None if all. Bytes not consumed are passed
+          again to the next call, together with newly received data.
+        '''
+
+        self.log_notice("{:s}.{:s}: using default on_data()".format(
+            self.__class__.__module__, self.__class__.__name__))
+        return None
+
+    def on_eof(self):
+        '''Called when the peer closed the stream, closes it by default.'''
+
+        self.handle_close()
+
+    def on_drain(self):
+        '''Called when all queued data was written, either by write() (or a
+        similar method) at once, or once the stream became writable.'''
+
+        pass
+
+    def pause_writing(self):
+        '''Called when the output queue grew above the high watermark.
+
+        By default pauses reading of the paired dispatcher (if any), producers
+        not paired should override it and stop calling write().
+        '''
+
+        if self._peer is not None:
+            self._peer.pause_reading()
+
+    def resume_writing(self):
+        '''Called when the output queue drained to the low watermark, after
+        pause_writing() was called.'''
+
+        if self._peer is not None:
+            self._peer.resume_reading()
+
+    def __handle_io_error(self, why):
+        if why.errno in _DISCONNECTED:
+            self.log_info("fd {:d}, connection lost: {:s}".format(self.fileno(),
+                                                                  str(why)))
+            self.handle_close()
+        else:
+            raise why
+
+    def _release_buffers(self):
+        for item in self._out_queue:
+            if isinstance(item, _FdsChunk):
+                item.release_fds()
+        self._out_queue.clear()
+        self._out_bytes = 0
+        self._in_start = self._in_end = 0
+        if self._writing_paused:
+            # don't leave the peer paused forever
+            self._writing_paused = False
+            self.resume_writing()
+        if self._peer is not None:
+            self._peer._peer = None
+            self._peer = None
+
+#------------------------------------------------------------------------------
+
+class BufferedStreamDispatcher(_BufferedStreamMixin,
+                               _socket_dispatcher.TcpClientDispatcher):
+    '''TCP client dispatcher with buffered input and output.
+
+    Data passed to write() is queued, and written with sendmsg(), several
+    buffers at once; interest in write events is managed automatically. Data
+    received is accumulated in a bytearray, and passed to on_data().
+
+    Usage:
+      Derive from this class, override on_data() (and optionally on_eof(),
+      on_drain()), and call write() to send data.
+    '''
+
+    def __init__(self, sock = None, log_handle = None, read_size = None):
+        _socket_dispatcher.TcpClientDispatcher.__init__(self, sock = sock,
+                                                        log_handle = log_handle)
+        self._init_buffers(read_size)
+        self.want_read(True)
+
+    def _write_buffers(self, buffers):
+        return self._sock.sendmsg(buffers)
+
+    def _read_into(self, view):
+        return self._sock.recv_into(view)
+
+    def _can_write(self):
+        return self.is_connected()
+
+    def handle_write_event(self, call_user_func = True):
+        connected = self.is_connected()
+        _socket_dispatcher.TcpClientDispatcher.handle_write_event(self, call_user_func)
+        if not connected and self._out_queue and call_user_func:
+            # data queued while connecting, in edge-triggered mode there won't
+            # be another write event
+            self.handle_write()
+
+    def handle_close(self):
+        self._release_buffers()
+        _socket_dispatcher.TcpClientDispatcher.handle_close(self)
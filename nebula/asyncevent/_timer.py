@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import heapq
+import itertools
+import time
+
+class _HeapTimerQueue(object):
+    '''Priority queue of timers, each timer is identified by a hashable key.
+
+    Every key has at most one live timer. Arming a key which already has a
+    timer replaces it, cancelling removes it; both operations never search the
+    heap. Instead each heap entry carries a generation number, and entries
+    whose generation does not match the live one are discarded lazily when
+    they reach the top of the heap.
+
+    Complexity: push() O(log n), cancel() O(1), peek() amortized O(1).
+    '''
+
+    # rebuild the heap if it holds this many stale entries per live entry
+    _COMPACT_RATIO = 2
+    _COMPACT_MIN_SIZE = 64
+
+    def __init__(self):
+        # items are 3-tuples of (deadline, generation, key), generation is
+        # unique, so keys are never compared with each other
+        self._heap = []
+        # mapping from key to 2-tuple of (deadline, generation) of live timer
+        self._live = {}
+        self._generation = itertools.count()
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key):
+        return key in self._live
+
+    def deadline(self, key):
+        '''Returns deadline of the timer identified by key, or None.'''
+
+        try:
+            return self._live[key][0]
+        except KeyError:
+            return None
+
+    def push(self, key, deadline):
+        '''Arms (or re-arms) the timer identified by key.
+
+        Args:
+          key:      hashable object identifying the timer
+          deadline: absolute time in seconds (as float) since the Epoch
+        '''
+
+        generation = next(self._generation)
+        self._live[key] = (deadline, generation)
+        heapq.heappush(self._heap, (deadline, generation, key))
+
+        if len(self._heap) > self._COMPACT_MIN_SIZE + \
+                              self._COMPACT_RATIO * len(self._live):
+            self.__compact()
+
+    def cancel(self, key):
+        '''Cancels the timer identified by key.
+
+        Returns:
+          True if the timer existed, False otherwise.
+        '''
+
+        return self._live.pop(key, None) is not None
+
+    def peek(self):
+        '''Returns the nearest deadline, or None if there's no timer.'''
+
+        heap = self._heap
+        live = self._live
+        while heap:
+            deadline, generation, key = heap[0]
+            item = live.get(key)
+            if item is not None and item[1] == generation:
+                return deadline
+            heapq.heappop(heap)
+        return None
+
+    def pop_due(self, now, limit = None):
+        '''Removes timers expired at `now'.
+
+        Args:
+          now:   current time in seconds (as float) since the Epoch
+          limit: max number of timers to be removed, None for no limit
+
+        Returns:
+          List of keys of the expired timers, ordered by deadline.
+        '''
+
+        heap = self._heap
+        live = self._live
+        due = []
+        while heap and heap[0][0] <= now:
+            if limit is not None and len(due) >= limit:
+                break
+            deadline, generation, key = heapq.heappop(heap)
+            item = live.get(key)
+            if item is not None and item[1] == generation:
+                del live[key]
+                due.append(key)
+        return due
+
+    def __compact(self):
+        self._heap = [(deadline, generation, key)
+                      for (key, (deadline, generation)) in self._live.items()]
+        heapq.heapify(self._heap)
+
+#------------------------------------------------------------------------------ 
+
+class _TimingWheel(object):
+    '''Hashed timing wheel, each timer is identified by a hashable key.
+
+    Time is divided into ticks of `resolution' seconds, and a timer lands in
+    the slot of the first tick at (or after) its deadline, modulo the number
+    of slots. Timers further away than one revolution share slots with nearer
+    ones, and are skipped until their tick is reached.
+
+    Timers never fire early, but may fire up to one tick late; timers fired in
+    the same call of pop_due() are not ordered by deadline.
+
+    Complexity: push() O(1), cancel() O(1), peek() O(num_slots) in the worst
+    case, but O(1) if the wheel is densely populated.
+    '''
+
+    def __init__(self, resolution = 0.1, num_slots = 512, now = None):
+        '''Creates a timing wheel.
+
+        Args:
+          resolution: (float) length of one tick, in seconds
+          num_slots:  (int)   number of slots of the wheel
+          now:        current time in seconds (as float) since the Epoch, use
+                      current time stamp if value is None
+        '''
+
+        if resolution <= 0:
+            raise ValueError("resolution must be positive: {:f}".format(resolution))
+        if num_slots <= 0:
+            raise ValueError("num_slots must be positive: {:d}".format(num_slots))
+
+        self._resolution = float(resolution)
+        self._num_slots = num_slots
+        # each slot is a mapping from key to its tick
+        self._slots = [{} for unused_idx in range(num_slots)]
+        # mapping from key to 2-tuple of (tick, deadline) of live timer
+        self._live = {}
+        # last tick processed by pop_due()
+        self._cursor = int((now is None and time.time() or now) // self._resolution)
+        # cached result of peek(), a lower bound of the nearest tick of live
+        # timers, or None if unknown
+        self._nearest_tick = None
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key):
+        return key in self._live
+
+    def resolution(self):
+        return self._resolution
+
+    def deadline(self, key):
+        '''Returns deadline of the timer identified by key, or None.'''
+
+        try:
+            return self._live[key][1]
+        except KeyError:
+            return None
+
+    def push(self, key, deadline):
+        '''Arms (or re-arms) the timer identified by key.
+
+        Args:
+          key:      hashable object identifying the timer
+          deadline: absolute time in seconds (as float) since the Epoch
+        '''
+
+        item = self._live.get(key)
+        if item is not None:
+            del self._slots[item[0] % self._num_slots][key]
+
+        tick = -int(-deadline // self._resolution)  # ceil()
+        if tick <= self._cursor:
+            tick = self._cursor + 1
+        self._live[key] = (tick, deadline)
+        self._slots[tick % self._num_slots][key] = tick
+        if self._nearest_tick is not None and tick < self._nearest_tick:
+            self._nearest_tick = tick
+
+    def cancel(self, key):
+        '''Cancels the timer identified by key.
+
+        Returns:
+          True if the timer existed, False otherwise.
+        '''
+
+        item = self._live.pop(key, None)
+        if item is None:
+            return False
+        del self._slots[item[0] % self._num_slots][key]
+        return True
+
+    def peek(self):
+        '''Returns a time at which pop_due() should be called next, or None if
+        there's no timer.
+
+        The returned value is the boundary of a tick not later than the nearest
+        deadline. Cancelling timers does not update the cached result, so an
+        early (and harmless) wakeup is possible.
+        '''
+
+        if not self._live:
+            return None
+
+        if self._nearest_tick is None:
+            slots = self._slots
+            num_slots = self._num_slots
+            first = self._cursor + 1
+            # a live timer is always in one of the slots
+            self._nearest_tick = first
+            for tick in range(first, first + num_slots):
+                if slots[tick % num_slots]:
+                    self._nearest_tick = tick
+                    break
+        return self._nearest_tick * self._resolution
+
+    def pop_due(self, now, limit = None):
+        '''Removes timers expired at `now'.
+
+        Args:
+          now:   current time in seconds (as float) since the Epoch
+          limit: max number of timers to be removed, None for no limit
+
+        Returns:
+          List of keys of the expired timers.
+        '''
+
+        now_tick = int(now // self._resolution)
+        if now_tick <= self._cursor:
+            return []
+
+        slots = self._slots
+        num_slots = self._num_slots
+        # if we were idle for more than one revolution, every slot is visited
+        # exactly once
+        first = max(self._cursor + 1, now_tick - num_slots + 1)
+
+        due = []
+        live = self._live
+        for tick in range(first, now_tick + 1):
+            slot = slots[tick % num_slots]
+            if slot:
+                expired = [key for (key, key_tick) in slot.items() if key_tick <= now_tick]
+                if limit is not None and len(due) + len(expired) > limit:
+                    # this slot will be visited again by next call
+                    expired = expired[:limit - len(due)]
+                    tick -= 1
+                for key in expired:
+                    del slot[key]
+                    del live[key]
+                due.extend(expired)
+            self._cursor = tick
+            if limit is not None and len(due) >= limit:
+                break
+
+        if self._nearest_tick is not None and self._nearest_tick <= self._cursor:
+            self._nearest_tick = None
+        return due
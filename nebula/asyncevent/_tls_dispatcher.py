@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import ssl
+import threading
+import time
+
+from . import _socket_dispatcher
+from . import _stream_dispatcher
+
+#------------------------------------------------------------------------------
+
+# max size of plaintext per TLS record
+_TLS_RECORD_SIZE = 16384
+
+# states of TlsStreamDispatcher
+_PLAIN = 'plain'
+_HANDSHAKING = 'handshaking'
+_ESTABLISHED = 'established'
+
+# mapping from configuration to SSLContext, in order of last use, see
+# tls_context()
+_contexts = collections.OrderedDict()
+_contexts_lock = threading.Lock()
+_MAX_CONTEXTS = 64
+
+def tls_context(server_side = False, certfile = None, keyfile = None,
+                cafile = None, capath = None, verify = True,
+                alpn_protocols = None, ciphers = None):
+    '''Returns the SSLContext of a configuration, created the first time it's
+    asked for, and shared by all callers afterwards.
+
+    Sharing a context matters: certificates are loaded once, and a server can
+    resume only sessions whose tickets were issued by the same context (for
+    PreforkServer, create it in the master process, so workers share the
+    ticket keys). Files are not read again once the context was created.
+    At most 64 configurations are cached, the least recently used one is
+    dropped (dispatchers using its context keep it); the cache may be used by
+    threads running different AsyncEvent objects.
+
+    Args:
+      server_side:    True for a context of servers
+      certfile:       certificate chain (PEM) of this side, required for
+                      servers, optional for clients
+      keyfile:        private key of `certfile', None if included in it
+      cafile:         CA certificates (PEM) verifying the peer; for servers,
+                      client certificates are required if given
+      capath:         directory of CA certificates, see cafile
+      verify:         False to accept any server certificate (clients only)
+      alpn_protocols: sequence of ALPN protocol names, e.g. ('h2', 'http/1.1')
+      ciphers:        OpenSSL cipher list of TLS 1.2 and earlier
+    '''
+
+    key = (server_side, certfile, keyfile, cafile, capath, verify and True or False,
+           alpn_protocols and tuple(alpn_protocols) or None, ciphers)
+    # held while creating the context, so concurrent callers share one
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context is None:
+            context = _create_context(*key)
+            _contexts[key] = context
+            while len(_contexts) > _MAX_CONTEXTS:
+                _contexts.popitem(last = False)
+        else:
+            _contexts.move_to_end(key)
+        return context
+
+def _create_context(server_side, certfile, keyfile, cafile, capath, verify,
+                    alpn_protocols, ciphers):
+    if server_side:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH,
+                                             cafile = cafile, capath = capath)
+        if cafile or capath:
+            context.verify_mode = ssl.CERT_REQUIRED
+    else:
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH,
+                                             cafile = cafile, capath = capath)
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    if alpn_protocols:
+        context.set_alpn_protocols(list(alpn_protocols))
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return context
+
+class TlsSessionCache(object):
+    '''Client side cache of TLS sessions, so a connection to a peer seen
+    before resumes the previous session instead of a full handshake (about
+    half the CPU time of a handshake is saved, on both sides).
+
+    Sessions are keyed by (context, host, port, server name), and evicted in
+    LRU order once `capacity' is exceeded, or when expired. A capacity of 0
+    disables resumption.
+    '''
+
+    DEFAULT_CAPACITY = 1024
+
+    def __init__(self, capacity = DEFAULT_CAPACITY):
+        if capacity < 0:
+            raise ValueError("capacity must not be negative: {:d}".format(capacity))
+        self._capacity = capacity
+        self._sessions = collections.OrderedDict()
+        self._stats = dict.fromkeys(('hits', 'misses', 'expired', 'stored',
+                                     'resumed', 'full_handshakes'), 0)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, key):
+        '''Returns the SSLSession cached for `key', None if not found.'''
+
+        if not self._capacity:
+            return None
+        session = self._sessions.get(key)
+        if session is not None and session.time + session.timeout <= time.time():
+            del self._sessions[key]
+            self._stats['expired'] += 1
+            session = None
+        if session is None:
+            self._stats['misses'] += 1
+            return None
+        self._sessions.move_to_end(key)
+        self._stats['hits'] += 1
+        return session
+
+    def put(self, key, session):
+        if not self._capacity:
+            return
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        self._stats['stored'] += 1
+        while len(self._sessions) > self._capacity:
+            self._sessions.popitem(last = False)
+
+    def discard(self, key):
+        '''Forgets the session of `key', e.g. after a failed handshake.'''
+
+        self._sessions.pop(key, None)
+
+    def record_handshake(self, resumed):
+        self._stats[resumed and 'resumed' or 'full_handshakes'] += 1
+
+    def stats(self):
+        '''Returns a dict of statistics: hits, misses, expired, stored,
+        resumed (handshakes) and full_handshakes, and size.'''
+
+        result = dict(self._stats)
+        result['size'] = len(self._sessions)
+        return result
+
+# used by TlsStreamDispatcher if no cache is given
+_shared_session_cache = TlsSessionCache()
+
+#------------------------------------------------------------------------------
+
+class TlsStreamDispatcher(_stream_dispatcher.BufferedStreamDispatcher):
+    '''Buffered TLS stream dispatcher, of either side of a connection: the
+    client side connecting, or the server side of a connection accepted by
+    TlsServerDispatcher.
+
+    As a client, initialize() and connect() work as for TcpClientDispatcher;
+    once connected, the TLS handshake is driven without blocking, waiting for
+    read or write events as asked by OpenSSL. On the server side, create it
+    with an accepted socket, and the context of TlsServerDispatcher.
+
+    Data written before the handshake completed is queued, on_handshake() is
+    called once it completed. Sessions of clients are cached (see
+    TlsSessionCache), and resumed by the next connection to the same peer.
+
+    Usage:
+      >>> context = tls_context(cafile = 'ca.pem')
+      >>> client = MyTlsDispatcher(context = context)
+      >>> client.initialize(('backend.example', 443))
+      >>> ae.register(client)
+    '''
+
+    def __init__(self, sock = None, context = None, server_side = False,
+                 server_hostname = None, session_cache = None,
+                 log_handle = None, read_size = None):
+        '''Creates a TLS stream dispatcher.
+
+        Args:
+          sock:            a connected socket (e.g. accepted), or None to
+                           create one with initialize()
+          context:         SSLContext, see tls_context(); the default client
+                           context if None
+          server_side:     True for connections accepted by a server
+          server_hostname: name sent with SNI, and matched against the
+                           certificate; the host passed to connect() if None
+          session_cache:   TlsSessionCache of clients, a cache shared by all
+                           dispatchers if None
+          log_handle:      a log handle to be used, None to disable logging
+          read_size:       see BufferedStreamDispatcher
+        '''
+
+        if context is None:
+            if server_side:
+                raise ValueError("a context is required on the server side")
+            context = tls_context()
+        self.__context = context
+        self.__server_side = server_side
+        self.__server_hostname = server_hostname
+        self.__session_cache = session_cache is None and _shared_session_cache \
+                               or session_cache
+        self.__session_key = None
+        self.__session_stored = False
+
+        # set before the base class declares its interest, see want_read()
+        self.__state = _PLAIN
+        # what do_handshake() is waiting for
+        self.__handshake_wants_read = server_side
+        # SSL_read() or SSL_write() waiting for the other direction
+        self.__read_wants_write = False
+        self.__write_wants_read = False
+        # size of the record SSL_write() must be retried with
+        self.__write_retry = 0
+        # interest declared by the buffered stream
+        self.__stream_wants_read = False
+        self.__stream_wants_write = False
+
+        _stream_dispatcher.BufferedStreamDispatcher.__init__(self, sock = sock,
+                                                             log_handle = log_handle,
+                                                             read_size = read_size)
+
+        if sock is not None and self.is_connected():
+            self.__wrap()
+
+    def tls_context(self):
+        return self.__context
+
+    def is_established(self):
+        '''Whether the TLS handshake completed.'''
+
+        return self.__state == _ESTABLISHED
+
+    def session_reused(self):
+        '''Whether the handshake resumed a previous session.'''
+
+        return self.__state == _ESTABLISHED and self._sock.session_reused
+
+    def connect(self, addr, timeout = None):
+        if self.__server_hostname is None:
+            self.__server_hostname = addr[0]
+        self.__session_key = (self.__context, addr[0], addr[1], self.__server_hostname)
+        return _stream_dispatcher.BufferedStreamDispatcher.connect(self, addr, timeout)
+
+    def __wrap(self):
+        session = None
+        if not self.__server_side and self.__session_key is not None:
+            session = self.__session_cache.get(self.__session_key)
+        self._sock = self.__context.wrap_socket(
+            self._sock, server_side = self.__server_side,
+            server_hostname = (not self.__server_side) and self.__server_hostname or None,
+            do_handshake_on_connect = False, session = session)
+        self.__state = _HANDSHAKING
+        self.log_info("fd {:d}, starting TLS handshake{:s}".format(
+            self.fileno(), session is not None and ", resuming session" or ""))
+        self.__sync_interest()
+
+    def __handshake(self):
+        try:
+            self._sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.__handshake_wants_read = True
+            self.__sync_interest()
+            return
+        except ssl.SSLWantWriteError:
+            self.__handshake_wants_read = False
+            self.__sync_interest()
+            return
+        except (ssl.SSLError, OSError):
+            if self.__session_key is not None:
+                # a stale session might be the reason
+                self.__session_cache.discard(self.__session_key)
+            raise
+
+        self.__state = _ESTABLISHED
+        reused = self._sock.session_reused
+        self.log_info("fd {:d}, TLS handshake completed, {:s}, {:s}, session {:s}".format(
+            self.fileno(), str(self._sock.version()), str(self._sock.cipher()[0]),
+            reused and "resumed" or "new"))
+        if not self.__server_side:
+            self.__session_cache.record_handshake(reused)
+            self.__store_session()
+        self.__sync_interest()
+
+        self.on_handshake()
+        if not self.pollster(False):
+            # closed by on_handshake()
+            return
+        if self._out_queue:
+            # data queued meanwhile
+            self.handle_write()
+        if self.pollster(False):
+            # application data might have arrived along with the handshake
+            self.handle_read()
+
+    def __store_session(self):
+        # A TLS 1.3 session can be resumed once its ticket arrived, which is
+        # sent after the handshake, and processed when data is read.
+        if self.__server_side or self.__session_stored or self.__session_key is None:
+            return
+        session = self._sock.session
+        if session is not None and session.has_ticket:
+            self.__session_cache.put(self.__session_key, session)
+            self.__session_stored = True
+
+    # low level I/O, see _BufferedStreamMixin
+
+    def _write_buffers(self, buffers):
+        # There's no scatter/gather SSL_write(), buffers are coalesced into
+        # records. After SSL_WANT_WRITE, the same number of bytes must be
+        # written again, the head of the queue has not changed meanwhile.
+        remaining = sum(len(view) for view in buffers)
+        total = 0
+        while remaining:
+            size = self.__write_retry or min(remaining, _TLS_RECORD_SIZE)
+            data = self.__gather(buffers, total, size)
+            try:
+                sent = self._sock.send(data)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError) as why:
+                self.__write_retry = size
+                if isinstance(why, ssl.SSLWantReadError):
+                    self.__write_wants_read = True
+                    self.__sync_interest()
+                if total:
+                    return total
+                raise BlockingIOError(str(why))
+            self.__write_retry = 0
+            if self.__write_wants_read:
+                self.__write_wants_read = False
+                self.__sync_interest()
+            total += sent
+            remaining -= sent
+        return total
+
+    @staticmethod
+    def __gather(buffers, offset, size):
+        '''Returns `size' bytes of `buffers', starting at `offset'.'''
+
+        chunks = []
+        for view in buffers:
+            if offset >= len(view):
+                offset -= len(view)
+                continue
+            chunk = view[offset:offset + size]
+            offset = 0
+            if not chunks and len(chunk) == size:
+                # in a single buffer, no copy
+                return chunk
+            chunks.append(chunk)
+            size -= len(chunk)
+            if not size:
+                break
+        return b''.join(chunks)
+
+    def _read_into(self, view):
+        try:
+            received = self._sock.recv_into(view)
+        except ssl.SSLWantReadError as why:
+            raise BlockingIOError(str(why))
+        except ssl.SSLWantWriteError as why:
+            self.__read_wants_write = True
+            self.__sync_interest()
+            raise BlockingIOError(str(why))
+        except ssl.SSLZeroReturnError:
+            # close_notify
+            return 0
+        self.__store_session()
+        return received
+
+    def _can_write(self):
+        return self.__state == _ESTABLISHED
+
+    # interest in events
+
+    def want_read(self, flag = True):
+        # Called by the buffered stream, which is not aware of OpenSSL waiting
+        # for the other direction, see __sync_interest().
+        self.__stream_wants_read = flag and True or False
+        self.__sync_interest()
+
+    def want_write(self, flag = True):
+        self.__stream_wants_write = flag and True or False
+        self.__sync_interest()
+
+    def __sync_interest(self):
+        '''Declares the interest of the stream, combined with the one of
+        OpenSSL; call it whenever the state of either one changed.'''
+
+        if self.__state == _HANDSHAKING:
+            read = self.__handshake_wants_read
+            write = not read
+        elif self.__state == _PLAIN:
+            # connected (e.g. by a connection attempt which won a race) but
+            # not wrapped yet, which is done by the next write event
+            read, write = False, True
+        else:
+            read = self.__stream_wants_read or self.__write_wants_read
+            # the stream skips want_write(True) if write events are waited
+            # for already, e.g. for SSL_read()
+            write = self.__stream_wants_write or self.__read_wants_write \
+                    or len(self._out_queue) > 0
+        _stream_dispatcher.BufferedStreamDispatcher.want_read(self, read)
+        _stream_dispatcher.BufferedStreamDispatcher.want_write(self, write)
+
+    # events
+
+    def handle_read(self):
+        if self.__state != _ESTABLISHED:
+            if self.__state == _HANDSHAKING:
+                self.__handshake()
+            return
+
+        if self.__write_wants_read:
+            self.__write_wants_read = False
+            self.__sync_interest()
+            self.handle_write()
+            if not self.pollster(False):
+                return
+        _stream_dispatcher.BufferedStreamDispatcher.handle_read(self)
+        # data decrypted by OpenSSL but not read yet won't make the fd readable
+        while self.pollster(False) and not self._reading_paused \
+        and self._sock.pending():
+            _stream_dispatcher.BufferedStreamDispatcher.handle_read(self)
+
+    def handle_write_event(self, call_user_func = True):
+        if self.__state == _PLAIN:
+            # raises if the connection failed
+            _socket_dispatcher.TcpClientDispatcher.handle_write_event(self, False)
+            if self.is_connected():
+                self.__wrap()
+                self.__handshake()
+        elif self.__state == _HANDSHAKING:
+            self.__handshake()
+        elif self.__read_wants_write:
+            self.__read_wants_write = False
+            self.__sync_interest()
+            self.handle_read()
+            if self.pollster(False) and self._out_queue:
+                _stream_dispatcher.BufferedStreamDispatcher.handle_write_event(self, call_user_func)
+        else:
+            _stream_dispatcher.BufferedStreamDispatcher.handle_write_event(self, call_user_func)
+
+    def resume_reading(self):
+        paused = self._reading_paused
+        _stream_dispatcher.BufferedStreamDispatcher.resume_reading(self)
+        pollster = self.pollster(False)
+        if paused and pollster and self.__state == _ESTABLISHED and self._sock.pending():
+            pollster.call_soon_threadsafe(self.__read_pending)
+
+    def __read_pending(self):
+        if self.pollster(False) and not self._reading_paused:
+            self.handle_read()
+
+    def handle_close(self):
+        if self.__state == _ESTABLISHED and self._sock is not None:
+            self.__store_session()
+            if not self._hung_up:
+                try:
+                    # sends close_notify, not waiting for the peer's one
+                    self._sock.unwrap()
+                except (ssl.SSLError, OSError):
+                    pass
+        _stream_dispatcher.BufferedStreamDispatcher.handle_close(self)
+
+    # callbacks, implement these methods in derived classes
+
+    def on_handshake(self):
+        '''Called once the TLS handshake completed, e.g. to check the peer's
+        certificate, or the ALPN protocol selected.'''
+
+        pass
+
+#------------------------------------------------------------------------------
+
+class TlsServerDispatcher(_socket_dispatcher.TcpServerDispatcher):
+    '''TCP server dispatcher accepting TLS connections.
+
+    Override prepare_serving_client(), and serve each connection with a
+    TlsStreamDispatcher (or a derived class) created by
+    `TlsStreamDispatcher(conn_sock, context = self.tls_context(),
+    server_side = True)', all of them sharing the context of the server,
+    hence its session tickets.
+    '''
+
+    def __init__(self, sock = None, context = None, log_handle = None):
+        '''Creates a TLS server socket Dispatcher instance.
+
+        Args:
+          sock:       see TcpServerDispatcher
+          context:    server side SSLContext, see tls_context()
+          log_handle: a log handle to be used, None to disable logging
+        '''
+
+        _socket_dispatcher.TcpServerDispatcher.__init__(self, sock = sock,
+                                                        log_handle = log_handle)
+        if context is None or context.protocol == ssl.PROTOCOL_TLS_CLIENT:
+            raise ValueError("a server side SSLContext is required")
+        self.__context = context
+
+    def tls_context(self):
+        return self.__context
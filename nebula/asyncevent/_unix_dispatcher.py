@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Dispatchers of AF_UNIX sockets, which can pass file descriptors.
+
+Descriptors are passed as SCM_RIGHTS ancillary data, the receiver gets new
+descriptors referring to the same open files (or sockets), and the sender may
+close its own ones once they were sent.
+'''
+
+import array
+import os
+import socket
+import stat
+
+from . import _socket_dispatcher
+from . import _stream_dispatcher
+
+#------------------------------------------------------------------------------
+
+# max number of descriptors passed by one message
+MAX_FDS_PER_MESSAGE = 16
+
+_ANCBUFSIZE = socket.CMSG_SPACE(MAX_FDS_PER_MESSAGE * array.array('i').itemsize)
+
+# received descriptors are not inherited by child processes
+_RECV_FLAGS = getattr(socket, 'MSG_CMSG_CLOEXEC', 0)
+
+def _is_abstract(path):
+    return path[:1] in ('\0', b'\0')
+
+def _remove_stale_socket(path):
+    '''Removes a socket file left by a previous process, other files are left
+    alone, so bind() fails with EADDRINUSE.'''
+
+    if not path or _is_abstract(path):
+        return
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def _check_fds(fds):
+    if len(fds) > MAX_FDS_PER_MESSAGE:
+        raise ValueError("at most {:d} fds per message: {:d}".format(
+            MAX_FDS_PER_MESSAGE, len(fds)))
+
+class _SocketFileOwner(object):
+    '''Removes the socket file bound to, when the dispatcher is closed, but
+    only in the process which created it (not in forked workers).'''
+
+    def _own_socket_file(self, path):
+        if path and not _is_abstract(path):
+            self._socket_file = (path, os.getpid())
+
+    def _remove_socket_file(self):
+        owned = getattr(self, '_socket_file', None)
+        self._socket_file = None
+        if owned and owned[1] == os.getpid():
+            try:
+                os.unlink(owned[0])
+            except OSError as why:
+                self.log_info("failed removing {:s}: {:s}".format(str(owned[0]), str(why)))
+
+#------------------------------------------------------------------------------
+
+class UnixServerDispatcher(_SocketFileOwner, _socket_dispatcher.TcpServerDispatcher):
+    '''Listening AF_UNIX stream socket, used like TcpServerDispatcher.
+
+    The socket file is removed when the dispatcher is closed.
+    '''
+
+    def initialize(self, path, listen_backlog = socket.SOMAXCONN,
+                   remove_stale = True):
+        '''Creates a non-blocking AF_UNIX server socket.
+
+        Args:
+          path:           file system path to bind to, or a name in the
+                          abstract namespace (Linux only, starting with a null
+                          byte)
+          listen_backlog: max length of the queue of pending connections
+          remove_stale:   whether to remove a socket file left at `path'
+        '''
+
+        self.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if remove_stale:
+            _remove_stale_socket(path)
+        self.bind(path)
+        self._own_socket_file(path)
+        self.listen(listen_backlog)
+
+    def handle_close(self):
+        _socket_dispatcher.TcpServerDispatcher.handle_close(self)
+        self._remove_socket_file()
+
+class UnixStreamDispatcher(_stream_dispatcher.BufferedStreamDispatcher):
+    '''Buffered AF_UNIX stream dispatcher, which can pass file descriptors.
+
+    Usage:
+      Derive from this class, override on_data() and on_fds(), and call
+      send_fds() to pass descriptors along with some data.
+    '''
+
+    @classmethod
+    def pair(cls, log_handle = None, read_size = None):
+        '''Creates two dispatchers connected to each other, e.g. before
+        forking a worker process.
+
+        Returns:
+          2-tuple of dispatchers, not registered yet.
+        '''
+
+        sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        return (cls(sock_a, log_handle = log_handle, read_size = read_size),
+                cls(sock_b, log_handle = log_handle, read_size = read_size))
+
+    def initialize(self, peer_addr = None, connect_timeout = None,
+                   local_addr = None, reuse_addr = False):
+        '''Creates a non-blocking AF_UNIX stream socket.
+
+        Args:
+          peer_addr:       path (or abstract name) to connect to
+          connect_timeout: number of seconds (as float) to wait before aborting
+                           the connection attempt
+          local_addr:      path (or abstract name) to bind to, usually None
+          reuse_addr:      ignored
+        '''
+
+        self.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if local_addr:
+            self.bind(local_addr)
+        if peer_addr:
+            self.connect(peer_addr, connect_timeout)
+
+    def send_fds(self, data, fds, close_fds = False):
+        '''Queues data carrying file descriptors.
+
+        The descriptors are received along with the first byte of `data', so
+        the receiver can tell which message they belong to.
+
+        Args:
+          data:      bytes-like object, at least one byte, not copied
+          fds:       list of integers, or objects with a fileno() method (e.g.
+                     sockets), at most MAX_FDS_PER_MESSAGE; they must stay
+                     open until sent
+          close_fds: if True, the descriptors (or objects) are closed once
+                     sent, or when the dispatcher is closed before
+        '''
+
+        _check_fds(fds)
+        self._write_with_fds(data, fds, close_fds)
+
+    def _write_buffers_with_fds(self, buffers, fds):
+        return socket.send_fds(self._sock, buffers, fds)
+
+    def _read_into(self, view):
+        # same as socket.recv_fds(), but receives into our input buffer
+        nbytes, ancdata, flags, unused_addr = self._sock.recvmsg_into(
+            [view], _ANCBUFSIZE, _RECV_FLAGS)
+        if flags & socket.MSG_CTRUNC:
+            self.log_warning("fd {:d}, ancillary data truncated, fds lost".format(
+                self.fileno()))
+        if ancdata:
+            fds = _socket_dispatcher._fds_from_ancdata(ancdata)
+            if fds:
+                self.on_fds(fds)
+                if not self.pollster(False):
+                    # closed by on_fds(), stops handle_read()
+                    raise InterruptedError
+        return nbytes
+
+    def on_fds(self, fds):
+        '''Called with file descriptors received, before the data carrying
+        them is passed to on_data().
+
+        Args:
+          fds: list of integers, owned by this callback, closes them by default
+        '''
+
+        self.log_notice("{:s}.{:s}: using default on_fds(), closing {:d} fds".format(
+            self.__class__.__module__, self.__class__.__name__, len(fds)))
+        for fd in fds:
+            os.close(fd)
+
+class UnixDatagramDispatcher(_SocketFileOwner, _socket_dispatcher.UdpDispatcher):
+    '''AF_UNIX datagram dispatcher, used like UdpDispatcher, and can pass file
+    descriptors along with datagrams.
+
+    The socket file bound to is removed when the dispatcher is closed.
+    '''
+
+    _ancbufsize = _ANCBUFSIZE
+    _recv_flags = _RECV_FLAGS
+
+    def initialize(self, local_addr = None, peer_addr = None,
+                   remove_stale = True):
+        '''Creates a non-blocking AF_UNIX datagram socket.
+
+        Args:
+          local_addr:   path (or abstract name) to bind to, needed to receive
+                        datagrams unless the socket is one of a socketpair
+          peer_addr:    if not None, the socket is connected to it
+          remove_stale: whether to remove a socket file left at `local_addr'
+        '''
+
+        self.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if local_addr:
+            if remove_stale:
+                _remove_stale_socket(local_addr)
+            self.bind(local_addr)
+            self._own_socket_file(local_addr)
+        if peer_addr:
+            self.connect(peer_addr)
+        self.set_local_addr(self._sock.getsockname())
+
+    def sendto(self, data, addr = None, fds = None, close_fds = False):
+        '''Queues a datagram, see UdpDispatcher.sendto().
+
+        Args:
+          fds:       file descriptors passed along with the datagram, see
+                     UnixStreamDispatcher.send_fds()
+          close_fds: if True, the descriptors are closed once sent (or
+                     dropped)
+        '''
+
+        if not fds:
+            _socket_dispatcher.UdpDispatcher.sendto(self, data, addr)
+            return
+        if addr is None and not self.is_connected():
+            raise ValueError("destination address required, socket not connected")
+        _check_fds(fds)
+        self._queue_datagram(data, addr,
+                             _socket_dispatcher._FdsChunk(None, list(fds), close_fds))
+
+    def _handle_ancdata(self, ancdata, flags, addr):
+        if flags & socket.MSG_CTRUNC:
+            self.log_warning("fd {:d}, ancillary data truncated, fds lost".format(
+                self.fileno()))
+        fds = _socket_dispatcher._fds_from_ancdata(ancdata)
+        if fds:
+            self.on_fds(fds, addr)
+
+    def on_fds(self, fds, addr):
+        '''Called with file descriptors received, before the datagram carrying
+        them is passed to on_datagrams().
+
+        Args:
+          fds:  list of integers, owned by this callback, closes them by
+                default
+          addr: address of the sender
+        '''
+
+        self.log_notice("{:s}.{:s}: using default on_fds(), closing {:d} fds".format(
+            self.__class__.__module__, self.__class__.__name__, len(fds)))
+        for fd in fds:
+            os.close(fd)
+
+    def handle_close(self):
+        for unused_data, unused_addr, fds in self._send_queue:
+            if fds is not None:
+                fds.release_fds()
+        self._send_queue.clear()
+        _socket_dispatcher.UdpDispatcher.handle_close(self)
+        self._remove_socket_file()
@@ -27,7 +27,7 @@ class SignalNumbers(object):
                         for (sig_name, sig_num) in signal.__dict__.items()
                         if (sig_name.startswith('SIG')
                             and ('_' not in sig_name)
-                            and type(sig_num) == int)
+                            and isinstance(sig_num, int))
                         ))
 
     @classmethod
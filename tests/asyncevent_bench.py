@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Self-contained benchmarks of the asyncevent package, on localhost.
+
+Workloads, each run with every available event API (epoll, poll, select):
+  connect: clients connect to an echo server, exchange one small message,
+           and close; reports connections/sec and latency of one connection.
+  echo:    persistent clients send requests to an echo server, waiting for
+           the whole reply before sending the next one; reports requests/sec,
+           bytes/sec and latency of one request.
+  timer:   many ScheduledJob objects firing periodically; reports timers/sec
+           and how late the timers fire.
+
+Client and server dispatchers run in the same AsyncEvent object, so the
+numbers include the cost of both sides. Results are written as JSON, e.g.
+
+  ./asyncevent_bench.py --output result.json
+'''
+
+import argparse
+import json
+import platform
+import socket
+import sys
+import time
+
+import add_nebula_path
+from nebula.asyncevent import (AsyncEvent, ScheduledJob, TcpClientDispatcher,
+                               TcpServerDispatcher)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+def percentiles(samples):
+    '''Returns dict of latency percentiles (in microseconds) of `samples'
+    (in seconds).'''
+
+    result = {}
+    if not samples:
+        return result
+    samples = sorted(samples)
+    for p in PERCENTILES:
+        idx = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        result["p{:s}".format(str(p))] = round(samples[idx] * 1000000, 1)
+    result["max"] = round(samples[-1] * 1000000, 1)
+    return result
+
+#------------------------------------------------------------------------------
+
+class EchoConnection(TcpClientDispatcher):
+    '''Server side of an accepted connection, sends back what it receives.'''
+
+    def __init__(self, sock, log_handle = None):
+        TcpClientDispatcher.__init__(self, sock = sock, log_handle = log_handle)
+        self.outgoing = bytearray()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return len(self.outgoing) > 0
+
+    def handle_read(self):
+        data = self._sock.recv(65536)
+        if not data:
+            self.handle_close()
+            return
+        self.outgoing += data
+        self.handle_write()
+
+    def handle_write(self):
+        try:
+            sent = self._sock.send(self.outgoing)
+        except BlockingIOError:
+            return
+        del self.outgoing[:sent]
+
+class EchoServer(TcpServerDispatcher):
+    def prepare_serving_clients(self, new_clients):
+        pollster = self.pollster()
+        for conn_sock, unused_addr in new_clients:
+            pollster.register(EchoConnection(conn_sock,
+                                             log_handle = self.get_log_handle()))
+
+class LoadClient(TcpClientDispatcher):
+    '''Sends `num_requests' requests of `size' bytes one by one, waiting for
+    the complete echo of each before sending the next one.'''
+
+    def __init__(self, stats, num_requests, size, log_handle = None):
+        TcpClientDispatcher.__init__(self, log_handle = log_handle)
+        self.stats = stats
+        self.remaining = num_requests
+        self.request = b'x' * size
+        self.outgoing = b''
+        self.received = 0
+        self.connect_started = time.perf_counter()
+        self.request_started = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return len(self.outgoing) > 0
+
+    def handle_write_event(self, call_user_func = True):
+        if not self.is_connected():
+            TcpClientDispatcher.handle_write_event(self, call_user_func)
+            self.next_request()
+        else:
+            TcpClientDispatcher.handle_write_event(self, call_user_func)
+
+    def next_request(self):
+        if not self.remaining:
+            self.stats.connection_done(time.perf_counter() - self.connect_started)
+            self.handle_close()
+            return
+        self.remaining -= 1
+        self.outgoing = self.request
+        self.received = 0
+        self.request_started = time.perf_counter()
+        self.handle_write()
+
+    def handle_write(self):
+        try:
+            sent = self._sock.send(self.outgoing)
+        except BlockingIOError:
+            return
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        data = self._sock.recv(65536)
+        if not data:
+            self.handle_close()
+            return
+        self.received += len(data)
+        if self.received >= len(self.request):
+            self.stats.request_done(time.perf_counter() - self.request_started,
+                                    len(self.request))
+            self.next_request()
+
+class ClientStats(object):
+    '''Shared by all clients of one run, opens new connections as old ones
+    finish, until `num_connections' were made.'''
+
+    def __init__(self, pollster, server_addr, num_connections, num_requests,
+                 size):
+        self.pollster = pollster
+        self.server_addr = server_addr
+        self.remaining = num_connections
+        self.num_requests = num_requests
+        self.size = size
+        self.connections = 0
+        self.requests = 0
+        self.bytes = 0
+        self.connect_latency = []
+        self.request_latency = []
+
+    def start_client(self):
+        if not self.remaining:
+            return
+        self.remaining -= 1
+        client = LoadClient(self, self.num_requests, self.size)
+        client.initialize(self.server_addr)
+        self.pollster.register(client)
+
+    def connection_done(self, elapsed):
+        self.connections += 1
+        self.connect_latency.append(elapsed)
+        self.start_client()
+
+    def request_done(self, elapsed, size):
+        self.requests += 1
+        # sent and received
+        self.bytes += 2 * size
+        self.request_latency.append(elapsed)
+
+#------------------------------------------------------------------------------
+
+class StopWhenDone(ScheduledJob):
+    '''Stops the loop once only the echo server is left.'''
+
+    def __init__(self, pollster):
+        ScheduledJob.__init__(self)
+        self.pollster = pollster
+
+    def schedule(self):
+        return time.time() + 0.01
+
+    def handle_job_event(self):
+        if self.pollster.num_of_dispatchers() <= 1:
+            self.pollster.set_stop_flag()
+
+def run_clients(api, concurrency, num_connections, num_requests, size):
+    ae = AsyncEvent(api = api)
+    server = EchoServer()
+    server.initialize(('127.0.0.1', 0))
+    ae.register(server)
+
+    stats = ClientStats(ae, server._sock.getsockname(), num_connections,
+                        num_requests, size)
+    for unused_idx in range(concurrency):
+        stats.start_client()
+    ae.add_scheduled_job(StopWhenDone(ae))
+
+    begin = time.perf_counter()
+    ae.loop()
+    elapsed = time.perf_counter() - begin
+
+    server.handle_close()
+    ae.close()
+    return stats, elapsed
+
+def bench_connect(api, args):
+    stats, elapsed = run_clients(api, args.concurrency, args.connections, 1, 64)
+    return {
+        "connections": stats.connections,
+        "elapsed": round(elapsed, 6),
+        "connections_per_sec": round(stats.connections / elapsed, 1),
+        "latency_usec": percentiles(stats.connect_latency),
+        }
+
+def bench_echo(api, args):
+    per_client = max(1, args.requests // args.concurrency)
+    stats, elapsed = run_clients(api, args.concurrency, args.concurrency,
+                                 per_client, args.size)
+    return {
+        "connections": stats.connections,
+        "requests": stats.requests,
+        "request_size": args.size,
+        "elapsed": round(elapsed, 6),
+        "requests_per_sec": round(stats.requests / elapsed, 1),
+        "bytes_per_sec": round(stats.bytes / elapsed, 1),
+        "latency_usec": percentiles(stats.request_latency),
+        }
+
+#------------------------------------------------------------------------------
+
+class PeriodicJob(ScheduledJob):
+    def __init__(self, results, interval, start, end):
+        ScheduledJob.__init__(self)
+        self.results = results
+        self.interval = interval
+        self.deadline = start
+        self.end = end
+
+    def schedule(self):
+        self.deadline += self.interval
+        if self.deadline > self.end:
+            return None
+        return self.deadline
+
+    def handle_job_event(self):
+        self.results.append(time.time() - self.deadline)
+
+def bench_timer(api, args):
+    ae = AsyncEvent(api = api)
+    lateness = []
+    now = time.time()
+    end = now + args.duration
+    for idx in range(args.timers):
+        # spread first deadlines across one interval
+        start = now + args.interval * idx / args.timers
+        ae.add_scheduled_job(PeriodicJob(lateness, args.interval, start, end))
+
+    begin = time.perf_counter()
+    ae.loop()
+    elapsed = time.perf_counter() - begin
+    ae.close()
+
+    return {
+        "timers": args.timers,
+        "interval": args.interval,
+        "fired": len(lateness),
+        "elapsed": round(elapsed, 6),
+        "timers_per_sec": round(len(lateness) / elapsed, 1),
+        "lateness_usec": percentiles(lateness),
+        }
+
+#------------------------------------------------------------------------------
+
+API_NAMES = {
+    "epoll": AsyncEvent.API_EPOLL,
+    "poll": AsyncEvent.API_POLL,
+    "select": AsyncEvent.API_SELECT,
+    }
+
+WORKLOADS = {
+    "connect": bench_connect,
+    "echo": bench_echo,
+    "timer": bench_timer,
+    }
+
+def available_apis():
+    result = []
+    for name in ("epoll", "poll", "select"):
+        try:
+            AsyncEvent(api = API_NAMES[name]).close()
+        except Exception:
+            continue
+        result.append(name)
+    return result
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument("--apis", default = ",".join(available_apis()),
+                        help = "comma separated event APIs (default: %(default)s)")
+    parser.add_argument("--workloads", default = ",".join(sorted(WORKLOADS)),
+                        help = "comma separated workloads (default: %(default)s)")
+    parser.add_argument("--concurrency", type = int, default = 50,
+                        help = "concurrent client connections (default: %(default)s)")
+    parser.add_argument("--connections", type = int, default = 2000,
+                        help = "connections made by `connect' (default: %(default)s)")
+    parser.add_argument("--requests", type = int, default = 20000,
+                        help = "requests sent by `echo' (default: %(default)s)")
+    parser.add_argument("--size", type = int, default = 512,
+                        help = "request size of `echo' in bytes (default: %(default)s)")
+    parser.add_argument("--timers", type = int, default = 1000,
+                        help = "periodic jobs of `timer' (default: %(default)s)")
+    parser.add_argument("--interval", type = float, default = 0.01,
+                        help = "seconds between runs of a job (default: %(default)s)")
+    parser.add_argument("--duration", type = float, default = 2.0,
+                        help = "seconds `timer' runs for (default: %(default)s)")
+    parser.add_argument("--output", default = None,
+                        help = "write JSON result to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv = None):
+    args = parse_args(argv)
+
+    results = {}
+    for workload in args.workloads.split(","):
+        results[workload] = {}
+        for api in args.apis.split(","):
+            results[workload][api] = WORKLOADS[workload](API_NAMES[api], args)
+            print("{:s}/{:s} done".format(workload, api), file = sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "parameters": vars(args),
+        "results": results,
+        }
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2788 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import errno
+import os
+import select
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import add_nebula_path
+import nebula
+from nebula.asyncevent import (AsyncEvent, ScheduledJob, TcpClientDispatcher,
+                               TcpServerDispatcher, PreforkServer,
+                               BufferedStreamDispatcher, BufferPool,
+                               FramedStreamDispatcher, AeFrameError,
+                               LengthPrefixedDecoder, DelimiterDecoder,
+                               FixedSizeDecoder, LengthPrefixedEncoder,
+                               DelimiterEncoder, FixedSizeEncoder,
+                               RelayDispatcher, UdpDispatcher,
+                               UnixServerDispatcher, UnixStreamDispatcher,
+                               UnixDatagramDispatcher, HandoffServerDispatcher,
+                               HandoffWorkerDispatcher, Resolver,
+                               SocketProfile, ConnectionPool,
+                               TlsStreamDispatcher, TlsServerDispatcher,
+                               TlsSessionCache, tls_context, HotUpgrade,
+                               PipeDispatcher, SubprocessDispatcher)
+from nebula.asyncevent import (_hot_upgrade, _pipe_dispatcher, _relay, _timer,
+                               _tls_dispatcher)
+
+class IdleDispatcher(TcpClientDispatcher):
+    '''Connected dispatcher which only waits for its timeout event.'''
+
+    def __init__(self, sock, idle_secs):
+        TcpClientDispatcher.__init__(self, sock = sock)
+        self.deadline = time.time() + idle_secs
+        self.timed_out = 0
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return False
+
+    def timeout(self):
+        return self.deadline
+
+    def handle_timeout(self):
+        self.timed_out += 1
+        self.handle_close()
+
+class CountingJob(ScheduledJob):
+    def __init__(self, interval, max_count):
+        ScheduledJob.__init__(self)
+        self.interval = interval
+        self.max_count = max_count
+        self.count = 0
+
+    def schedule(self):
+        if self.count < self.max_count:
+            return time.time() + self.interval
+        return None
+
+    def handle_job_event(self):
+        self.count += 1
+
+class BusyDispatcher(TcpClientDispatcher):
+    '''Connected dispatcher whose write event fires on every iteration.'''
+
+    def __init__(self, sock):
+        TcpClientDispatcher.__init__(self, sock = sock)
+        self.steps = 0
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def timeout(self):
+        return None
+
+    def handle_write(self):
+        self.steps += 1
+
+class StopLoopJob(ScheduledJob):
+    def __init__(self, delay):
+        ScheduledJob.__init__(self)
+        self.deadline = time.time() + delay
+        self.fired_at = None
+
+    def schedule(self):
+        return self.fired_at is None and self.deadline or None
+
+    def handle_job_event(self):
+        self.fired_at = time.time()
+        for disp in list(self.pollster_obj._registered_dispatchers.values()):
+            disp.handle_close()
+
+class DrainingDispatcher(TcpClientDispatcher):
+    '''Reads until EAGAIN, closes after `expected' bytes were received.'''
+
+    def __init__(self, sock, expected):
+        TcpClientDispatcher.__init__(self, sock = sock)
+        self.expected = expected
+        self.received = b''
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def timeout(self):
+        return None
+
+    def handle_read(self):
+        while True:
+            try:
+                data = self._sock.recv(7)
+            except socket.error as err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            self.received += data
+        if len(self.received) >= self.expected:
+            self.handle_close()
+
+    def handle_write(self):
+        pass
+
+class CountingServerDispatcher(TcpServerDispatcher):
+    def __init__(self, expected):
+        TcpServerDispatcher.__init__(self)
+        self.expected = expected
+        self.accepted = 0
+        self.read_events = 0
+
+    def handle_read(self):
+        self.read_events += 1
+        TcpServerDispatcher.handle_read(self)
+        if self.accepted == self.expected:
+            self.handle_close()
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        self.accepted += 1
+        conn_sock.close()
+
+class BatchServerDispatcher(CountingServerDispatcher):
+    def __init__(self, expected, limit):
+        CountingServerDispatcher.__init__(self, expected)
+        self.set_max_accepts_per_event(limit)
+        self.batches = []
+
+    def prepare_serving_clients(self, new_clients):
+        self.batches.append(len(new_clients))
+        CountingServerDispatcher.prepare_serving_clients(self, new_clients)
+
+class ExplicitWriter(TcpClientDispatcher):
+    '''Writes `chunks', waits for read events, closes on second timeout.'''
+
+    def __init__(self, sock, chunks):
+        TcpClientDispatcher.__init__(self, sock = sock)
+        self.chunks = list(chunks)
+        self.timeouts = 0
+        self.want_write(True)
+
+    def handle_write(self):
+        self._sock.send(self.chunks.pop(0))
+        if not self.chunks:
+            self.want_write(False)
+            self.want_read(True)
+            self.set_deadline(time.time() + 0.01)
+
+    def handle_read(self):
+        pass
+
+    def handle_timeout(self):
+        self.timeouts += 1
+        if self.timeouts == 1:
+            self.set_deadline(time.time() + 0.01)
+        else:
+            self.handle_close()
+
+class PidServerDispatcher(TcpServerDispatcher):
+    '''Sends pid of the serving process to clients, then closes.'''
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        conn_sock.setblocking(1)
+        conn_sock.sendall(str(os.getpid()).encode('ascii'))
+        conn_sock.close()
+
+class LineReceiver(BufferedStreamDispatcher):
+    '''Collects complete lines, closes after `expected' lines.'''
+
+    def __init__(self, sock, expected, read_size = None):
+        BufferedStreamDispatcher.__init__(self, sock = sock, read_size = read_size)
+        self.expected = expected
+        self.lines = []
+        self.calls = 0
+
+    def on_data(self, data):
+        self.calls += 1
+        end = bytes(data).rfind(b'\n') + 1
+        self.lines.extend(bytes(data[:end]).splitlines())
+        if len(self.lines) >= self.expected:
+            self.handle_close()
+        return end
+
+class LineSender(BufferedStreamDispatcher):
+    def __init__(self, sock, chunks):
+        BufferedStreamDispatcher.__init__(self, sock = sock)
+        self.want_read(False)
+        self.writelines(chunks)
+        self.close_when_done()
+
+class PooledReader(TcpClientDispatcher):
+    def __init__(self, sock, expected):
+        TcpClientDispatcher.__init__(self, sock = sock)
+        self.expected = expected
+        self.received = b''
+        self.want_read(True)
+
+    def handle_read(self):
+        view = self.recv_pooled(16)
+        if view is None:
+            return
+        if not len(view):
+            self.handle_close()
+            return
+        self.received += view
+        self.pollster().buffer_pool().release(view)
+        if len(self.received) >= self.expected:
+            self.handle_close()
+
+class FrameEcho(FramedStreamDispatcher):
+    '''Sends frames back reversed, closes after `expected' frames.'''
+
+    def __init__(self, sock, expected):
+        FramedStreamDispatcher.__init__(self, LengthPrefixedDecoder(2, 'little'),
+                                        LengthPrefixedEncoder(2, 'little'),
+                                        sock = sock)
+        self.expected = expected
+        self.frames = []
+
+    def on_frame(self, frame):
+        self.frames.append(bytes(frame))
+        self.send_frame(bytes(frame[::-1]))
+        if len(self.frames) == self.expected:
+            self.close_when_done()
+
+def tcp_pair():
+    '''Returns 2 connected TCP sockets.'''
+
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sock_a = socket.create_connection(listener.getsockname())
+        sock_b, unused_addr = listener.accept()
+    return sock_a, sock_b
+
+class WatermarkRecorder(BufferedStreamDispatcher):
+    def __init__(self, sock):
+        BufferedStreamDispatcher.__init__(self, sock = sock)
+        self.events = []
+
+    def pause_writing(self):
+        self.events.append('pause')
+
+    def resume_writing(self):
+        self.events.append('resume')
+
+    def on_drain(self):
+        self.handle_close()
+
+class ChunkWriter(BufferedStreamDispatcher):
+    '''Writes another chunk from on_drain(), `count' chunks in total.'''
+
+    def __init__(self, sock, count):
+        BufferedStreamDispatcher.__init__(self, sock = sock)
+        self.count = count
+        self.drained = 0
+
+    def on_drain(self):
+        self.drained += 1
+        if self.drained < self.count:
+            self.write(b'x')
+
+class Forwarder(BufferedStreamDispatcher):
+    '''Forwards data received to its peer.'''
+
+    def __init__(self, sock):
+        BufferedStreamDispatcher.__init__(self, sock = sock)
+        self.max_peer_buffer = 0
+        self.paused = 0
+
+    def on_data(self, data):
+        peer = self.peer()
+        peer.write(bytes(data))
+        self.max_peer_buffer = max(self.max_peer_buffer, peer.get_write_buffer_size())
+
+    def pause_reading(self):
+        self.paused += 1
+        BufferedStreamDispatcher.pause_reading(self)
+
+    def on_eof(self):
+        self.peer().close_when_done()
+        self.handle_close()
+
+class FileSender(BufferedStreamDispatcher):
+    def __init__(self, sock):
+        BufferedStreamDispatcher.__init__(self, sock = sock)
+        self.want_read(False)
+        self.progress = []
+        self.error = None
+
+    def handle_error(self, exception_obj):
+        self.error = exception_obj
+        BufferedStreamDispatcher.handle_error(self, exception_obj)
+
+    def record(self, sent, count):
+        self.progress.append((sent, count))
+
+class UdpCollector(UdpDispatcher):
+    '''Collects datagrams, replies to each, closes after `expected' ones.'''
+
+    def __init__(self, expected, budget):
+        UdpDispatcher.__init__(self)
+        self.initialize(('127.0.0.1', 0))
+        self.set_recv_budget(budget)
+        self.set_max_datagram_size(2048)
+        self.expected = expected
+        self.received = []
+        self.batches = []
+
+    def on_datagrams(self, batch):
+        self.batches.append(len(batch))
+        UdpDispatcher.on_datagrams(self, batch)
+
+    def on_datagram(self, data, addr):
+        self.received.append(bytes(data))
+        self.sendto(b'ack:' + bytes(data), addr)
+
+    def handle_write(self):
+        UdpDispatcher.handle_write(self)
+        if len(self.received) == self.expected and not self.stats()['queued']:
+            self.handle_close()
+
+class UnixLineServer(UnixServerDispatcher):
+    '''Serves one client with a LineReceiver, then closes.'''
+
+    def __init__(self):
+        UnixServerDispatcher.__init__(self)
+        self.receiver = None
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        self.receiver = LineReceiver(conn_sock, 1)
+        self.pollster().register(self.receiver)
+        self.handle_close()
+
+class FdReceiver(UnixStreamDispatcher):
+    '''Reads the content of files received, closes after `expected' ones.'''
+
+    def __init__(self, sock, expected):
+        UnixStreamDispatcher.__init__(self, sock = sock)
+        self.expected = expected
+        self.contents = []
+        self.data = b''
+
+    def on_fds(self, fds):
+        for fd in fds:
+            with os.fdopen(fd, 'rb') as f:
+                self.contents.append(f.read())
+
+    def on_data(self, data):
+        self.data += bytes(data)
+        if len(self.contents) >= self.expected:
+            self.handle_close()
+
+class DatagramFdCollector(UnixDatagramDispatcher):
+    def __init__(self, path, expected):
+        UnixDatagramDispatcher.__init__(self)
+        self.initialize(path)
+        self.expected = expected
+        self.received = []
+        self.contents = []
+
+    def on_fds(self, fds, addr):
+        for fd in fds:
+            with os.fdopen(fd, 'rb') as f:
+                self.contents.append(f.read())
+
+    def on_datagram(self, data, addr):
+        self.received.append((bytes(data), addr))
+        if len(self.received) == self.expected:
+            self.handle_close()
+
+def pipe_with(data):
+    '''Returns read end of a pipe holding `data'.'''
+
+    fd_r, fd_w = os.pipe()
+    os.write(fd_w, data)
+    os.close(fd_w)
+    return fd_r
+
+class NamedWorker(HandoffWorkerDispatcher):
+    '''Answers connections with its name, reports a fixed base load plus the
+    number of connections received.'''
+
+    def __init__(self, sock, name, base_load):
+        HandoffWorkerDispatcher.__init__(self, sock = sock)
+        self.name = name
+        self.base_load = base_load
+
+    def load(self):
+        return self.base_load + self.received()
+
+    def serve_connection(self, conn_sock):
+        responder = BufferedStreamDispatcher(conn_sock)
+        responder.want_read(False)
+        self.pollster().register(responder)
+        responder.write(self.name)
+        responder.close_when_done()
+
+class ConnectJob(ScheduledJob):
+    def __init__(self, delay, addr, count):
+        ScheduledJob.__init__(self)
+        self.deadline = time.time() + delay
+        self.addr = addr
+        self.count = count
+        self.clients = []
+
+    def schedule(self):
+        return not self.clients and self.deadline or None
+
+    def handle_job_event(self):
+        self.clients = [socket.create_connection(self.addr) for i in range(self.count)]
+
+class FakeGetaddrinfo(object):
+    '''Replaces socket.getaddrinfo(), maps names in `hosts' to an address, or
+    a list of IPv4 and IPv6 addresses, records names looked up.'''
+
+    def __init__(self, hosts, delay = 0.05):
+        self.hosts = hosts
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, host, port, family = 0, type = 0, proto = 0, flags = 0):
+        with self.lock:
+            self.calls.append(host)
+        time.sleep(self.delay)
+        if host not in self.hosts:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        addrs = self.hosts[host]
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        infos = []
+        for addr in addrs:
+            if ':' in addr:
+                info = (socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                        (addr, port, 0, 0))
+            else:
+                info = (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                        (addr, port))
+            if family in (0, info[0]):
+                infos.append(info)
+        if not infos:
+            raise socket.gaierror(socket.EAI_ADDRFAMILY, "Address family for hostname not supported")
+        return infos
+
+class ConnectingClient(TcpClientDispatcher):
+    '''Closes once connected, records the address connected to.'''
+
+    def __init__(self):
+        TcpClientDispatcher.__init__(self)
+        self.peer = None
+        self.error = None
+        self.fd = None
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        # once a connection attempt won a race, see connect()
+        return self.is_connected()
+
+    def timeout(self):
+        return None
+
+    def handle_write_event(self, call_user_func = True):
+        TcpClientDispatcher.handle_write_event(self, call_user_func)
+        if self.is_connected():
+            self.peer = self._sock.getpeername()
+            self.fd = self.fileno()
+            self.handle_close()
+
+    def handle_write(self):
+        pass
+
+    def handle_error(self, exception_obj):
+        self.error = exception_obj
+        TcpClientDispatcher.handle_error(self, exception_obj)
+
+class CountingPollster(object):
+    '''Wraps a pollster object, counts calls of modify().'''
+
+    def __init__(self, pollster):
+        self.pollster = pollster
+        self.modified = 0
+
+    def modify(self, fd, eventmask):
+        self.modified += 1
+        return self.pollster.modify(fd, eventmask)
+
+    def __getattr__(self, name):
+        return getattr(self.pollster, name)
+
+#  -----------------------------------------------------------------------------
+
+class HeapTimerQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = _timer._HeapTimerQueue()
+        for key, deadline in (('c', 3.0), ('a', 1.0), ('b', 2.0)):
+            queue.push(key, deadline)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.peek(), 1.0)
+        self.assertEqual(queue.pop_due(2.5), ['a', 'b'])
+        self.assertEqual(queue.peek(), 3.0)
+        self.assertEqual(len(queue), 1)
+
+    def test_rearm_and_cancel(self):
+        queue = _timer._HeapTimerQueue()
+        queue.push('a', 1.0)
+        queue.push('b', 2.0)
+        queue.push('a', 5.0)
+        self.assertEqual(queue.deadline('a'), 5.0)
+        self.assertEqual(queue.peek(), 2.0)
+        self.assertTrue(queue.cancel('b'))
+        self.assertFalse(queue.cancel('b'))
+        self.assertEqual(queue.peek(), 5.0)
+        self.assertEqual(queue.pop_due(4.0), [])
+        self.assertEqual(queue.pop_due(5.0), ['a'])
+        self.assertIsNone(queue.peek())
+
+    def test_limit(self):
+        queue = _timer._HeapTimerQueue()
+        for i in range(5):
+            queue.push(i, float(i))
+        self.assertEqual(queue.pop_due(10.0, 2), [0, 1])
+        self.assertEqual(queue.pop_due(10.0, 2), [2, 3])
+        self.assertEqual(queue.pop_due(10.0, 2), [4])
+
+    def test_compaction(self):
+        queue = _timer._HeapTimerQueue()
+        for i in range(10000):
+            queue.push(i % 10, float(i))
+        self.assertEqual(len(queue), 10)
+        self.assertLess(len(queue._heap), 1000)
+        self.assertEqual(queue.pop_due(float('inf')), list(range(10)))
+
+class TimingWheelTest(unittest.TestCase):
+
+    def test_never_early(self):
+        wheel = _timer._TimingWheel(resolution = 0.5, num_slots = 8, now = 100.0)
+        wheel.push('a', 100.2)
+        wheel.push('b', 101.0)
+        wheel.push('c', 110.3)          # more than one revolution away
+        self.assertEqual(wheel.peek(), 100.5)
+        self.assertEqual(wheel.pop_due(100.4), [])
+        self.assertEqual(wheel.pop_due(100.5), ['a'])
+        self.assertEqual(wheel.pop_due(101.0), ['b'])
+        self.assertEqual(wheel.pop_due(110.0), [])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.pop_due(110.5), ['c'])
+        self.assertIsNone(wheel.peek())
+
+    def test_rearm_and_cancel(self):
+        wheel = _timer._TimingWheel(resolution = 1.0, num_slots = 4, now = 0.0)
+        wheel.push('a', 1.0)
+        wheel.push('a', 3.0)
+        wheel.push('b', 2.0)
+        self.assertEqual(wheel.deadline('a'), 3.0)
+        self.assertTrue(wheel.cancel('b'))
+        self.assertFalse(wheel.cancel('b'))
+        self.assertEqual(wheel.pop_due(2.0), [])
+        self.assertEqual(wheel.pop_due(3.0), ['a'])
+
+    def test_past_deadline(self):
+        wheel = _timer._TimingWheel(resolution = 1.0, num_slots = 4, now = 10.0)
+        wheel.push('a', 3.0)
+        self.assertEqual(wheel.peek(), 11.0)
+        self.assertEqual(wheel.pop_due(11.0), ['a'])
+
+    def test_long_idle(self):
+        wheel = _timer._TimingWheel(resolution = 1.0, num_slots = 4, now = 0.0)
+        for i in range(10):
+            wheel.push(i, float(i + 1))
+        self.assertEqual(sorted(wheel.pop_due(100.0)), list(range(10)))
+
+    def test_limit(self):
+        wheel = _timer._TimingWheel(resolution = 1.0, num_slots = 4, now = 0.0)
+        for i in range(6):
+            wheel.push(i, 1.0 + (i % 2))
+        due = wheel.pop_due(100.0, 2)
+        due += wheel.pop_due(100.0, 3)
+        due += wheel.pop_due(100.0, 3)
+        self.assertEqual(sorted(due), list(range(6)))
+        self.assertEqual(len(wheel), 0)
+
+#  -----------------------------------------------------------------------------
+
+class AsyncEventTimerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def new_idle_dispatcher(self, idle_secs):
+        sock_a, sock_b = socket.socketpair()
+        self.socks.append(sock_b)
+        return IdleDispatcher(sock_a, idle_secs)
+
+    def test_fd_timeouts_and_jobs(self):
+        for timer in (AsyncEvent.TIMER_HEAP, AsyncEvent.TIMER_WHEEL):
+            self.check_fd_timeouts_and_jobs(AsyncEvent(timer = timer,
+                                                       timer_resolution = 0.005))
+
+    def check_fd_timeouts_and_jobs(self, ae):
+        dispatchers = [self.new_idle_dispatcher(0.01 * (i % 3)) for i in range(6)]
+        for disp in dispatchers:
+            ae.register(disp)
+        job = CountingJob(0.01, 3)
+        ae.add_scheduled_job(job)
+        self.assertEqual(ae.num_of_scheduled_jobs(), 1)
+
+        ae.loop()
+
+        self.assertEqual([d.timed_out for d in dispatchers], [1] * 6)
+        self.assertEqual(job.count, 3)
+        self.assertEqual(ae.num_of_dispatchers(), 0)
+        self.assertEqual(ae.num_of_scheduled_jobs(), 0)
+
+    def test_timers_fire_while_busy(self):
+        for timer in (AsyncEvent.TIMER_HEAP, AsyncEvent.TIMER_WHEEL):
+            ae = AsyncEvent(timer = timer, timer_resolution = 0.005)
+            sock_a, sock_b = socket.socketpair()
+            self.socks.append(sock_b)
+            busy = BusyDispatcher(sock_a)
+            ae.register(busy)
+            job = StopLoopJob(0.05)
+            job.pollster_obj = ae
+            ae.add_scheduled_job(job)
+
+            ae.loop()
+
+            self.assertGreater(busy.steps, 0)
+            self.assertLess(job.fired_at - job.deadline, 0.05)
+
+    def test_timer_budget(self):
+        ae = AsyncEvent(timer_budget = 2)
+        dispatchers = [self.new_idle_dispatcher(0.0) for i in range(5)]
+        for disp in dispatchers:
+            ae.register(disp)
+        ae.loop()
+        self.assertEqual([d.timed_out for d in dispatchers], [1] * 5)
+
+    def test_unregister_cancels_timeout(self):
+        ae = AsyncEvent()
+        disp = self.new_idle_dispatcher(0.0)
+        ae.register(disp)
+        ae.unregister(disp)
+        disp.close()
+        self.assertEqual(len(ae._fds_with_timeout), 0)
+
+#  -----------------------------------------------------------------------------
+
+class ExplicitInterestTest(unittest.TestCase):
+
+    def test_sync_only_when_changed(self):
+        for api in (AsyncEvent.API_EPOLL, AsyncEvent.API_POLL, AsyncEvent.API_SELECT):
+            ae = AsyncEvent(api = api)
+            ae._pollster = CountingPollster(ae._pollster)
+            sock_a, sock_b = socket.socketpair()
+            disp = ExplicitWriter(sock_a, [b'a', b'b', b'c', b'd'])
+            ae.register(disp)
+            ae.loop()
+            self.assertEqual(sock_b.recv(16), b'abcd')
+            sock_b.close()
+
+            self.assertTrue(disp.explicit_interest())
+            self.assertEqual(disp.timeouts, 2)
+            # OUT -> IN, once
+            self.assertEqual(ae._pollster.modified, 1)
+
+#  -----------------------------------------------------------------------------
+
+class WakeupTest(unittest.TestCase):
+
+    def test_stop_from_other_thread(self):
+        ae = AsyncEvent()
+        job = CountingJob(3600.0, 1)
+        ae.add_scheduled_job(job)
+        timer = threading.Timer(0.05, ae.set_stop_flag)
+        begin = time.time()
+        timer.start()
+        ae.loop()
+        timer.join()
+        ae.close()
+        self.assertLess(time.time() - begin, 1.0)
+        self.assertEqual(job.count, 0)
+
+    def test_call_soon_threadsafe(self):
+        ae = AsyncEvent()
+        ae.add_scheduled_job(CountingJob(3600.0, 1))
+        results = []
+        loop_thread = threading.current_thread()
+
+        def callback(value):
+            results.append((value, threading.current_thread() is loop_thread))
+            if len(results) == 10:
+                ae.set_stop_flag()
+
+        def worker():
+            for i in range(10):
+                ae.call_soon_threadsafe(callback, i)
+
+        thread = threading.Thread(target = worker)
+        thread.start()
+        ae.loop()
+        thread.join()
+        ae.close()
+        self.assertEqual(results, [(i, True) for i in range(10)])
+
+    def test_coalesce(self):
+        ae = AsyncEvent()
+        if ae._pipe_rd_end != ae._pipe_wr_end:
+            self.skipTest("eventfd is not available")
+        for i in range(100):
+            ae.call_soon_threadsafe(len, ())
+        self.assertEqual(os.eventfd_read(ae._pipe_rd_end), 1)
+        ae.close()
+
+    def test_callbacks_keep_loop_running(self):
+        ae = AsyncEvent()
+        results = []
+        ae.call_soon_threadsafe(results.append, 1)
+        ae.call_soon_threadsafe(ae.call_soon_threadsafe, results.append, 2)
+        ae.loop()
+        ae.close()
+        self.assertEqual(results, [1, 2])
+
+class ExecutorTest(unittest.TestCase):
+
+    def test_run_in_executor(self):
+        ae = AsyncEvent()
+        ticker = CountingJob(0.01, 1000)
+        ae.add_scheduled_job(ticker)
+        loop_thread = threading.current_thread()
+        results = []
+
+        def blocking(value):
+            time.sleep(0.1)
+            return (value, threading.current_thread() is loop_thread)
+
+        def done(future):
+            results.append((future.result(), threading.current_thread() is loop_thread))
+            ae.set_stop_flag()
+
+        ae.run_in_executor(blocking, 42, callback = done)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(results, [((42, False), True)])
+        # the loop was not blocked while the job was running
+        self.assertGreater(ticker.count, 3)
+
+    def test_pending_job_keeps_loop_running(self):
+        ae = AsyncEvent(executor_workers = 2)
+        results = []
+        for i in range(4):
+            ae.run_in_executor(time.sleep, 0.01,
+                               callback = lambda f: results.append(f.exception()))
+        ae.run_in_executor(divmod, 1, 0,
+                           callback = lambda f: results.append(type(f.exception())))
+        ae.loop()
+        ae.close()
+        self.assertEqual(sorted(map(str, results)),
+                         sorted(map(str, [None] * 4 + [ZeroDivisionError])))
+
+class BufferedStreamTest(unittest.TestCase):
+
+    def transfer(self, edge_triggered, num_lines, read_size = None):
+        ae = AsyncEvent(api = AsyncEvent.API_EPOLL if edge_triggered else AsyncEvent.API_POLL,
+                        edge_triggered = edge_triggered)
+        sock_a, sock_b = socket.socketpair()
+        lines = [("line {:d} ".format(i) * (i % 50)).encode('ascii') + b'\n'
+                 for i in range(num_lines)]
+        # split lines at arbitrary points
+        payload = b''.join(lines)
+        chunks = [payload[i:i + 1000] for i in range(0, len(payload), 1000)]
+
+        receiver = LineReceiver(sock_a, num_lines, read_size)
+        sender = LineSender(sock_b, chunks)
+        ae.register(receiver)
+        if sender.fileno() >= 0:
+            ae.register(sender)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(receiver.lines, [line[:-1] for line in lines])
+        return receiver
+
+    def test_transfer(self):
+        self.transfer(False, 5000)
+
+    def test_small_read_size(self):
+        receiver = self.transfer(False, 200, read_size = 64)
+        self.assertTrue(receiver.calls > 100)
+
+    def test_transfer_edge_triggered(self):
+        if not hasattr(select, 'epoll'):
+            self.skipTest("epoll is not available")
+        self.transfer(True, 5000)
+
+    def test_write_buffer(self):
+        sock_a, sock_b = socket.socketpair()
+        disp = BufferedStreamDispatcher(sock = sock_a)
+        # larger than the socket buffer
+        data = bytearray(8 * 1024 * 1024)
+        disp.write(b'abc')
+        disp.write(data)
+        self.assertTrue(0 < disp.get_write_buffer_size() < len(data))
+        self.assertTrue(disp.writable())
+        self.assertEqual(sock_b.recv(3), b'abc')
+        disp.close()
+        sock_b.close()
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_size_classes(self):
+        pool = BufferPool((1024, 4096))
+        self.assertEqual(len(pool.lease(1)), 1024)
+        self.assertEqual(len(pool.lease(1024)), 1024)
+        self.assertEqual(len(pool.lease(1025)), 4096)
+        self.assertEqual(len(pool.lease(5000)), 5000)
+        stats = pool.stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['oversize'], 1)
+        self.assertEqual(stats['leased'], 4)
+
+    def test_reuse(self):
+        pool = BufferPool((1024,))
+        slab = pool.lease(100)
+        pool.release(memoryview(slab)[:10])
+        self.assertIs(pool.lease(100), slab)
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['leased']), (1, 1, 1))
+
+    def test_release_exported(self):
+        pool = BufferPool((1024,))
+        slab = pool.lease(100)
+        view = memoryview(slab)
+        self.assertRaises(BufferError, pool.release, slab)
+        view.release()
+        pool.release(slab)
+        self.assertEqual(pool.stats()['free'], {1024: 1})
+
+    def test_max_free(self):
+        pool = BufferPool((1024,), max_free = 1)
+        slabs = [pool.lease(1), pool.lease(1)]
+        for slab in slabs:
+            pool.release(slab)
+        stats = pool.stats()
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['free'], {1024: 1})
+
+    def test_recv_pooled(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = socket.socketpair()
+        reader = PooledReader(sock_a, 100)
+        ae.register(reader)
+        sock_b.sendall(b'0123456789' * 10)
+        ae.loop()
+        sock_b.close()
+
+        self.assertEqual(reader.received, b'0123456789' * 10)
+        stats = ae.buffer_pool().stats()
+        self.assertEqual(stats['leased'], 0)
+        self.assertEqual(stats['misses'], 1)
+        self.assertTrue(stats['hits'] > 0)
+        ae.close()
+
+class FramingTest(unittest.TestCase):
+
+    def feed(self, decoder, stream, step):
+        '''Feeds `stream' in pieces of `step' bytes, following the contract
+        of on_data(), returns decoded frames.'''
+
+        frames = []
+        pending = b''
+        for idx in range(0, len(stream), step):
+            pending += stream[idx:idx + step]
+            decoded, consumed = decoder.decode(memoryview(pending))
+            frames.extend(bytes(frame) for frame in decoded)
+            pending = pending[consumed:]
+        self.assertEqual(pending, b'')
+        return frames
+
+    def test_length_prefixed(self):
+        payloads = [b'', b'a', b'hello' * 100, b'x' * 70000]
+        for header_size in (1, 2, 4, 8):
+            for byteorder in ('big', 'little'):
+                encoder = LengthPrefixedEncoder(header_size, byteorder)
+                items = [p for p in payloads if len(p) < (1 << (8 * header_size))]
+                stream = b''.join(b''.join(encoder.encode(p)) for p in items)
+                for step in (1, 7, len(stream)):
+                    decoder = LengthPrefixedDecoder(header_size, byteorder)
+                    self.assertEqual(self.feed(decoder, stream, step), items)
+
+    def test_length_prefixed_errors(self):
+        self.assertRaises(ValueError, LengthPrefixedDecoder, 3)
+        self.assertRaises(ValueError, LengthPrefixedDecoder, 4, 'middle')
+        self.assertRaises(AeFrameError, LengthPrefixedEncoder(1).encode, b'x' * 256)
+        decoder = LengthPrefixedDecoder(4, max_frame_size = 10)
+        self.assertRaises(AeFrameError, decoder.decode, memoryview(b'\x00\x00\x00\x0b'))
+
+    def test_delimiter(self):
+        for delimiter in (b'\r\n', b'\n', b'--sep--'):
+            encoder = DelimiterEncoder(delimiter)
+            items = [b'', b'GET / HTTP/1.1', b'a\rb', b'y' * 1000]
+            stream = b''.join(b''.join(encoder.encode(p)) for p in items)
+            for step in (1, 2, 5, len(stream)):
+                decoder = DelimiterDecoder(delimiter)
+                self.assertEqual(self.feed(decoder, stream, step), items)
+
+    def test_delimiter_too_long(self):
+        decoder = DelimiterDecoder(max_frame_size = 4)
+        self.assertEqual(decoder.decode(memoryview(b'abcd\r')), ([], 0))
+        self.assertRaises(AeFrameError, decoder.decode, memoryview(b'abcde\r'))
+        decoder.reset()
+        self.assertRaises(AeFrameError, decoder.decode, memoryview(b'abcde\r\n'))
+
+    def test_fixed_size(self):
+        items = [bytes([i]) * 3 for i in range(10)]
+        for step in (1, 2, 4, 30):
+            self.assertEqual(self.feed(FixedSizeDecoder(3), b''.join(items), step),
+                             items)
+        self.assertRaises(AeFrameError, FixedSizeEncoder(3).encode, b'ab')
+
+    def test_framed_stream(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = socket.socketpair()
+        echo = FrameEcho(sock_a, 3)
+        ae.register(echo)
+        encoder = LengthPrefixedEncoder(2, 'little')
+        sock_b.sendall(b''.join(b''.join(encoder.encode(p))
+                                for p in (b'abc', b'', b'hello')))
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(echo.frames, [b'abc', b'', b'hello'])
+        reply = b''
+        while True:
+            data = sock_b.recv(4096)
+            if not data:
+                break
+            reply += data
+        sock_b.close()
+        self.assertEqual(reply, b'\x03\x00cba\x00\x00\x05\x00olleh')
+
+class FlowControlTest(unittest.TestCase):
+
+    def receive_all(self, sock, result, delay = 0):
+        time.sleep(delay)
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            result.append(len(data))
+        sock.close()
+
+    def test_watermarks(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        disp = WatermarkRecorder(sock_a)
+        disp.set_write_buffer_limits(65536)
+        self.assertEqual(disp.get_write_buffer_limits(), (16384, 65536))
+        ae.register(disp)
+        disp.write(bytes(4 * 1024 * 1024))
+        self.assertEqual(disp.events, ['pause'])
+        self.assertTrue(disp.is_writing_paused())
+
+        received = []
+        reader = threading.Thread(target = self.receive_all, args = (sock_b, received))
+        reader.start()
+        ae.loop()
+        reader.join()
+        ae.close()
+
+        self.assertEqual(disp.events, ['pause', 'resume'])
+        self.assertEqual(sum(received), 4 * 1024 * 1024)
+
+    def test_drained_at_once(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        # deeper than the recursion limit if on_drain() recursed
+        count = sys.getrecursionlimit() + 100
+        disp = ChunkWriter(sock_a, count)
+        ae.register(disp)
+        disp.write(b'x')
+        self.assertEqual(disp.drained, count)
+        self.assertFalse(disp.writable())
+
+        received = b''
+        while len(received) < count:
+            received += sock_b.recv(65536)
+        self.assertEqual(received, b'x' * count)
+        disp.handle_close()
+        sock_b.close()
+        ae.close()
+
+    def test_unpair(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        sock_c, sock_d = tcp_pair()
+        src = BufferedStreamDispatcher(sock = sock_a)
+        dst = BufferedStreamDispatcher(sock = sock_c)
+        ae.register(src)
+        ae.register(dst)
+        src.pair_with(dst)
+        dst.set_write_buffer_limits(1024)
+        dst.write(bytes(4 * 1024 * 1024))
+        self.assertTrue(dst.is_writing_paused())
+        self.assertTrue(src.is_reading_paused())
+
+        # dissolved by either side, the one paused by the other resumes
+        dst.pair_with(None)
+        self.assertIsNone(src.peer())
+        self.assertFalse(src.is_reading_paused())
+
+        src.pair_with(dst)
+        self.assertTrue(src.is_reading_paused())
+        src.pair_with(None)
+        self.assertFalse(src.is_reading_paused())
+
+        for disp in (src, dst):
+            disp.handle_close()
+        for sock in (sock_b, sock_d):
+            sock.close()
+        ae.close()
+
+    def test_invalid_limits(self):
+        disp = BufferedStreamDispatcher(sock = socket.socket())
+        self.assertRaises(ValueError, disp.set_write_buffer_limits, 100, 200)
+        disp.close()
+
+    def run_proxy(self, api, edge_triggered):
+        total = 8 * 1024 * 1024
+        ae = AsyncEvent(api = api, edge_triggered = edge_triggered)
+        src_far, src_near = tcp_pair()
+        dst_near, dst_far = tcp_pair()
+        for sock in (dst_near, dst_far):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+        src = Forwarder(src_near)
+        dst = Forwarder(dst_near)
+        src.pair_with(dst)
+        dst.set_write_buffer_limits(65536)
+        ae.register(src)
+        ae.register(dst)
+
+        def produce():
+            src_far.sendall(bytes(total))
+            src_far.close()
+
+        received = []
+        threads = [threading.Thread(target = produce),
+                   threading.Thread(target = self.receive_all,
+                                    args = (dst_far, received, 0.2))]
+        for thread in threads:
+            thread.start()
+        ae.loop()
+        for thread in threads:
+            thread.join()
+        ae.close()
+
+        self.assertEqual(sum(received), total)
+        self.assertTrue(src.paused > 0)
+        # one read beyond the high watermark at most
+        self.assertTrue(src.max_peer_buffer <= 65536 + src._read_size)
+
+    def test_proxy(self):
+        self.run_proxy(AsyncEvent.API_POLL, False)
+
+    def test_proxy_edge_triggered(self):
+        if not hasattr(select, 'epoll'):
+            self.skipTest("epoll is not available")
+        self.run_proxy(AsyncEvent.API_EPOLL, True)
+
+    def test_read_buffer_limit(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        disp = LineReceiver(sock_a, 3)
+        disp.set_read_buffer_limit(8)
+        ae.register(disp)
+        # no line fits into 8 bytes, reading stops
+        sock_b.sendall(b'0123456789\n')
+        job = StopLoopJob(0.1)
+        job.pollster_obj = ae
+        ae.add_scheduled_job(job)
+        ae.loop()
+        self.assertEqual(disp.lines, [])
+        self.assertEqual(disp.calls, 1)
+        sock_b.close()
+        ae.close()
+
+class SendFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.content = os.urandom(3 * 1024 * 1024 + 17)
+        self.file = tempfile.TemporaryFile()
+        self.file.write(self.content)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def transfer(self, queue_data):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        sender = FileSender(sock_a)
+        ae.register(sender)
+        queue_data(sender)
+        sender.close_when_done()
+
+        received = []
+        def receive():
+            while True:
+                data = sock_b.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+            sock_b.close()
+        reader = threading.Thread(target = receive)
+        reader.start()
+        ae.loop()
+        reader.join()
+        ae.close()
+        return sender, b''.join(received)
+
+    def test_whole_file(self):
+        sender, data = self.transfer(lambda disp: disp.send_file(self.file))
+        self.assertEqual(data, self.content)
+
+    def test_range_and_order(self):
+        def queue_data(disp):
+            disp.write(b'head')
+            disp.send_file(self.file, 1000, 2000000, disp.record)
+            disp.write(b'tail')
+        sender, data = self.transfer(queue_data)
+        self.assertEqual(data, b'head' + self.content[1000:2001000] + b'tail')
+        self.assertEqual(sender.progress[-1], (2000000, 2000000))
+        self.assertEqual(sender.progress, sorted(sender.progress))
+
+    def test_copy_fallback(self):
+        with mock.patch.object(os, 'sendfile',
+                               side_effect = OSError(errno.ENOSYS, "no sendfile")):
+            sender, data = self.transfer(lambda disp: disp.send_file(self.file.fileno(), 5))
+        self.assertEqual(data, self.content[5:])
+
+    def test_truncated(self):
+        sender, data = self.transfer(
+            lambda disp: disp.send_file(self.file, len(self.content) - 10, 100))
+        self.assertEqual(data, self.content[-10:])
+        self.assertIsInstance(sender.error, EOFError)
+
+    def test_truncated_then_write(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = tcp_pair()
+        sender = FileSender(sock_a)
+        ae.register(sender)
+        sender.send_file(self.file, len(self.content) - 10, 100)
+        # the end of the file is found by write(), not by a write event
+        sender.write(b'hello')
+        self.assertIsInstance(sender.error, EOFError)
+        self.assertIsNone(sender.pollster(False))
+        ae.close()
+
+        received = b''
+        while True:
+            data = sock_b.recv(65536)
+            if not data:
+                break
+            received += data
+        sock_b.close()
+        self.assertEqual(received, self.content[-10:])
+
+class RelayTest(unittest.TestCase):
+
+    REQUEST_SIZE = 4 * 1024 * 1024
+    REPLY_SIZE = 2 * 1024 * 1024
+
+    def receive_all(self, sock):
+        total = 0
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return total
+            total += len(data)
+
+    def run_relay(self, use_splice, api = AsyncEvent.API_POLL, edge_triggered = False):
+        ae = AsyncEvent(api = api, edge_triggered = edge_triggered)
+        client, sock_a = tcp_pair()
+        sock_b, server = tcp_pair()
+        leg_a, leg_b = RelayDispatcher.pair(sock_a, sock_b, use_splice = use_splice)
+        ae.register(leg_a)
+        ae.register(leg_b)
+        results = {}
+
+        def run_client():
+            client.sendall(bytes(self.REQUEST_SIZE))
+            client.shutdown(socket.SHUT_WR)
+            results['client'] = self.receive_all(client)
+            client.close()
+
+        def run_server():
+            # a slow receiver
+            time.sleep(0.1)
+            results['server'] = self.receive_all(server)
+            server.sendall(bytes(self.REPLY_SIZE))
+            server.close()
+
+        threads = [threading.Thread(target = run_client),
+                   threading.Thread(target = run_server)]
+        for thread in threads:
+            thread.start()
+        ae.loop()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {'client': self.REPLY_SIZE,
+                                   'server': self.REQUEST_SIZE})
+        self.assertEqual(leg_a.bytes_relayed(), self.REQUEST_SIZE)
+        self.assertEqual(leg_b.bytes_relayed(), self.REPLY_SIZE)
+        self.assertEqual(leg_a.uses_splice(), use_splice)
+        if not use_splice:
+            self.assertEqual(ae.buffer_pool().stats()['leased'], 0)
+        ae.close()
+
+    def test_copy(self):
+        self.run_relay(False)
+
+    def test_splice(self):
+        if not _relay.splice_available():
+            self.skipTest("os.splice() is not available")
+        self.run_relay(True)
+
+    def test_edge_triggered(self):
+        if not hasattr(select, 'epoll'):
+            self.skipTest("epoll is not available")
+        self.run_relay(False, AsyncEvent.API_EPOLL, True)
+        if _relay.splice_available():
+            self.run_relay(True, AsyncEvent.API_EPOLL, True)
+
+class UdpDispatcherTest(unittest.TestCase):
+
+    def run_collector(self, api, edge_triggered, count, budget):
+        ae = AsyncEvent(api = api, edge_triggered = edge_triggered)
+        collector = UdpCollector(count, budget)
+        addr = collector._sock.getsockname()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        for idx in range(count):
+            client.sendto("datagram {:d}".format(idx).encode('ascii'), addr)
+        ae.register(collector)
+        ae.loop()
+
+        acks = [client.recv(2048) for idx in range(count)]
+        client.close()
+        ae.close()
+
+        expected = ["datagram {:d}".format(idx).encode('ascii') for idx in range(count)]
+        self.assertEqual(collector.received, expected)
+        self.assertEqual(acks, [b'ack:' + data for data in expected])
+        stats = collector.stats()
+        self.assertEqual(stats['datagrams_received'], count)
+        self.assertEqual(stats['datagrams_sent'], count)
+        self.assertEqual(stats['max_recv_batch'], max(collector.batches))
+        self.assertTrue(stats['send_batches'] < count)
+        return collector
+
+    def test_batches(self):
+        collector = self.run_collector(AsyncEvent.API_POLL, False, 200, 64)
+        self.assertEqual(collector.batches, [64, 64, 64, 8])
+
+    def test_edge_triggered(self):
+        if not hasattr(select, 'epoll'):
+            self.skipTest("epoll is not available")
+        collector = self.run_collector(AsyncEvent.API_EPOLL, True, 200, 64)
+        self.assertEqual(collector.batches, [64, 64, 64, 8])
+
+    def test_truncated(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        collector = UdpCollector(1, 8)
+        collector.set_max_datagram_size(4)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto(b'0123456789', collector._sock.getsockname())
+        ae.register(collector)
+        ae.loop()
+        client.close()
+        ae.close()
+        self.assertEqual(collector.received, [b'0123'])
+        self.assertEqual(collector.stats()['truncated'], 1)
+
+    def test_sendto_unconnected(self):
+        disp = UdpDispatcher()
+        disp.initialize()
+        self.assertRaises(ValueError, disp.sendto, b'x')
+        disp.close()
+
+#  -----------------------------------------------------------------------------
+
+class UnixDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_server(self):
+        path = os.path.join(self.tmpdir.name, 'server.sock')
+        # a socket file left by a previous process
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = UnixLineServer()
+        server.initialize(path)
+        self.assertEqual(server.socket_family_repr(), "AF_UNIX")
+        self.assertIn(path, str(server))
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b'hello\n')
+        ae.register(server)
+        ae.loop()
+        client.close()
+        ae.close()
+
+        self.assertEqual(server.receiver.lines, [b'hello'])
+        self.assertFalse(os.path.exists(path))
+
+    def test_send_fds(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sender = UnixStreamDispatcher(sock_a)
+        sender.want_read(False)
+        receiver = FdReceiver(sock_b, 3)
+        ae.register(sender)
+        ae.register(receiver)
+
+        fds = [pipe_with(b'first'), pipe_with(b'second')]
+        third = pipe_with(b'third')
+        sender.write(b'head')
+        sender.send_fds(b'ab', fds, close_fds = True)
+        sender.send_fds(b'c', [third])
+        sender.close_when_done()
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(receiver.contents, [b'first', b'second', b'third'])
+        self.assertEqual(receiver.data, b'headabc')
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+        # not owned by the sender
+        os.close(third)
+
+    def test_send_fds_checks(self):
+        sock_a, sock_b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        sender = UnixStreamDispatcher(sock_a)
+        self.assertRaises(ValueError, sender.send_fds, b'', [0])
+        self.assertRaises(ValueError, sender.send_fds, b'x', [0] * 17)
+        sender.close()
+        sock_b.close()
+
+    def test_unsent_fds_closed(self):
+        sender, receiver = UnixStreamDispatcher.pair()
+        fd = pipe_with(b'data')
+        # not connected yet as far as the queue is concerned: nothing is sent
+        with mock.patch.object(sender, '_can_write', return_value = False):
+            sender.send_fds(b'x', [fd], close_fds = True)
+        sender.handle_close()
+        receiver.handle_close()
+        self.assertRaises(OSError, os.fstat, fd)
+
+    def test_datagram(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        path = os.path.join(self.tmpdir.name, 'dgram.sock')
+        collector = DatagramFdCollector(path, 2)
+        sender = UnixDatagramDispatcher()
+        sender.initialize(os.path.join(self.tmpdir.name, 'sender.sock'))
+        fd = pipe_with(b'payload')
+        sender.sendto(b'plain', path)
+        sender.sendto(b'with fd', path, fds = [fd], close_fds = True)
+        self.assertEqual(sender.flush(), 2)
+        ae.register(collector)
+        ae.loop()
+        sender.handle_close()
+        ae.close()
+
+        sender_path = os.path.join(self.tmpdir.name, 'sender.sock')
+        self.assertEqual(collector.received, [(b'plain', sender_path),
+                                              (b'with fd', sender_path)])
+        self.assertEqual(collector.contents, [b'payload'])
+        self.assertRaises(OSError, os.fstat, fd)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(sender_path))
+
+class HandoffTest(unittest.TestCase):
+
+    def test_least_loaded(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = HandoffServerDispatcher()
+        server.initialize(('127.0.0.1', 0))
+        ae.register(server)
+
+        workers = []
+        for name, base_load in ((b'a', 3), (b'b', 0)):
+            front_sock, worker_sock = socket.socketpair(socket.AF_UNIX,
+                                                        socket.SOCK_STREAM)
+            server.add_worker(front_sock)
+            worker = NamedWorker(worker_sock, name, base_load)
+            ae.register(worker)
+            workers.append(worker)
+        channels = server.workers()
+
+        # connect after the workers reported their initial load
+        connect = ConnectJob(0.1, server._sock.getsockname(), 4)
+        ae.add_scheduled_job(connect)
+        stop = StopLoopJob(0.5)
+        stop.pollster_obj = ae
+        ae.add_scheduled_job(stop)
+        ae.loop()
+
+        names = []
+        for sock in connect.clients:
+            names.append(sock.recv(64))
+            self.assertEqual(sock.recv(64), b'')
+            sock.close()
+        ae.close()
+
+        self.assertEqual(names, [b'b', b'b', b'b', b'a'])
+        self.assertEqual([worker.received() for worker in workers], [1, 3])
+        self.assertEqual([channel.handed_off() for channel in channels], [1, 3])
+        self.assertEqual([channel.load() for channel in channels], [4, 3])
+        self.assertEqual(server.workers(), [])
+
+    def test_no_worker(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = HandoffServerDispatcher()
+        server.initialize(('127.0.0.1', 0))
+        client = socket.create_connection(server._sock.getsockname())
+        ae.register(server)
+        stop = StopLoopJob(0.2)
+        stop.pollster_obj = ae
+        ae.add_scheduled_job(stop)
+        ae.loop()
+        self.assertEqual(client.recv(64), b'')
+        client.close()
+        ae.close()
+
+class ResolverTest(unittest.TestCase):
+
+    def resolve_all(self, resolver, names):
+        '''Resolves all names concurrently, returns list of 2-tuples of (name,
+        result or exception), in order of completion.'''
+
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        results = []
+        def record(name, future):
+            try:
+                results.append((name, future.result()))
+            except socket.gaierror as e:
+                results.append((name, e))
+        for name in names:
+            resolver.resolve(ae, name, 80, lambda f, name = name: record(name, f),
+                             family = socket.AF_INET, type = socket.SOCK_STREAM)
+        ae.loop()
+        ae.close()
+        return results
+
+    def test_coalesced(self):
+        fake = FakeGetaddrinfo({'svc.test': '127.0.0.2'})
+        resolver = Resolver()
+        with mock.patch('socket.getaddrinfo', fake):
+            results = self.resolve_all(resolver, ['svc.test'] * 100)
+            self.assertEqual(fake.calls, ['svc.test'])
+            self.assertEqual(len(results), 100)
+            for unused_name, infos in results:
+                self.assertEqual(infos[0][4], ('127.0.0.2', 80))
+
+            self.resolve_all(resolver, ['svc.test'])
+            self.assertEqual(fake.calls, ['svc.test'])
+
+        stats = resolver.stats()
+        self.assertEqual(stats['lookups'], 101)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['coalesced'], 99)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_negative(self):
+        fake = FakeGetaddrinfo({})
+        resolver = Resolver()
+        with mock.patch('socket.getaddrinfo', fake):
+            first = self.resolve_all(resolver, ['missing.test'] * 2)
+            second = self.resolve_all(resolver, ['missing.test'])
+        self.assertEqual(fake.calls, ['missing.test'])
+        for unused_name, error in first + second:
+            self.assertIsInstance(error, socket.gaierror)
+        self.assertIsNot(first[0][1], first[1][1])
+        stats = resolver.stats()
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['negative_hits'], 1)
+        self.assertIsNone(resolver.lookup('missing.test', 80, socket.AF_INET,
+                                          socket.SOCK_STREAM))
+
+    def test_ttl_and_size(self):
+        hosts = {'a.test': '127.0.0.2', 'b.test': '127.0.0.3', 'c.test': '127.0.0.4'}
+        resolver = Resolver(max_entries = 2, ttl = 0.2)
+        with mock.patch('socket.getaddrinfo', FakeGetaddrinfo(hosts, 0)):
+            for name in sorted(hosts):
+                self.resolve_all(resolver, [name])
+        lookup = lambda name: resolver.lookup(name, 80, socket.AF_INET, socket.SOCK_STREAM)
+
+        self.assertEqual(resolver.stats()['evictions'], 1)
+        self.assertIsNone(lookup('a.test'))
+        self.assertEqual(lookup('c.test')[0][4], ('127.0.0.4', 80))
+        time.sleep(0.3)
+        self.assertIsNone(lookup('c.test'))
+
+    def test_loop_stopped(self):
+        answered = threading.Event()
+        released = threading.Event()
+        def blocking(*args):
+            answered.wait(5.0)
+            return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+                     ('127.0.0.2', 80))]
+        resolver = Resolver()
+        ae = AsyncEvent(api = AsyncEvent.API_POLL, executor_workers = 1)
+        # occupies the only worker of the loop until the end
+        ae.run_in_executor(released.wait, 5.0)
+        with mock.patch('socket.getaddrinfo', blocking):
+            resolver.resolve(ae, 'svc.test', 80, lambda f: None)
+            ae.call_soon_threadsafe(ae.set_stop_flag)
+            ae.loop()
+            self.assertEqual(resolver.stats()['in_flight'], 1)
+
+            # the lookup in flight is finished without the stopped loop
+            answered.set()
+            results = self.resolve_all(resolver, ['svc.test'])
+        released.set()
+        ae.close()
+        resolver.shutdown()
+
+        self.assertEqual(results[0][1][0][4], ('127.0.0.2', 80))
+        self.assertEqual(resolver.stats()['in_flight'], 0)
+
+    def connect_by_name(self, api, edge_triggered):
+        fake = FakeGetaddrinfo({'svc.test': '127.0.0.1'})
+        ae = AsyncEvent(api = api, edge_triggered = edge_triggered)
+        ae.set_resolver(Resolver())
+        server = CountingServerDispatcher(3)
+        server.initialize(('127.0.0.1', 0))
+        port = server._sock.getsockname()[1]
+        ae.register(server)
+
+        clients = []
+        with mock.patch('socket.getaddrinfo', fake):
+            for i in range(3):
+                client = ConnectingClient()
+                client.initialize(('svc.test', port))
+                self.assertTrue(client.is_resolving())
+                ae.register(client)
+                clients.append(client)
+            ae.loop()
+        ae.close()
+
+        self.assertEqual(fake.calls, ['svc.test'])
+        self.assertEqual(server.accepted, 3)
+        for client in clients:
+            self.assertFalse(client.is_resolving())
+            self.assertEqual(client.peer, ('127.0.0.1', port))
+
+    def test_connect_by_name(self):
+        self.connect_by_name(AsyncEvent.API_POLL, False)
+        self.connect_by_name(AsyncEvent.API_EPOLL, True)
+
+    def test_connect_unknown_name(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        ae.set_resolver(Resolver())
+        client = ConnectingClient()
+        client.initialize()
+        ae.register(client)
+        with mock.patch('socket.getaddrinfo', FakeGetaddrinfo({})):
+            self.assertEqual(client.connect(('missing.test', 80)), errno.EINPROGRESS)
+            ae.loop()
+        ae.close()
+
+        self.assertIsInstance(client.error, socket.gaierror)
+        self.assertIsNone(client.pollster(False))
+
+class HappyEyeballsTest(unittest.TestCase):
+
+    def blackholed(self):
+        '''Returns a listening IPv6 socket with a full accept queue, new
+        connections to which hang, and the connections filling it.'''
+
+        server = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        server.bind(('::1', 0))
+        server.listen(0)
+        fillers = []
+        for i in range(3):
+            filler = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            filler.setblocking(False)
+            filler.connect_ex(server.getsockname()[:2])
+            fillers.append(filler)
+        time.sleep(0.05)
+        return server, fillers
+
+    def connect_by_name(self, addrs, attempt_delay, port = 0, serve = True):
+        '''Connects to a name resolved to `addrs', a server is listening on
+        127.0.0.1 if `serve' is True.
+
+        Returns:
+          3-tuple of (client, its fd before connected, seconds elapsed).
+        '''
+
+        fake = FakeGetaddrinfo({'dual.test': addrs}, delay = 0)
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        ae.set_resolver(Resolver())
+        if serve:
+            server = CountingServerDispatcher(1)
+            server.initialize(('127.0.0.1', port))
+            port = server._sock.getsockname()[1]
+            ae.register(server)
+        else:
+            # nobody is listening on this port
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+
+        client = ConnectingClient()
+        client.set_attempt_delay(attempt_delay)
+        with mock.patch('socket.getaddrinfo', fake):
+            client.initialize(('dual.test', port), connect_timeout = 5.0)
+            fd = client.fileno()
+            ae.register(client)
+            start = time.time()
+            ae.loop()
+        elapsed = time.time() - start
+        ae.close()
+        return client, fd, elapsed
+
+    def test_dual_stack_server(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = CountingServerDispatcher(2)
+        server.initialize(('', 0), dual_stack = True)
+        self.assertEqual(server.socket_family(), socket.AF_INET6)
+        port = server._sock.getsockname()[1]
+        ae.register(server)
+
+        clients = []
+        for host in ('127.0.0.1', '::1'):
+            client = ConnectingClient()
+            client.initialize((host, port))
+            ae.register(client)
+            clients.append(client)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(server.accepted, 2)
+        self.assertEqual(clients[0].socket_family(), socket.AF_INET)
+        self.assertEqual(clients[0].peer, ('127.0.0.1', port))
+        self.assertEqual(clients[1].socket_family(), socket.AF_INET6)
+        self.assertEqual(clients[1].peer[:2], ('::1', port))
+
+    def test_connect_other_family(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = CountingServerDispatcher(1)
+        server.initialize(('::1', 0))
+        port = server._sock.getsockname()[1]
+        ae.register(server)
+
+        client = ConnectingClient()
+        client.initialize()
+        self.assertEqual(client.socket_family(), socket.AF_INET)
+        fd = client.fileno()
+        ae.register(client)
+        self.assertEqual(client.connect(('::1', port)), errno.EINPROGRESS)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(client.peer[:2], ('::1', port))
+        self.assertEqual(client.socket_family(), socket.AF_INET6)
+        self.assertEqual(client.fd, fd)
+
+    def test_race_blackholed(self):
+        blackhole, fillers = self.blackholed()
+        port = blackhole.getsockname()[1]
+        try:
+            client, fd, elapsed = self.connect_by_name(['::1', '127.0.0.1'],
+                                                       0.05, port = port)
+        finally:
+            blackhole.close()
+            for filler in fillers:
+                filler.close()
+
+        # the IPv6 attempt was cancelled once the IPv4 one was connected
+        self.assertEqual(client.peer, ('127.0.0.1', port))
+        self.assertEqual(client.socket_family(), socket.AF_INET)
+        self.assertEqual(client.fd, fd)
+        self.assertGreaterEqual(elapsed, 0.05)
+        self.assertLess(elapsed, 1.0)
+
+    def test_refused_falls_back(self):
+        # no IPv6 server, attempts are not raced
+        client, fd, elapsed = self.connect_by_name(['::1', '127.0.0.1'], None)
+        self.assertEqual(client.peer[0], '127.0.0.1')
+        self.assertEqual(client.fd, fd)
+        self.assertIsNone(client.error)
+
+    def test_all_failed(self):
+        client, fd, elapsed = self.connect_by_name(['::1', '127.0.0.1'], 0.05,
+                                                   serve = False)
+        self.assertIsInstance(client.error, ConnectionRefusedError)
+        self.assertIsNone(client.peer)
+        self.assertIsNone(client.pollster(False))
+
+def tcp_options(sock):
+    '''Returns options of a TCP socket, as set by SocketProfile.'''
+
+    return {
+        'nodelay':      sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+        'keepalive':    sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+        'keepidle':     sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE),
+        'keepcnt':      sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT),
+        'user_timeout': sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT),
+        'sndbuf':       sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        }
+
+class OptionRecordingServer(CountingServerDispatcher):
+    def __init__(self, expected):
+        CountingServerDispatcher.__init__(self, expected)
+        self.options = []
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        self.options.append(tcp_options(conn_sock))
+        CountingServerDispatcher.prepare_serving_client(self, conn_sock, conn_addr)
+
+class FailingSocket(object):
+    '''Stands in for a socket, setsockopt() of which always fails.'''
+
+    family = socket.AF_INET
+
+    def __init__(self):
+        self.calls = 0
+
+    def fileno(self):
+        return -1
+
+    def setsockopt(self, level, optname, value):
+        self.calls += 1
+        raise OSError(errno.ENOPROTOOPT, "Protocol not available")
+
+class SocketProfileTest(unittest.TestCase):
+
+    def test_validation(self):
+        self.assertRaises(ValueError, SocketProfile, sndbuf = 0)
+        self.assertRaises(TypeError, SocketProfile, rcvbuf = '64k')
+        self.assertRaises(TypeError, SocketProfile, keepalive_count = True)
+        self.assertRaises(ValueError, SocketProfile, user_timeout = -1)
+
+        profile = SocketProfile(keepalive_idle = 30, user_timeout = 2.5,
+                                fastopen = True)
+        self.assertEqual(profile.options(),
+                         {'keepalive': 1, 'keepalive_idle': 30,
+                          'user_timeout': 2500, 'fastopen': 16,
+                          'fastopen_connect': 1})
+        self.assertEqual(set(profile.report().values()),
+                         set([SocketProfile.STATUS_NOT_APPLIED]))
+
+        profile = SocketProfile.bulk_transfer(buffer_size = 1 << 20, nodelay = True)
+        self.assertEqual(profile.options(),
+                         {'nodelay': 1, 'sndbuf': 1 << 20, 'rcvbuf': 1 << 20})
+
+    def test_client_and_accepted(self):
+        profile = SocketProfile(nodelay = True, keepalive_idle = 30,
+                                keepalive_count = 3, user_timeout = 2.5,
+                                sndbuf = 65536)
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server = OptionRecordingServer(2)
+        server.initialize(('127.0.0.1', 0), profile = profile)
+        self.assertIs(server.socket_profile(), profile)
+        port = server._sock.getsockname()[1]
+        ae.register(server)
+
+        clients = []
+        for i in range(2):
+            client = ConnectingClient()
+            client.initialize(('127.0.0.1', port), profile = profile)
+            clients.append((client, tcp_options(client._sock)))
+            ae.register(client)
+        ae.loop()
+        ae.close()
+
+        expected = {'nodelay': 1, 'keepalive': 1, 'keepidle': 30, 'keepcnt': 3,
+                    'user_timeout': 2500}
+        self.assertEqual(server.accepted, 2)
+        for options in server.options + [options for unused, options in clients]:
+            # doubled by Linux, for bookkeeping overhead; accepted sockets
+            # inherit it from the listening socket
+            self.assertGreaterEqual(options.pop('sndbuf'), 65536)
+            self.assertEqual(options, expected)
+        self.assertEqual(set(profile.report().values()),
+                         set([SocketProfile.STATUS_OK]))
+
+    def test_listener_options(self):
+        profile = SocketProfile.low_latency(fastopen = 8, defer_accept = 5)
+        server = TcpServerDispatcher()
+        server.initialize(('127.0.0.1', 0), profile = profile)
+        sock = server._sock
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN), 8)
+        # rounded up to a number of SYN-ACK retransmissions
+        self.assertGreaterEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT), 5)
+        # options of connections are not set on the listening socket
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 0)
+        self.assertEqual(profile.report()['nodelay'], SocketProfile.STATUS_NOT_APPLIED)
+        server.close()
+
+    def test_failure_reported_once(self):
+        profile = SocketProfile(nodelay = True)
+        sock = FailingSocket()
+        profile.apply(sock, SocketProfile.ROLE_CLIENT)
+        profile.apply(sock, SocketProfile.ROLE_CLIENT)
+        self.assertEqual(sock.calls, 1)
+        self.assertIn("Protocol not available", profile.report()['nodelay'])
+
+class CallLaterJob(ScheduledJob):
+    def __init__(self, delay, callback, *args):
+        ScheduledJob.__init__(self)
+        self.deadline = time.time() + delay
+        self.callback = callback
+        self.args = args
+        self.fired = False
+
+    def schedule(self):
+        return not self.fired and self.deadline or None
+
+    def handle_job_event(self):
+        self.fired = True
+        self.callback(*self.args)
+
+class HoldingServer(TcpServerDispatcher):
+    '''Keeps connections accepted open, without reading them.'''
+
+    def __init__(self):
+        TcpServerDispatcher.__init__(self)
+        self.connections = []
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        self.connections.append(conn_sock)
+
+    def handle_close(self):
+        for sock in self.connections:
+            sock.close()
+        TcpServerDispatcher.handle_close(self)
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        self.server = HoldingServer()
+        self.server.initialize(('127.0.0.1', 0))
+        self.addr = ('127.0.0.1', self.server._sock.getsockname()[1])
+        self.ae.register(self.server)
+        self.results = []
+
+    def tearDown(self):
+        self.ae.close()
+
+    def finish(self, pool):
+        pool.close()
+        self.server.handle_close()
+
+    def test_reuse(self):
+        pool = ConnectionPool(self.ae)
+
+        def first(sock, error):
+            self.results.append((sock, error))
+            pool.release(sock)
+            pool.acquire(self.addr, second)
+
+        def second(sock, error):
+            self.results.append((sock, error))
+            self.stats = pool.stats()
+            pool.release(sock)
+            self.finish(pool)
+
+        pool.acquire(self.addr, first)
+        self.ae.loop()
+
+        (sock1, error1), (sock2, error2) = self.results
+        self.assertIsNone(error1)
+        self.assertIs(sock1, sock2)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.stats['hits'], 1)
+        self.assertEqual(self.stats['misses'], 1)
+        self.assertEqual(self.stats['connects'], 1)
+        self.assertEqual(self.stats['in_use'], 1)
+        # closed by close()
+        self.assertEqual(sock1.fileno(), -1)
+
+    def test_waiters(self):
+        pool = ConnectionPool(self.ae, max_total = 2)
+
+        def on_connection(sock, error):
+            self.results.append(sock)
+            if len(self.results) == 2:
+                # the third one is waiting
+                self.ae.add_scheduled_job(CallLaterJob(0.05, pool.release, self.results[0]))
+            elif len(self.results) == 3:
+                self.stats = pool.stats()
+                self.finish(pool)
+
+        for i in range(3):
+            pool.acquire(self.addr, on_connection)
+        self.ae.loop()
+
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertIs(self.results[2], self.results[0])
+        self.assertEqual(self.stats['waits'], 1)
+        self.assertEqual(self.stats['connects'], 2)
+        self.assertGreaterEqual(self.stats['wait_time_max'], 0.04)
+        self.assertEqual(self.stats['in_use'], 2)
+
+    def test_acquire_timeout(self):
+        pool = ConnectionPool(self.ae, max_total = 1)
+
+        def first(sock, error):
+            self.results.append(sock)
+            pool.acquire(self.addr, second, timeout = 0.05)
+
+        def second(sock, error):
+            self.results.append(error)
+            pool.discard(self.results[0])
+            self.finish(pool)
+
+        pool.acquire(self.addr, first)
+        self.ae.loop()
+
+        self.assertIsInstance(self.results[1], TimeoutError)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_dead_connection(self):
+        pool = ConnectionPool(self.ae)
+
+        def first(sock, error):
+            self.results.append(sock)
+            pool.release(sock)
+            # closed by the peer while idle
+            self.server.connections[0].close()
+            self.ae.add_scheduled_job(CallLaterJob(0.05, pool.acquire, self.addr, second))
+
+        def second(sock, error):
+            self.results.append(sock)
+            pool.release(sock)
+            self.finish(pool)
+
+        pool.acquire(self.addr, first)
+        self.ae.loop()
+
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(pool.stats()['dead'], 1)
+        self.assertEqual(pool.stats()['connects'], 2)
+
+    def test_idle_eviction(self):
+        pool = ConnectionPool(self.ae, min_idle = 1, idle_timeout = 0.05)
+
+        def on_connection(sock, error):
+            self.results.append(sock)
+            if len(self.results) == 2:
+                for sock in self.results:
+                    pool.release(sock)
+                self.ae.add_scheduled_job(CallLaterJob(0.2, check))
+
+        def check():
+            self.stats = pool.stats()
+            self.finish(pool)
+
+        pool.acquire(self.addr, on_connection)
+        pool.acquire(self.addr, on_connection)
+        self.ae.loop()
+
+        # a spare one was established for min_idle, two of three evicted
+        self.assertEqual(self.stats['evictions'], 2)
+        self.assertEqual(self.stats['idle'], 1)
+        self.assertEqual(len(self.server.connections), 3)
+
+    def test_discard_tops_up(self):
+        pool = ConnectionPool(self.ae, max_total = 2, min_idle = 1)
+
+        def on_connection(sock, error):
+            self.results.append(sock)
+            if len(self.results) == 1:
+                # takes the spare one established for min_idle
+                pool.acquire(self.addr, on_connection)
+            else:
+                self.before = pool.stats()
+                pool.discard(self.results[0])
+                self.ae.add_scheduled_job(CallLaterJob(0.2, check))
+
+        def check():
+            self.stats = pool.stats()
+            pool.release(self.results[1])
+            self.finish(pool)
+
+        pool.acquire(self.addr, on_connection)
+        self.ae.loop()
+
+        self.assertEqual((self.before['idle'], self.before['in_use']), (0, 2))
+        self.assertEqual((self.stats['idle'], self.stats['in_use']), (1, 1))
+        self.assertEqual(self.stats['connects'], 3)
+
+    def test_timer_rearmed_lazily(self):
+        pool = ConnectionPool(self.ae, idle_timeout = 0.05)
+        rounds = 100
+
+        def on_connection(sock, error):
+            self.results.append(sock)
+            pool.release(sock)
+            if len(self.results) < rounds:
+                pool.acquire(self.addr, on_connection)
+            else:
+                self.ae.add_scheduled_job(CallLaterJob(0.2, check))
+
+        def check():
+            self.stats = pool.stats()
+            self.finish(pool)
+
+        with mock.patch.object(self.ae, 'add_scheduled_job',
+                               wraps = self.ae.add_scheduled_job) as add:
+            pool.acquire(self.addr, on_connection)
+            self.ae.loop()
+        armed = [call for call in add.call_args_list if call[0][0] is pool._timer]
+
+        self.assertEqual(self.stats['hits'], rounds - 1)
+        self.assertEqual(self.stats['evictions'], 1)
+        # once by the first release, once by close()
+        self.assertEqual(len(armed), 2)
+
+    def test_connect_failure(self):
+        # nobody is listening on this port
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            addr = sock.getsockname()
+        self.server.handle_close()
+        pool = ConnectionPool(self.ae)
+
+        pool.acquire(addr, lambda sock, error: self.results.append((sock, error)))
+        self.ae.loop()
+
+        ((sock, error),) = self.results
+        self.assertIsNone(sock)
+        self.assertIsInstance(error, ConnectionRefusedError)
+        self.assertEqual(pool.stats()['connect_failures'], 1)
+        pool.close()
+        self.assertRaises(nebula.asyncevent.AeError, pool.acquire, addr, None)
+
+def make_certificate(directory):
+    '''Creates a self-signed certificate of 127.0.0.1 with the openssl
+    command, returns 2-tuple of (certfile, keyfile), or (None, None).'''
+
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec',
+                        '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                        '-keyout', keyfile, '-out', certfile, '-days', '1',
+                        '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                       check = True, stdout = subprocess.DEVNULL,
+                       stderr = subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return certfile, keyfile
+
+class TlsEcho(TlsStreamDispatcher):
+    def on_data(self, data):
+        self.write(bytes(data))
+
+    def handle_error(self, exception_obj):
+        self.error = exception_obj
+        TlsStreamDispatcher.handle_error(self, exception_obj)
+
+class TlsEchoServer(TlsServerDispatcher):
+    def __init__(self, expected, context):
+        TlsServerDispatcher.__init__(self, context = context)
+        self.expected = expected
+        self.connections = []
+
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        conn = TlsEcho(conn_sock, context = self.tls_context(), server_side = True)
+        self.connections.append(conn)
+        self.pollster().register(conn)
+        if len(self.connections) == self.expected:
+            self.handle_close()
+
+class TlsRequester(TlsStreamDispatcher):
+    '''Writes `message' (before the handshake completed), closes once it was
+    echoed, then calls `on_done'.'''
+
+    def __init__(self, message, on_done = None, **kwargs):
+        TlsStreamDispatcher.__init__(self, **kwargs)
+        self.message = message
+        self.on_done = on_done
+        self.received = b''
+        self.handshakes = 0
+        self.reused = None
+        self.error = None
+        self.write(message)
+
+    def on_handshake(self):
+        self.handshakes += 1
+        self.reused = self.session_reused()
+
+    def on_data(self, data):
+        self.received += bytes(data)
+        if len(self.received) >= len(self.message):
+            self.handle_close()
+            if self.on_done:
+                self.on_done()
+
+    def handle_error(self, exception_obj):
+        self.error = exception_obj
+        TlsStreamDispatcher.handle_error(self, exception_obj)
+
+class StalledTlsWriter(TlsRequester):
+    '''Writes `message' once the handshake completed, while reading is
+    paused, and the first SSL_write() asks for reading.'''
+
+    def __init__(self, message, **kwargs):
+        # nothing queued before the handshake
+        TlsRequester.__init__(self, b'', **kwargs)
+        self.message = message
+
+    def on_handshake(self):
+        TlsRequester.on_handshake(self)
+        self.pause_reading()
+        with mock.patch.object(self._sock, 'send', side_effect = ssl.SSLWantReadError()):
+            self.write(self.message)
+        self.stalled_interest = (self.readable(), self.writable())
+        self.pollster().add_scheduled_job(CallLaterJob(0.05, self.resume_reading))
+
+class TlsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.certfile, cls.keyfile = make_certificate(cls.tmpdir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        if self.certfile is None:
+            self.skipTest("openssl command is not available")
+        self.server_context = tls_context(server_side = True,
+                                          certfile = self.certfile,
+                                          keyfile = self.keyfile)
+        self.context = tls_context(cafile = self.certfile)
+
+    def serve(self, ae, expected):
+        server = TlsEchoServer(expected, self.server_context)
+        server.initialize(('127.0.0.1', 0))
+        ae.register(server)
+        return server, ('127.0.0.1', server._sock.getsockname()[1])
+
+    def test_shared_context(self):
+        self.assertIs(tls_context(cafile = self.certfile), self.context)
+        self.assertIsNot(tls_context(cafile = self.certfile, verify = False),
+                         self.context)
+        self.assertEqual(self.context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertRaises(ValueError, TlsServerDispatcher, context = self.context)
+        self.assertRaises(ValueError, TlsStreamDispatcher, server_side = True)
+
+        with mock.patch.object(_tls_dispatcher, '_MAX_CONTEXTS', 2):
+            tls_context(cafile = self.certfile, ciphers = 'HIGH')
+            tls_context(cafile = self.certfile, alpn_protocols = ('h2',))
+            self.assertEqual(len(_tls_dispatcher._contexts), 2)
+            # dropped, the least recently used
+            self.assertIsNot(tls_context(cafile = self.certfile), self.context)
+
+    def run_clients(self, ae, count, message):
+        server, addr = self.serve(ae, count)
+        cache = TlsSessionCache()
+        clients = []
+
+        def start():
+            client = TlsRequester(message, on_done = len(clients) < count - 1 and start,
+                                  context = self.context, session_cache = cache)
+            clients.append(client)
+            client.initialize(addr)
+            ae.register(client)
+
+        start()
+        ae.loop()
+        ae.close()
+        return server, clients, cache
+
+    def test_resumption(self):
+        # several records each way, written before the handshake completed
+        message = bytes(range(256)) * 400
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server, clients, cache = self.run_clients(ae, 3, message)
+
+        for client in clients:
+            self.assertIsNone(client.error)
+            self.assertEqual(client.handshakes, 1)
+            self.assertEqual(client.received, message)
+        self.assertEqual([client.reused for client in clients], [False, True, True])
+        stats = cache.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 2))
+        self.assertEqual((stats['full_handshakes'], stats['resumed']), (1, 2))
+        self.assertEqual(stats['size'], 1)
+
+    def test_edge_triggered(self):
+        ae = AsyncEvent(api = AsyncEvent.API_EPOLL, edge_triggered = True)
+        if not ae.edge_triggered():
+            self.skipTest("epoll is not available")
+        message = b'x' * 100000
+        server, clients, cache = self.run_clients(ae, 2, message)
+
+        self.assertEqual([client.received for client in clients], [message] * 2)
+        self.assertEqual([client.reused for client in clients], [False, True])
+
+    def test_write_wants_read(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server, addr = self.serve(ae, 1)
+        client = StalledTlsWriter(b'ping', context = self.context,
+                                  session_cache = TlsSessionCache())
+        client.initialize(addr)
+        ae.register(client)
+        ae.loop()
+        ae.close()
+
+        self.assertIsNone(client.error)
+        self.assertEqual(client.stalled_interest, (True, True))
+        self.assertEqual(client.received, b'ping')
+
+    def test_verification_failed(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        server, addr = self.serve(ae, 1)
+        cache = TlsSessionCache()
+        # the self-signed certificate is not trusted by the default context
+        client = TlsRequester(b'hello', context = tls_context(), session_cache = cache)
+        client.initialize(addr)
+        ae.register(client)
+        ae.loop()
+        ae.close()
+
+        self.assertIsInstance(client.error, ssl.SSLCertVerificationError)
+        self.assertEqual(client.handshakes, 0)
+        self.assertIsInstance(server.connections[0].error, ssl.SSLError)
+        self.assertEqual(len(cache), 0)
+
+class PipeCollector(PipeDispatcher):
+    def __init__(self, fd):
+        PipeDispatcher.__init__(self, fd)
+        self.received = b''
+        self.eof = False
+
+    def on_data(self, data):
+        self.received += bytes(data)
+
+    def on_eof(self):
+        self.eof = True
+        self.handle_close()
+
+class CollectingChild(SubprocessDispatcher):
+    def __init__(self, args, **kwargs):
+        SubprocessDispatcher.__init__(self, args, **kwargs)
+        self.stdout_data = b''
+        self.stderr_data = b''
+        self.exit_status = None
+        self.paused = 0
+
+    def on_stdout(self, data):
+        self.stdout_data += bytes(data)
+
+    def on_stderr(self, data):
+        self.stderr_data += bytes(data)
+
+    def on_exit(self, returncode):
+        # output was read to the end
+        self.exit_status = (returncode, self.stdout() is None, self.stderr() is None)
+
+    def pause_writing(self):
+        self.paused += 1
+
+class SubprocessTest(unittest.TestCase):
+
+    def test_pipe(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        rd, wr = os.pipe()
+        data = os.urandom(1 << 20)
+        reader = PipeCollector(rd)
+        writer = PipeDispatcher(wr)
+        self.assertFalse(writer.readable())
+        ae.register(reader)
+        ae.register(writer)
+        # more than the capacity of the pipe
+        writer.write(data)
+        writer.close_when_done()
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(reader.received, data)
+        self.assertTrue(reader.eof)
+        self.assertEqual(writer.fileno(), -1)
+
+    def test_streaming(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        data = os.urandom(1 << 20)
+        child = CollectingChild(['cat'])
+        ae.register(child)
+        for i in range(0, len(data), 65536):
+            child.write(data[i:i + 65536])
+        child.close_stdin()
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(child.stdout_data, data)
+        self.assertEqual(child.exit_status, (0, True, True))
+        self.assertEqual(child.returncode(), 0)
+        self.assertGreaterEqual(child.paused, 1)
+        self.assertIsNone(child.stdin())
+
+    def test_stderr_and_status(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        child = CollectingChild([sys.executable, '-c',
+                                 'import sys; sys.stderr.write("oops"); sys.exit(3)'],
+                                stdin = subprocess.DEVNULL)
+        self.assertIsNone(child.stdin())
+        self.assertRaises(ValueError, child.write, b'x')
+        ae.register(child)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual(child.stderr_data, b'oops')
+        self.assertEqual(child.exit_status, (3, True, True))
+
+    def test_many_children(self):
+        ae = AsyncEvent(api = AsyncEvent.API_EPOLL, edge_triggered = True)
+        children = [CollectingChild(['echo', str(i)], stdin = subprocess.DEVNULL)
+                    for i in range(20)]
+        for child in children:
+            ae.register(child)
+        ae.loop()
+        ae.close()
+
+        self.assertEqual([child.stdout_data for child in children],
+                         [b'%d\n' % i for i in range(20)])
+        self.assertEqual([child.exit_status for child in children],
+                         [(0, True, True)] * 20)
+
+    def test_sigchld(self):
+        previous = signal.getsignal(signal.SIGCHLD)
+        self.addCleanup(signal.signal, signal.SIGCHLD, previous)
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        with mock.patch.object(_pipe_dispatcher, '_pidfd_open', None), \
+             mock.patch.object(_pipe_dispatcher, '_child_watcher',
+                               _pipe_dispatcher._ChildWatcher()):
+            children = [CollectingChild([sys.executable, '-c', 'print(%d)' % i])
+                        for i in range(3)]
+            self.assertIsNotNone(children[0]._wakeup_fds)
+            for child in children:
+                child.close_stdin()
+                ae.register(child)
+            ae.loop()
+            # restored once the last child was reaped
+            self.assertEqual(signal.getsignal(signal.SIGCHLD), previous)
+        ae.close()
+
+        self.assertEqual([child.stdout_data for child in children],
+                         [b'0\n', b'1\n', b'2\n'])
+        self.assertEqual([child.returncode() for child in children], [0, 0, 0])
+
+    def killed_on_close(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        child = CollectingChild(['sleep', '10'])
+        ae.register(child)
+        ae.add_scheduled_job(CallLaterJob(0.05, child.handle_close))
+        started = time.time()
+        # reaped by the loop, not by a blocking wait()
+        with mock.patch.object(child._popen, 'wait', side_effect = AssertionError):
+            ae.loop()
+        ae.close()
+
+        self.assertLess(time.time() - started, 5.0)
+        self.assertEqual(child.returncode(), -signal.SIGKILL)
+        self.assertIsNone(child.exit_status)
+
+    def test_killed_on_close(self):
+        self.killed_on_close()
+
+    def test_killed_on_close_sigchld(self):
+        previous = signal.getsignal(signal.SIGCHLD)
+        self.addCleanup(signal.signal, signal.SIGCHLD, previous)
+        with mock.patch.object(_pipe_dispatcher, '_pidfd_open', None), \
+             mock.patch.object(_pipe_dispatcher, '_child_watcher',
+                               _pipe_dispatcher._ChildWatcher()):
+            self.killed_on_close()
+
+#  -----------------------------------------------------------------------------
+
+class PreforkServerTest(unittest.TestCase):
+
+    def ask_pid(self, addr):
+        for i in range(100):
+            try:
+                with socket.create_connection(addr, timeout = 5.0) as sock:
+                    return int(sock.recv(64))
+            except ConnectionRefusedError:
+                time.sleep(0.02)
+        raise AssertionError("server is not running")
+
+    def check_mode(self, mode):
+        server = PreforkServer(('127.0.0.1', 0), PidServerDispatcher,
+                               num_workers = 2, mode = mode,
+                               shutdown_timeout = 1.0)
+        master = os.fork()
+        if not master:
+            status = 1
+            try:
+                server.run()
+                status = 0
+            finally:
+                os._exit(status)
+
+        server.close()
+        pids = set(self.ask_pid(server.local_addr()) for i in range(20))
+        os.kill(master, signal.SIGTERM)
+        unused_pid, status = os.waitpid(master, 0)
+
+        self.assertEqual(status, 0)
+        self.assertNotIn(master, pids)
+        self.assertTrue(1 <= len(pids) <= 2)
+
+    def test_reuseport(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.skipTest("SO_REUSEPORT is not available")
+        self.check_mode(PreforkServer.MODE_REUSEPORT)
+
+    def test_shared(self):
+        self.check_mode(PreforkServer.MODE_SHARED)
+
+# run by HotUpgradeTest, as `script package_root'
+_UPGRADE_SCRIPT = r'''
+import os, sys
+sys.path.insert(0, sys.argv[1])
+from nebula.asyncevent import (AsyncEvent, BufferedStreamDispatcher,
+                               HotUpgrade, TcpServerDispatcher)
+
+class Echo(BufferedStreamDispatcher):
+    def on_data(self, data):
+        self.write(bytes(data))
+
+class Server(TcpServerDispatcher):
+    def prepare_serving_client(self, conn_sock, conn_addr):
+        conn = Echo(conn_sock)
+        self.pollster().register(conn)
+        conn.write(b"%d\n" % os.getpid())
+
+ae = AsyncEvent()
+upgrade = HotUpgrade(drain_timeout = 5.0)
+server = upgrade.create_server(Server, ("127.0.0.1", 0))
+ae.register(server)
+upgrade.install(ae)
+upgrade.ready()
+if not upgrade.has_predecessor():
+    print(server._sock.getsockname()[1], flush = True)
+ae.loop()
+'''
+
+def recv_line(sock):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(64)
+        if not chunk:
+            raise EOFError("connection closed")
+        data += chunk
+    return data
+
+class HotUpgradeTest(unittest.TestCase):
+
+    def test_inherit(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        port = listener.getsockname()[1]
+        unused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        unused.bind(('127.0.0.1', 0))
+        unused.listen(8)
+        os.environ[_hot_upgrade.ENV_LISTEN_FDS] = "{:d},{:d}".format(
+            listener.detach(), unused.fileno())
+        unused.detach()
+
+        upgrade = HotUpgrade()
+        self.assertTrue(upgrade.has_predecessor())
+        self.assertNotIn(_hot_upgrade.ENV_LISTEN_FDS, os.environ)
+        self.assertIsNone(upgrade.listening_socket(('127.0.0.2', port)))
+        server = upgrade.create_server(TcpServerDispatcher, ('127.0.0.1', port))
+        self.assertEqual(server.local_addr()[1], port)
+        self.assertTrue(server._accepting)
+        self.assertIsNone(upgrade.listening_socket(('127.0.0.1', port)))
+
+        inherited = upgrade._inherited[0]
+        upgrade.ready()
+        self.assertEqual(inherited.fileno(), -1)
+        server.close()
+
+        # not started by an upgrade, binds a new socket
+        upgrade = HotUpgrade()
+        self.assertFalse(upgrade.has_predecessor())
+        server = upgrade.create_server(TcpServerDispatcher, ('127.0.0.1', 0))
+        self.assertTrue(server._accepting)
+        server.close()
+
+    def test_inherit_wildcard(self):
+        listeners = []
+        for family, host in ((socket.AF_INET, ''), (socket.AF_INET6, '::'),
+                             (socket.AF_INET, '127.0.0.1')):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind((host, 0))
+            sock.listen(8)
+            listeners.append(sock)
+        ports = [sock.getsockname()[1] for sock in listeners]
+        os.environ[_hot_upgrade.ENV_LISTEN_FDS] = ",".join(
+            str(sock.detach()) for sock in listeners)
+
+        upgrade = HotUpgrade()
+        # the wildcard address of the other family is a different socket
+        self.assertIsNone(upgrade.listening_socket(('::', ports[0])))
+        sock = upgrade.listening_socket(('', ports[0]))
+        self.assertEqual(sock.getsockname(), ('0.0.0.0', ports[0]))
+        sock.close()
+        sock = upgrade.listening_socket(('::', ports[1], 0, 0))
+        self.assertEqual(sock.family, socket.AF_INET6)
+        sock.close()
+        server = upgrade.create_server(TcpServerDispatcher, ('localhost', ports[2]))
+        self.assertEqual(server.local_addr(), ('127.0.0.1', ports[2]))
+        self.assertEqual(upgrade._inherited, [])
+        server.close()
+
+    def test_successor_failed(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        upgrade = HotUpgrade(argv = [sys.executable, '-c', 'import sys; sys.exit(3)'])
+        server = upgrade.create_server(TcpServerDispatcher, ('127.0.0.1', 0))
+        ae.register(server)
+        self.assertTrue(upgrade.upgrade(ae))
+        self.assertTrue(upgrade.is_upgrading())
+        self.assertFalse(upgrade.upgrade(ae))
+
+        def check():
+            if upgrade.is_upgrading():
+                ae.add_scheduled_job(CallLaterJob(0.02, check))
+            else:
+                self.registered = server.pollster(False) is not None
+                server.handle_close()
+
+        check()
+        ae.loop()
+        ae.close()
+
+        # still accepting
+        self.assertTrue(self.registered)
+        self.assertFalse(upgrade.is_draining())
+
+    def test_successor_not_ready(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL)
+        upgrade = HotUpgrade(argv = [sys.executable, '-c', 'import time; time.sleep(30)'],
+                             ready_timeout = 0.1)
+        server = upgrade.create_server(TcpServerDispatcher, ('127.0.0.1', 0))
+        ae.register(server)
+        self.assertTrue(upgrade.upgrade(ae))
+        successor = upgrade._successor
+
+        def check():
+            if upgrade.is_upgrading():
+                ae.add_scheduled_job(CallLaterJob(0.02, check))
+            else:
+                server.handle_close()
+
+        check()
+        started = time.time()
+        # killed, and reaped by the loop, not by a blocking wait()
+        with mock.patch.object(successor, 'wait', side_effect = AssertionError):
+            ae.loop()
+        ae.close()
+
+        self.assertLess(time.time() - started, 10.0)
+        self.assertEqual(successor.returncode, -signal.SIGKILL)
+
+    def test_upgrade(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        script = os.path.join(tmpdir.name, 'server.py')
+        with open(script, 'w') as f:
+            f.write(_UPGRADE_SCRIPT)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(nebula.__file__)))
+        old = subprocess.Popen([sys.executable, script, root], stdout = subprocess.PIPE)
+        self.addCleanup(old.stdout.close)
+        self.addCleanup(old.kill)
+        port = int(old.stdout.readline())
+
+        def connect():
+            sock = socket.create_connection(('127.0.0.1', port), timeout = 5.0)
+            return sock, int(recv_line(sock))
+
+        in_flight, pid = connect()
+        self.assertEqual(pid, old.pid)
+
+        # connect again and again during the upgrade
+        pids = []
+        refused = []
+        stop = threading.Event()
+        def hammer():
+            while not stop.is_set():
+                try:
+                    sock, pid = connect()
+                    sock.close()
+                    pids.append(pid)
+                except ConnectionRefusedError:
+                    refused.append(time.time())
+        thread = threading.Thread(target = hammer)
+        thread.start()
+
+        try:
+            os.kill(old.pid, signal.SIGUSR2)
+            deadline = time.time() + 10.0
+            while not [pid for pid in pids if pid != old.pid] and time.time() < deadline:
+                time.sleep(0.01)
+            # connections accepted before are served until closed
+            in_flight.sendall(b'ping\n')
+            self.assertEqual(recv_line(in_flight), b'ping\n')
+            in_flight.close()
+            self.assertEqual(old.wait(10.0), 0)
+            time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join()
+
+        successors = set(pid for pid in pids if pid != old.pid)
+        for pid in successors:
+            os.kill(pid, signal.SIGTERM)
+        self.assertEqual(len(successors), 1)
+        self.assertEqual(refused, [])
+        # accepted by the successor only, once the old process is gone
+        self.assertEqual(pids[-1], successors.pop())
+
+class BatchedAcceptTest(unittest.TestCase):
+
+    def run_server(self, api, edge_triggered, limit):
+        ae = AsyncEvent(api = api, edge_triggered = edge_triggered)
+        server = BatchServerDispatcher(5, limit)
+        server.initialize(('127.0.0.1', 0), listen_backlog = 16)
+        clients = [socket.create_connection(server._sock.getsockname())
+                   for i in range(5)]
+        ae.register(server)
+        ae.loop()
+        for sock in clients:
+            sock.close()
+        ae.close()
+        return server
+
+    def test_one_batch(self):
+        server = self.run_server(AsyncEvent.API_POLL, False, None)
+        self.assertEqual(server.accepted, 5)
+        self.assertEqual(server.batches, [5])
+
+    def test_limit(self):
+        server = self.run_server(AsyncEvent.API_POLL, False, 2)
+        self.assertEqual(server.accepted, 5)
+        self.assertEqual(server.batches, [2, 2, 1])
+
+    def test_limit_edge_triggered(self):
+        if not hasattr(select, 'epoll'):
+            self.skipTest("epoll is not available")
+        server = self.run_server(AsyncEvent.API_EPOLL, True, 2)
+        self.assertEqual(server.accepted, 5)
+        self.assertEqual(server.batches, [2, 2, 1])
+
+    def test_invalid_limit(self):
+        server = TcpServerDispatcher()
+        self.assertRaises(ValueError, server.set_max_accepts_per_event, 0)
+
+#  -----------------------------------------------------------------------------
+
+class EdgeTriggeredTest(unittest.TestCase):
+
+    def test_fallback(self):
+        ae = AsyncEvent(api = AsyncEvent.API_POLL, edge_triggered = True)
+        self.assertFalse(ae.edge_triggered())
+
+    def test_drain_without_modify(self):
+        ae = AsyncEvent(api = AsyncEvent.API_EPOLL, edge_triggered = True)
+        if not ae.edge_triggered():
+            self.skipTest("epoll is not available")
+        ae._pollster = CountingPollster(ae._pollster)
+
+        sock_a, sock_b = socket.socketpair()
+        sock_b.sendall(b'x' * 100)
+        disp = DrainingDispatcher(sock_a, 100)
+        ae.register(disp)
+        ae.loop()
+        sock_b.close()
+
+        self.assertEqual(disp.received, b'x' * 100)
+        self.assertEqual(ae._pollster.modified, 0)
+
+    def test_accept_until_eagain(self):
+        ae = AsyncEvent(api = AsyncEvent.API_EPOLL, edge_triggered = True)
+        if not ae.edge_triggered():
+            self.skipTest("epoll is not available")
+
+        server = CountingServerDispatcher(5)
+        server.initialize(('127.0.0.1', 0), listen_backlog = 16)
+        clients = [socket.create_connection(server._sock.getsockname())
+                   for i in range(5)]
+        ae.register(server)
+        ae.loop()
+        for sock in clients:
+            sock.close()
+
+        self.assertEqual(server.accepted, 5)
+        self.assertEqual(server.read_events, 1)
+
+#  -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2012 Brian Yi ZHANG <brianlions at gmail dot com>
+#
+# This file is part of pynebula.
+#
+# pynebula is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pynebula is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pynebula. If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''
+Measures the cost of one AsyncEvent loop step, while the number of idle
+dispatchers carrying a timeout grows.
+
+Every loop step one "ticker" dispatcher fires a write event and re-arms its
+timeout, all other dispatchers are idle with a timeout far in the future. With
+the timers kept in a priority queue (or a timing wheel), the cost per step
+should stay (almost) flat as the number of idle dispatchers grows.
+'''
+
+import os
+import sys
+import time
+
+import add_nebula_path
+from nebula.asyncevent import AsyncEvent, Dispatcher
+
+class FdDispatcher(Dispatcher):
+    def __init__(self, fd, log_handle = None):
+        Dispatcher.__init__(self, log_handle = log_handle)
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+class IdleDispatcher(FdDispatcher):
+    def readable(self):
+        return False
+
+    def writable(self):
+        return False
+
+    def timeout(self):
+        return time.time() + 3600.0
+
+class TickerDispatcher(FdDispatcher):
+    def __init__(self, fd, max_steps, log_handle = None):
+        FdDispatcher.__init__(self, fd, log_handle = log_handle)
+        self.steps = 0
+        self.max_steps = max_steps
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def timeout(self):
+        return time.time() + 60.0
+
+    def handle_write(self):
+        self.steps += 1
+        if self.steps == self.max_steps:
+            self.pollster().set_stop_flag()
+
+def run(num_idle, max_steps, event_api, timer):
+    rd_end, wr_end = os.pipe()
+
+    ae = AsyncEvent(api = event_api, timer = timer)
+    idle = []
+    for i in range(num_idle):
+        disp = IdleDispatcher(os.dup(rd_end))
+        ae.register(disp)
+        idle.append(disp)
+
+    ticker = TickerDispatcher(wr_end, max_steps)
+    ae.register(ticker)
+
+    begin = time.perf_counter()
+    ae.loop()
+    elapsed = time.perf_counter() - begin
+
+    ae.unregister(ticker)
+    ticker.close()
+    for disp in idle:
+        ae.unregister(disp)
+        disp.close()
+    os.close(rd_end)
+
+    return elapsed / ticker.steps
+
+def main():
+    max_steps = 20000
+    counts = (0, 100, 1000, 10000)
+    if len(sys.argv) > 1:
+        counts = tuple(int(v) for v in sys.argv[1:])
+
+    print("{:>10s} {:>14s} {:>14s}".format("idle_fds", "heap usec/step",
+                                           "wheel usec/step"))
+    for num_idle in counts:
+        heap_cost = run(num_idle, max_steps, AsyncEvent.API_EPOLL,
+                        AsyncEvent.TIMER_HEAP)
+        wheel_cost = run(num_idle, max_steps, AsyncEvent.API_EPOLL,
+                         AsyncEvent.TIMER_WHEEL)
+        print("{:10d} {:14.3f} {:14.3f}".format(num_idle, heap_cost * 1000000,
+                                                wheel_cost * 1000000))
+
+if __name__ == '__main__':
+    main()